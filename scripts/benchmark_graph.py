@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  build time, memory and queries/sec of the concept graph
+
+# default modules
+from __future__ import print_function
+import os
+import random
+import resource
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from time import time as now
+
+# installed modules
+# no modules
+
+# project modules
+from src.concept_graph import ConceptGraph, MRREL_SCHEMA
+from src.concept_importer import ConceptImporterFromRRF
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process (ru_maxrss is in KB on
+    linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def build_graph(args):
+    """Builds and saves the graph; runs in its own process so that its
+    peak memory is measured alone"""
+    mrrel_path, graph_path = args
+    start = now()
+    graph = ConceptGraph.from_mrrel(mrrel_path, notifiy_every=10000000)
+    elapsed = now() - start
+    graph.save(graph_path)
+    return len(graph), graph.edges, elapsed, peak_rss_mb()
+
+
+def build_dict(mrrel_path):
+    """Baseline: relations of each CUI in a dictionary of lists"""
+    importer = ConceptImporterFromRRF(mrrel_path, MRREL_SCHEMA)
+    adjacency = {}
+    for record in importer.iter_records(('CUI1', 'REL', 'CUI2', 'RELA')):
+        adjacency.setdefault(record.CUI1, []).append(
+            (record.CUI2, record.REL, record.RELA))
+    return adjacency
+
+
+def dict_k_hop(adjacency, cuis, k, rels=None):
+    distances = {cui: 0 for cui in cuis if cui in adjacency}
+    frontier = list(distances)
+    for depth in xrange(1, k + 1):
+        reached = []
+        for cui in frontier:
+            for other, rel, _ in adjacency.get(cui, ()):
+                if ((rels is None or rel in rels) and
+                        other not in distances):
+                    distances[other] = depth
+                    reached.append(other)
+        frontier = reached
+    return distances
+
+
+def run_dict_baseline(args):
+    mrrel_path, queries, k = args
+    start = now()
+    adjacency = build_dict(mrrel_path)
+    elapsed = now() - start
+
+    start = now()
+    reached = sum(len(dict_k_hop(adjacency, [cui], k)) for cui in queries)
+    return elapsed, peak_rss_mb(), len(queries) / (now() - start), reached
+
+
+def measure(name, func, queries):
+    start = now()
+    reached = sum(len(func(cui)) for cui in queries)
+    elapsed = now() - start
+    print('[bench] {:<12} {:10.1f} queries/s  {:8.1f} concepts/query'.format(
+        name, len(queries) / elapsed, reached / float(len(queries))))
+    return reached
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument('mrrel', help='MRREL.RRF used to build the graph')
+    ap.add_argument('-g', '--graph', default=None,
+                    help='directory of a saved graph; built from MRREL '
+                         'and saved there if it does not exist')
+    ap.add_argument('-n', '--queries', type=int, default=2000)
+    ap.add_argument('-k', '--hops', type=int, default=2)
+    ap.add_argument('-b', '--baseline', action='store_true',
+                    help='also measure a dictionary of lists')
+    opts = ap.parse_args()
+
+    graph_path = opts.graph or '{}.graph'.format(opts.mrrel)
+    if not os.path.isdir(graph_path):
+        # a pool of one process, so that the memory used to build the
+        # graph is not counted when measuring queries
+        pool = Pool(1)
+        concepts, edges, elapsed, rss = pool.apply(
+            build_graph, ((opts.mrrel, graph_path), ))
+        pool.close()
+        pool.join()
+        print('[bench] {:,d} concepts, {:,d} relations built in {:.1f} s, '
+              'peak memory {:,.0f} MB'.format(concepts, edges, elapsed, rss))
+
+    start = now()
+    graph = ConceptGraph.load(graph_path)
+    print('[bench] graph loaded in {:.3f} s, on disk {:,.1f} MB'.format(
+        now() - start, sum(os.path.getsize(os.path.join(graph_path, f))
+                           for f in os.listdir(graph_path)) / 2. ** 20))
+
+    rnd = random.Random(0)
+    queries = [graph.cuis[rnd.randrange(len(graph))].decode('utf-8')
+               for _ in xrange(opts.queries)]
+
+    measure('neighbors', graph.neighbors, queries)
+    reached = measure('{}-hop'.format(opts.hops),
+                      lambda cui: graph.k_hop([cui], opts.hops), queries)
+    measure('ancestors', graph.ancestors, queries)
+    measure('descendants',
+            lambda cui: graph.descendants(cui, max_depth=opts.hops),
+            queries)
+    print('[bench] peak memory after queries {:,.0f} MB'.format(
+        peak_rss_mb()))
+
+    if opts.baseline:
+        pool = Pool(1)
+        elapsed, rss, qps, dict_reached = pool.apply(
+            run_dict_baseline, ((opts.mrrel, queries, opts.hops), ))
+        pool.close()
+        pool.join()
+        print('[bench] dict of lists: built in {:.1f} s, peak memory '
+              '{:,.0f} MB, {:.1f} {}-hop queries/s{}'.format(
+                  elapsed, rss, qps, opts.hops,
+                  '' if dict_reached == reached else ' (MISMATCH)'))
+
+
+if __name__ == '__main__':
+    main()
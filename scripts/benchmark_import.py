@@ -0,0 +1,261 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  end-to-end import benchmark against a fake elasticsearch
+
+# default modules
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+from time import time as now, strftime
+
+# installed modules
+# no modules
+
+# project modules
+from utils.config import Config
+from utils.fake_es import FakeElasticsearch
+from utils.metrics import metrics
+from utils.synthetic_mrconso import generate_mrconso
+
+
+CONFIG_PATH = 'config/import_elasticsearch.json'
+
+# counters of utils.metrics that make up the per-stage breakdown, as
+# (stage, seconds counter, amount counter, unit of the amount)
+STAGES = (('read', 'read_seconds_total', 'read_bytes_total', 'bytes'),
+          ('parse', 'parse_seconds_total', 'parse_rows_total', 'rows'),
+          ('serialize', 'serialize_seconds_total', 'serialize_docs_total',
+           'docs'))
+
+
+def git_revision():
+    """Commit of the working tree, if it is a git repository"""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'],
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its (finished)
+    children, such as the workers of parallel imports; ru_maxrss is in
+    kilobytes on Linux and in bytes on macOS"""
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return {who: resource.getrusage(res).ru_maxrss * unit / 2. ** 20
+            for who, res in (('self', resource.RUSAGE_SELF),
+                             ('children', resource.RUSAGE_CHILDREN))}
+
+
+def stage_breakdown(snapshot, elapsed):
+    """Time spent in each stage, its share of the elapsed time, and the
+    throughput of the stage while it runs; the latencies of concurrent
+    bulk requests can add up to more than the elapsed time"""
+    counters = snapshot['counters']
+    stages = {}
+    for stage, seconds_key, amount_key, unit in STAGES:
+        seconds = counters.get(seconds_key, 0.0)
+        amount = counters.get(amount_key, 0)
+        stages[stage] = {'seconds': seconds, unit: amount,
+                         'share': seconds / elapsed if elapsed else None,
+                         unit + '_per_sec': (amount / seconds
+                                             if seconds else None)}
+
+    hist = snapshot['histograms'].get('bulk_request_seconds')
+    if hist is not None:
+        requests = sum(hist['counts'])
+        stages['bulk'] = {
+            'seconds': hist['sum'], 'requests': requests,
+            'share': hist['sum'] / elapsed if elapsed else None,
+            'mean_latency': hist['sum'] / requests if requests else None,
+            'retries': counters.get('bulk_retries_total', 0),
+            'backoff_seconds': counters.get('bulk_backoff_seconds_total',
+                                            0.0),
+            'rejected_docs': counters.get('bulk_rejected_docs_total', 0)}
+    return stages
+
+
+def run_import(overrides, queue):
+    """Runs the import driver in a process of its own, so that each run
+    starts from a fresh heap and peak memory is its own"""
+    # imported here so that the import script is loaded by the process
+    # that runs it
+    from scripts.import_elasticsearch import driver
+
+    try:
+        config = Config(overrides, CONFIG_PATH)
+        metrics.reset()
+        start = now()
+        indexed = driver(config)
+        elapsed = now() - start
+        queue.put({'indexed': indexed, 'elapsed': elapsed,
+                   'metrics': metrics.snapshot(), 'rss': peak_rss_mb()})
+    except Exception as e:
+        queue.put({'error': '{}: {}'.format(type(e).__name__, e)})
+        raise
+
+
+def benchmark(name, fake, mrconso_path, input_stats, overrides):
+    config = {'elasticsearch': {'host': fake.host, 'port': fake.port,
+                                'index': 'umls', 'username': None,
+                                'password': None},
+              'mrconso_path': mrconso_path, 'notifiy_every': 0,
+              'metrics': {'enabled': True, 'log_every': 3600,
+                          'snapshot_path': None}}
+    for key, value in overrides.iteritems():
+        if isinstance(value, dict):
+            config[key] = dict(config.get(key, {}), **value)
+        else:
+            config[key] = value
+
+    queue = Queue()
+    process = Process(target=run_import, args=(config, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if 'error' in result:
+        raise RuntimeError('run "{}" failed: {}'.format(name,
+                                                        result['error']))
+
+    elapsed = result['elapsed']
+    rows = input_stats['rows']
+    return {'name': name, 'overrides': overrides,
+            'elapsed': elapsed, 'indexed': result['indexed'],
+            'in_fake_es': fake.count('umls'),
+            'rows_per_sec': rows / elapsed,
+            'mb_per_sec': input_stats['bytes'] / 2. ** 20 / elapsed,
+            'peak_rss_mb': max(result['rss'].values()),
+            'peak_rss_mb_by_process': result['rss'],
+            'stages': stage_breakdown(result['metrics'], elapsed),
+            'metrics': result['metrics']}
+
+
+def print_run(run, baseline=None):
+    line = ('[bench] {:<24} {:8.2f} s {:10,.0f} rows/s {:7.2f} MB/s '
+            '{:8.1f} MB rss'.format(run['name'], run['elapsed'],
+                                    run['rows_per_sec'], run['mb_per_sec'],
+                                    run['peak_rss_mb']))
+    if baseline is not None:
+        line += ' ({:+.1%} rows/s)'.format(
+            run['rows_per_sec'] / baseline['rows_per_sec'] - 1)
+    print(line)
+    for stage, stats in sorted(run['stages'].items()):
+        print('[bench] {:<24}   {:<9} {:8.2f} s {:6.1%} of the time'.format(
+            '', stage, stats['seconds'], stats['share'] or 0))
+    if run['indexed'] != run['in_fake_es']:
+        print('[bench] {:<24} {:,} indexed but {:,} in elasticsearch'.format(
+            '', run['indexed'], run['in_fake_es']))
+
+
+def main():
+    ap = ArgumentParser(description=(
+        'Imports a synthetic (or provided) MRCONSO into an in-process fake '
+        'elasticsearch with each bulk backend, and reports throughput, '
+        'peak memory and time spent by stage; results are saved as JSON '
+        'to compare versions.'))
+    ap.add_argument('-m', '--mrconso-path', default=None,
+                    help='MRCONSO to import instead of a synthetic one')
+    ap.add_argument('-r', '--rows', type=int, default=200000,
+                    help='rows of the synthetic MRCONSO')
+    ap.add_argument('-s', '--size-mb', type=float, default=None,
+                    help='size of the synthetic MRCONSO instead of rows')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('-b', '--backends', nargs='+',
+                    default=['serial', 'threaded', 'async'])
+    ap.add_argument('-w', '--workers', type=int, nargs='+', default=[1],
+                    help='also runs the serial backend with these '
+                    'numbers of workers')
+    ap.add_argument('-c', '--config', default='{}',
+                    help='JSON overrides of ' + CONFIG_PATH)
+    ap.add_argument('--latency', type=float, default=0.0,
+                    help='seconds added to every bulk request')
+    ap.add_argument('--latency-per-doc', type=float, default=0.0)
+    ap.add_argument('--reject-rate', type=float, default=0.0,
+                    help='probability of rejecting a document with 429')
+    ap.add_argument('--reject-request-rate', type=float, default=0.0)
+    ap.add_argument('-o', '--output', default=None,
+                    help='file results are written to as JSON')
+    ap.add_argument('--compare', default=None,
+                    help='results of a previous run to compare with')
+    ap.add_argument('-t', '--tmp-dir', default=None)
+    opts = ap.parse_args()
+
+    overrides = json.loads(opts.config)
+    runs = [(backend, dict(overrides, bulk=dict(
+        overrides.get('bulk', {}), backend=backend)))
+        for backend in opts.backends]
+    runs.extend(('serial, {} workers'.format(workers),
+                 dict(overrides, workers=workers))
+                for workers in opts.workers if workers > 1)
+
+    tmp_dir = tempfile.mkdtemp(dir=opts.tmp_dir)
+    try:
+        if opts.mrconso_path:
+            mrconso_path = opts.mrconso_path
+            with open(mrconso_path, 'rb') as f:
+                rows = sum(1 for _ in f)
+            input_stats = {'rows': rows, 'path': mrconso_path,
+                           'bytes': os.path.getsize(mrconso_path)}
+        else:
+            mrconso_path = os.path.join(tmp_dir, 'MRCONSO.RRF')
+            start = now()
+            input_stats = generate_mrconso(
+                mrconso_path, seed=opts.seed,
+                rows=None if opts.size_mb else opts.rows,
+                size=(int(opts.size_mb * 2 ** 20)
+                      if opts.size_mb else None))
+            print('[bench] {:,} synthetic rows ({:.1f} MB) written in '
+                  '{:.1f} s'.format(input_stats['rows'],
+                                    input_stats['bytes'] / 2. ** 20,
+                                    now() - start))
+
+        fake_es = {'latency': opts.latency,
+                   'latency_per_doc': opts.latency_per_doc,
+                   'reject_rate': opts.reject_rate,
+                   'reject_request_rate': opts.reject_request_rate}
+
+        baselines = {}
+        if opts.compare:
+            with open(opts.compare) as f:
+                previous = json.load(f)
+            baselines = {run['name']: run for run in previous['runs']}
+            if (previous['input']['bytes'] != input_stats['bytes'] or
+                    previous['fake_es'] != fake_es):
+                print('[bench] warning: {} was run on a different input '
+                      'or fake elasticsearch settings'.format(opts.compare))
+
+        results = {'time': strftime('%Y-%m-%dT%H:%M:%S'),
+                   'revision': git_revision(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'input': input_stats, 'fake_es': fake_es, 'runs': []}
+
+        for name, run_overrides in runs:
+            with FakeElasticsearch(seed=opts.seed, **fake_es) as fake:
+                run = benchmark(name, fake, mrconso_path, input_stats,
+                                run_overrides)
+            results['runs'].append(run)
+            print_run(run, baselines.get(name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('[bench] results written to {}'.format(opts.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  throughput of parsing compressed and split MRCONSO files
+
+# default modules
+from __future__ import print_function
+import os
+import gzip
+import shutil
+import zipfile
+import tempfile
+from argparse import ArgumentParser
+from time import time as now
+
+# installed modules
+# no modules
+
+# project modules
+from src.concept_importer import (ConceptImporterFromRRF,
+                                  ElasticSearchScoller, DEFAULT_BLOCK_SIZE)
+from utils.compressed_input import open_input, input_stat
+
+
+def write_gzip(src, dst, block_size):
+    with open(src, 'rb') as fin, gzip.open(dst, 'wb', 6) as fout:
+        shutil.copyfileobj(fin, fout, block_size)
+
+
+def write_zstd(src, dst, block_size):
+    import zstandard
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        zstandard.ZstdCompressor(level=3).copy_stream(fin, fout)
+
+
+def write_zip(src, dst, block_size):
+    with zipfile.ZipFile(dst, 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as archive:
+        archive.write(src, os.path.basename(dst)[:-len('.zip')])
+
+
+def write_gzip_parts(src, dst, block_size, parts=3):
+    """Splits src in parts of about the same size at newlines, as UMLS
+    releases do, each compressed on its own"""
+    size = os.path.getsize(src)
+    with open(src, 'rb') as fin:
+        for i in xrange(parts):
+            suffix = chr(ord('a') + i // 26) + chr(ord('a') + i % 26)
+            with gzip.open('{}.{}.gz'.format(dst, suffix), 'wb', 6) as fout:
+                limit = size * (i + 1) // parts
+                while fin.tell() < limit:
+                    fout.write(fin.read(min(block_size,
+                                            limit - fin.tell())))
+                if i < parts - 1:
+                    fout.write(fin.readline())
+
+
+def run_read(filepath, block_size, threaded):
+    """Decompressed bytes read, without parsing"""
+    total = 0
+    with open_input(filepath, block_size=block_size,
+                    threaded=threaded) as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            total += len(block)
+    return total
+
+
+def run_parse(filepath, block_size):
+    """Rows parsed by the batch parser, with the columns of the index"""
+    importer = ConceptImporterFromRRF(filepath, block_size=block_size)
+    return sum(len(batch) for batch
+               in importer.iter_batches(ElasticSearchScoller.columns))
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument('mrconso_path', help='uncompressed MRCONSO.RRF')
+    ap.add_argument('-b', '--block-size', type=int,
+                    default=DEFAULT_BLOCK_SIZE)
+    ap.add_argument('-t', '--tmp-dir', default=None,
+                    help='where compressed copies are written')
+    opts = ap.parse_args()
+
+    size = os.path.getsize(opts.mrconso_path)
+    tmp_dir = tempfile.mkdtemp(dir=opts.tmp_dir)
+    name = os.path.basename(opts.mrconso_path)
+    writers = [('gzip', write_gzip, name + '.gz'),
+               ('gzip parts', write_gzip_parts, name),
+               ('zip', write_zip, name + '.zip'),
+               ('zstd', write_zstd, name + '.zst')]
+
+    inputs = [('plain', opts.mrconso_path)]
+    try:
+        for label, write, filename in writers:
+            path = os.path.join(tmp_dir, filename)
+            start = now()
+            try:
+                write(opts.mrconso_path, path, opts.block_size)
+            except ImportError:
+                print('[bench] {:<12} skipped, zstandard is not installed'
+                      ''.format(label))
+                continue
+            print('[bench] {:<12} written in {:.2f} s, {:.1%} of the size'
+                  ''.format(label, now() - start,
+                            input_stat(path)[0] / float(size)))
+            inputs.append((label, path))
+
+        baseline = None
+        for label, path in inputs:
+            for threaded in ((False, True) if label != 'plain' else (False, )):
+                start = now()
+                run_read(path, opts.block_size, threaded)
+                elapsed = now() - start
+                print('[bench] {:<12} read {:<7} {:8.2f} s {:10,.1f} MB/s'
+                      ''.format(label, 'thread' if threaded else 'inline',
+                                elapsed, size / 2. ** 20 / elapsed))
+
+            start = now()
+            rows = run_parse(path, opts.block_size)
+            elapsed = now() - start
+            baseline = baseline or elapsed
+            print('[bench] {:<12} parse        {:8.2f} s {:10,.1f} MB/s '
+                  '{:12,.0f} rows/s ({:.2f}x)'.format(
+                      label, elapsed, size / 2. ** 20 / elapsed,
+                      rows / elapsed, baseline / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
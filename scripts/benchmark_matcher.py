@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  latency of exhaustive vs MaxScore local matching
+
+# default modules
+from __future__ import print_function
+import os
+from argparse import ArgumentParser
+from time import time as now
+
+# installed modules
+import numpy as np
+
+# project modules
+from src.local_matcher import LocalUmlsMatcher
+from utils.cache import memoize
+
+
+# spans of the kind found in clinical notes
+CLINICAL_STRINGS = [
+    u'acute myocardial infarction', u'chest pain', u'shortness of breath',
+    u'congestive heart failure', u'type 2 diabetes mellitus',
+    u'hypertension', u'chronic obstructive pulmonary disease',
+    u'atrial fibrillation', u'acute renal failure', u'pneumonia',
+    u'urinary tract infection', u'deep vein thrombosis',
+    u'pulmonary embolism', u'sepsis', u'anemia', u'hyperlipidemia',
+    u'coronary artery disease', u'cerebrovascular accident',
+    u'transient ischemic attack', u'gastroesophageal reflux disease',
+    u'left ventricular hypertrophy', u'abdominal pain',
+    u'nausea and vomiting', u'fever', u'headache', u'lower back pain',
+    u'fracture of left femur', u'metastatic breast carcinoma',
+    u'non-small cell lung cancer', u'hepatitis C virus infection',
+    u'cirrhosis of liver', u'iron deficiency anemia', u'vitamin D deficiency',
+    u'asthma exacerbation', u'acute bronchitis', u'migraine without aura',
+    u'major depressive disorder',
+    u'generalized anxiety disorder', u'end stage renal disease',
+    u'status post coronary artery bypass graft', u'metformin 500 mg',
+    u'aspirin', u'lisinopril', u'elevated troponin', u'ejection fraction',
+    u'bilateral lower extremity edema', u'MRI of the brain',
+    u'computed tomography of abdomen', u'hemoglobin A1c', u'CHF', u'COPD',
+]
+
+
+def time_queries(match, strings, k, method, formula):
+    latencies, results = [], []
+    for string in strings:
+        start = now()
+        results.append(match(string, k=k, method=method, formula=formula))
+        latencies.append(now() - start)
+    return np.array(latencies), results
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument('path', help='MRCONSO.RRF or a directory with a '
+                                 'matcher saved with LocalUmlsMatcher.save')
+    ap.add_argument('-k', type=int, default=10)
+    ap.add_argument('-f', '--formula', default='coverage',
+                    choices=('coverage', 'plugin'),
+                    help='scoring formula (see LocalUmlsMatcher)')
+    ap.add_argument('-r', '--repeat', type=int, default=3,
+                    help='times each string is queried')
+    ap.add_argument('-s', '--save', default=None,
+                    help='directory where to save the matcher once built')
+    opts = ap.parse_args()
+
+    start = now()
+    if os.path.isdir(opts.path):
+        matcher = LocalUmlsMatcher.load(opts.path)
+    else:
+        matcher = LocalUmlsMatcher.from_mrconso(opts.path,
+                                                notifiy_every=1000000)
+        if opts.save:
+            matcher.save(opts.save)
+    print('[bench] {:,d} atoms loaded in {:.1f} s'.format(len(matcher),
+                                                         now() - start))
+
+    strings = CLINICAL_STRINGS * opts.repeat
+    # repeated spans are answered from a cache of the results
+    cached_match = memoize(max_entries=len(CLINICAL_STRINGS))(matcher.match)
+    baseline = None
+    for method in ('exhaustive', 'maxscore', 'cached'):
+        if method == 'cached':
+            latencies, results = time_queries(cached_match, strings,
+                                              opts.k, 'maxscore',
+                                              opts.formula)
+        else:
+            latencies, results = time_queries(matcher.match, strings,
+                                              opts.k, method, opts.formula)
+        mean = latencies.mean()
+        baseline = mean if baseline is None else baseline
+        print('[bench] {:<10} mean {:8.2f} ms  p50 {:8.2f} ms  '
+              'p99 {:8.2f} ms  ({:.2f}x)'.format(
+                  method, mean * 1000,
+                  np.percentile(latencies, 50) * 1000,
+                  np.percentile(latencies, 99) * 1000, baseline / mean))
+        if method == 'cached':
+            print('[bench] cache hit rate {:.1%}'.format(
+                cached_match.cache.stats['hit_rate']))
+
+        if method == 'exhaustive':
+            expected = results
+        elif results != expected:
+            mismatches = sum(r != e for r, e in zip(results, expected))
+            print('[bench] {} queries differ from exhaustive scoring'
+                  ''.format(mismatches))
+
+
+if __name__ == '__main__':
+    main()
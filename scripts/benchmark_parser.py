@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  compares rows/sec of the MRCONSO parsing modes
+
+# default modules
+from __future__ import print_function
+from argparse import ArgumentParser
+from time import time as now
+
+# installed modules
+# no modules
+
+# project modules
+from src.concept_importer import (ConceptImporterFromRRF,
+                                  ElasticSearchScoller, DEFAULT_BLOCK_SIZE)
+from src.rrf_cache import RRFCache
+
+
+def run_iterator(filepath, limit, block_size):
+    """Current iterator: one dictionary per row, all columns"""
+    importer = ConceptImporterFromRRF(filepath, block_size=block_size)
+    cnt = 0
+    for _ in importer:
+        cnt += 1
+        if cnt == limit:
+            break
+    return cnt
+
+
+def run_records(filepath, limit, block_size, columns=None, cache_dir=None):
+    """Batch parser (or columnar cache), one record per row"""
+    importer = ConceptImporterFromRRF(filepath, block_size=block_size,
+                                      cache_dir=cache_dir)
+    cnt = 0
+    for _ in importer.iter_records(columns):
+        cnt += 1
+        if cnt == limit:
+            break
+    return cnt
+
+
+def run_batches(filepath, limit, block_size, columns=None):
+    """Batch parser, rows consumed one batch at the time"""
+    importer = ConceptImporterFromRRF(filepath, block_size=block_size)
+    cnt = 0
+    for batch in importer.iter_batches(columns):
+        cnt += len(batch)
+        if limit and cnt >= limit:
+            break
+    return cnt
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument('mrconso_path')
+    ap.add_argument('-l', '--limit', type=int, default=0,
+                    help='number of rows to parse (0 for all)')
+    ap.add_argument('-b', '--block-size', type=int,
+                    default=DEFAULT_BLOCK_SIZE)
+    ap.add_argument('-c', '--cache-dir', default=None,
+                    help='also read from a columnar cache in this directory')
+    opts = ap.parse_args()
+
+    cols = ElasticSearchScoller.columns
+    runs = [
+        ('iterator (all columns)', run_iterator, ()),
+        ('records (all columns)', run_records, ()),
+        ('records ({})'.format(','.join(cols)), run_records, (cols, )),
+        ('batches ({})'.format(','.join(cols)), run_batches, (cols, )),
+    ]
+
+    if opts.cache_dir:
+        start = now()
+        RRFCache.open_or_build(ConceptImporterFromRRF(opts.mrconso_path),
+                               opts.cache_dir)
+        print('[bench] cache ready in {:.2f} s'.format(now() - start))
+        runs.extend([
+            ('cache (all columns)', run_records, (None, opts.cache_dir)),
+            ('cache ({})'.format(','.join(cols)), run_records,
+             (cols, opts.cache_dir))])
+
+    baseline = None
+    for name, func, args in runs:
+        start = now()
+        cnt = func(opts.mrconso_path, opts.limit, opts.block_size, *args)
+        elapsed = now() - start
+        rate = cnt / elapsed if elapsed > 0 else float('inf')
+        baseline = rate if baseline is None else baseline
+        print('[bench] {:<32} {:>10,d} rows {:>8.2f} s {:>12,.0f} rows/s '
+              '({:.2f}x)'.format(name, cnt, elapsed, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  throughput of the dictionary tagger in documents/sec
+
+# default modules
+from __future__ import print_function
+import os
+import random
+from argparse import ArgumentParser
+from time import time as now
+
+# installed modules
+# no modules
+
+# project modules
+from src.concept_importer import ConceptImporterFromRRF
+from src.tagger import DictionaryTagger, tag_documents
+
+
+FILLER_WORDS = (u'the patient was admitted with a history of and no '
+                u'evidence on exam today denies reports mild severe '
+                u'left right since last week follow up in clinic').split()
+
+
+def make_documents(mrconso_filepath, n_docs, doc_length, seed=0):
+    """Synthetic notes of about doc_length tokens: filler words with
+    MRCONSO strings mixed in"""
+    rnd = random.Random(seed)
+    importer = ConceptImporterFromRRF(mrconso_filepath)
+    strings = [record.STR for _, record in
+               zip(xrange(100000), importer.iter_records(('STR', )))]
+
+    documents = []
+    for _ in xrange(n_docs):
+        words = []
+        while len(words) < doc_length:
+            if rnd.random() < 0.2:
+                words.append(rnd.choice(strings))
+            else:
+                words.append(rnd.choice(FILLER_WORDS))
+        documents.append(u' '.join(words) + u'.')
+    return documents
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument('mrconso', help='MRCONSO.RRF used to build the tagger '
+                                    'and to generate documents')
+    ap.add_argument('-t', '--tagger', default=None,
+                    help='directory of a saved tagger; built from MRCONSO '
+                         'and saved there if it does not exist')
+    ap.add_argument('-n', '--documents', type=int, default=2000)
+    ap.add_argument('-l', '--length', type=int, default=300,
+                    help='approximate tokens per document')
+    ap.add_argument('-w', '--workers', type=int, default=4)
+    ap.add_argument('-b', '--batch-size', type=int, default=256)
+    opts = ap.parse_args()
+
+    tagger_path = opts.tagger or '{}.tagger'.format(opts.mrconso)
+    if not os.path.isdir(tagger_path):
+        start = now()
+        tagger = DictionaryTagger.from_mrconso(opts.mrconso,
+                                               notifiy_every=1000000)
+        tagger.save(tagger_path)
+        print('[bench] {:,d} strings compiled in {:.1f} s'.format(
+            len(tagger), now() - start))
+
+    start = now()
+    tagger = DictionaryTagger.load(tagger_path)
+    print('[bench] {:,d} strings loaded in {:.3f} s'.format(
+        len(tagger), now() - start))
+
+    documents = make_documents(opts.mrconso, opts.documents, opts.length)
+
+    for workers in sorted(set([1, opts.workers])):
+        start = now()
+        mentions = list(tag_documents(tagger_path, documents,
+                                      workers=workers,
+                                      batch_size=opts.batch_size))
+        elapsed = now() - start
+        print('[bench] {} worker(s): {:8.1f} docs/s  {:10,.0f} tokens/s  '
+              '{:.1f} mentions/doc'.format(
+                  workers, len(documents) / elapsed,
+                  len(documents) * opts.length / elapsed,
+                  sum(len(m) for m in mentions) / float(len(documents))))
+
+
+if __name__ == '__main__':
+    main()
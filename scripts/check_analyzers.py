@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  checks the client-side analyzers against a corpus of
+#               cases; their expected tokens were written by hand, so
+#               they only guard against regressions until regenerated
+#               with the _analyze API of elasticsearch
+
+# default modules
+from __future__ import print_function
+import json
+import codecs
+from time import strftime
+from argparse import ArgumentParser
+
+# installed modules
+from elasticsearch.client import IndicesClient
+
+# project modules
+from src.analysis import load_analyzers
+from utils.es_tools import connect, versioned_index_name
+
+
+def check(analyzers, cases):
+    """Compares the local tokens of each case with the expected ones.
+
+    Returns:
+        mismatches (list): (case, local tokens) for each failing case
+    """
+    mismatches = []
+    for case in cases:
+        tokens = analyzers[case['analyzer']](case['text'])
+        if tokens != case['tokens']:
+            mismatches.append((case, tokens))
+    return mismatches
+
+
+def regenerate(corpus, mapping, host, port, index=None, username=None,
+               password=None):
+    """Replaces the expected tokens of each case with those returned by
+    the _analyze API, and records the version of elasticsearch they come
+    from in the source of the corpus. If index is not provided, a
+    temporary index with the analysis settings of mapping is created
+    and deleted afterwards; otherwise, index must use mapping."""
+    es = connect(host, port, username=username, password=password)
+    ic = IndicesClient(es)
+
+    temporary = index is None
+    if temporary:
+        index = versioned_index_name('analyzer_cases')
+        ic.create(index=index,
+                  body={'settings': mapping.get('settings', {})})
+    try:
+        for case in corpus['cases']:
+            resp = ic.analyze(index=index,
+                              body={'analyzer': case['analyzer'],
+                                    'text': case['text']})
+            case['tokens'] = [tok['token'] for tok in resp['tokens']]
+    finally:
+        if temporary:
+            ic.delete(index=index)
+
+    corpus['source'] = {
+        'elasticsearch': es.info()['version']['number'],
+        'index': None if temporary else index,
+        'generated': strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument('corpus', nargs='?',
+                    default='maps/ngrams_analyzer_cases.json')
+    ap.add_argument('-m', '--mapping', default='maps/ngrams.json')
+    ap.add_argument('-r', '--regenerate', action='store_true',
+                    help='fetch the expected tokens from elasticsearch')
+    ap.add_argument('--host', default='localhost')
+    ap.add_argument('--port', default=9200, type=int)
+    ap.add_argument('--index', default=None,
+                    help='index analyzed with; a temporary one with the '
+                    'settings of the mapping if not provided')
+    ap.add_argument('--username')
+    ap.add_argument('--password')
+    opts = ap.parse_args()
+
+    with codecs.open(opts.corpus, encoding='utf-8') as f:
+        corpus = json.load(f)
+
+    if opts.regenerate:
+        with open(opts.mapping) as f:
+            mapping = json.load(f)
+        regenerate(corpus, mapping, opts.host, opts.port, index=opts.index,
+                   username=opts.username, password=opts.password)
+        corpus['mapping'] = opts.mapping
+        with codecs.open(opts.corpus, 'w', encoding='utf-8') as f:
+            json.dump(corpus, f, indent=2, sort_keys=True,
+                      separators=(',', ': '), ensure_ascii=False)
+            f.write(u'\n')
+        print('[info] {} cases regenerated with elasticsearch {}'.format(
+            len(corpus['cases']), corpus['source']['elasticsearch']))
+        return
+
+    source = corpus.get('source', {})
+    if source.get('elasticsearch') is None:
+        print('[warning] expected tokens of {} were written by hand, not '
+              'produced by elasticsearch: matching them does not show '
+              'that the analyzers agree with a cluster; regenerate them '
+              'with -r to check that'.format(opts.corpus))
+    else:
+        print('[info] expected tokens from elasticsearch {} ({})'.format(
+            source['elasticsearch'], source['generated']))
+
+    analyzers = load_analyzers(opts.mapping, cache_size=0)
+    mismatches = check(analyzers, corpus['cases'])
+    for case, tokens in mismatches:
+        print(u'[error] {} "{}": expected {} got {}'.format(
+            case['analyzer'], case['text'], case['tokens'],
+            tokens).encode('utf-8'))
+    print('[info] {} of {} cases match'.format(
+        len(corpus['cases']) - len(mismatches), len(corpus['cases'])))
+
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,38 +5,433 @@
 # description:  import AUIs in elasticsearch from MRCONSO
 
 # default modules
+import os
 import json
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from time import time as now
 
 # installed modules
 
 # project modules
-from src.concept_importer import ElasticSearchScoller
+from src.concept_importer import (ConceptImporterFromRRF,
+                                  ElasticSearchScoller, split_byte_ranges)
+from src.rrf_cache import RRFCache
+from src.delta_importer import DeltaScroller
+from src.grouped_importer import GroupedScroller
+from src.enrichment import AtomEnricher
+from src.exact_index import ExactIndex
 
+from utils.bulk_payload import export_payloads
+from utils.checkpoint import ImportCheckpoint
+from utils.compressed_input import is_plain_input
+from utils.common import error_wrapper_pool
 from utils.config import parse_config
-from utils.es_tools import create_index, bulk_create, connect
+from utils.es_tools import (create_index, bulk_create, connect,
+                            finish_bulk_load, swap_alias, check_alias,
+                            versioned_index_name)
+from utils.metrics import metrics, MetricsReporter
+from utils.profiling import (profiler, profile,
+                             configure as configure_profiling)
 
 
+def import_filters(config):
+    """Row filters of the configuration as plain dictionaries"""
+    if not config.filters or not config.filters.keys():
+        return None
+    return {column: {key: list(values) for key, values
+                     in condition.iteritems()}
+            for column, condition in config.filters.iteritems()}
 
-def driver(config):
 
-    # create index
-    with file(config.mapping_path) as f:
-        mapping = json.load(f)
-    create_kwargs = dict(config.elasticsearch)
-    create_kwargs['mapping'] = mapping
-    create_index(**create_kwargs)
+@profile
+def index_range(es, index, doc_type, mrconso_path, chunk_size,
+                bulk_kwargs, start, end, cache_dir=None,
+                checkpoint_path=None, notifiy_every=0, filters=None,
+                mrsty_path=None, mrrank_path=None):
+    """Parses and indexes the byte range [start, end) of MRCONSO.
+
+    If checkpoint_path is provided, the offset after the last document
+    acknowledged is recorded there after every bulk chunk, and the range
+    is read from the offset recorded by a previous run, if any. If
+    mrsty_path or mrrank_path are provided, documents are enriched with
+    the semantic types and ranks they hold (see AtomEnricher).
+
+    Returns:
+        served (int): documents parsed
+        indexed (int): documents indexed
+        dropped (dict): rows skipped by filters, by column
+    """
+    offset = start
+    if checkpoint_path is not None:
+        checkpoint = ImportCheckpoint(checkpoint_path)
+        offset, resumed = checkpoint.progress(start)
+        if end is not None and offset >= end:
+            return 0, 0, {}
+
+    enricher = None
+    if mrsty_path or mrrank_path:
+        enricher = AtomEnricher(mrsty_path, mrrank_path)
+
+    scroller = ElasticSearchScoller(mrconso_path, index, doc_type,
+                                    notifiy_every=notifiy_every,
+                                    start=offset, end=end,
+                                    cache_dir=cache_dir,
+                                    track_offsets=checkpoint_path is not None,
+                                    filters=filters, enricher=enricher)
+
+    on_progress = None
+    if checkpoint_path is not None:
+        def on_progress(acknowledged):
+            checkpoint.update(start,
+                              scroller.acknowledged_offset(acknowledged),
+                              resumed + acknowledged)
+
+    indexed = bulk_create(client=es, docs=scroller, chunk_size=chunk_size,
+                          on_progress=on_progress, **bulk_kwargs)
+    dropped = (scroller.row_filter.dropped
+               if scroller.row_filter is not None else {})
+    return scroller.served, indexed, dropped
+
+
+def add_counts(total, counts):
+    """Adds the values of dictionary counts to those of total"""
+    for key, value in counts.iteritems():
+        total[key] = total.get(key, 0) + value
+    return total
+
+
+def print_dropped(dropped):
+    if dropped:
+        print '[info] rows dropped by filters: {}'.format(', '.join(
+            '{:,} by {}'.format(cnt, column)
+            for column, cnt in sorted(dropped.iteritems())))
+
+
+@error_wrapper_pool
+def import_range(args):
+    """Parses and indexes one byte range of MRCONSO; runs in a worker"""
+    (es_kwargs, bulk_kwargs, mrconso_path, doc_type,
+     chunk_size, start, end, cache_dir, checkpoint_path, filters,
+     mrsty_path, mrrank_path, metrics_enabled) = args
+
+    # metrics and profiled spans of each range are sent back to the
+    # parent process; the profiler keeps the settings it was forked with
+    metrics.reset()
+    metrics.enabled = metrics_enabled
+    profiler.reset()
+
+    start_time = now()
+    es = connect(**es_kwargs)
+    served, indexed, dropped = index_range(
+        es, es_kwargs['index'], doc_type, mrconso_path, chunk_size,
+        bulk_kwargs, start, end, cache_dir=cache_dir,
+        checkpoint_path=checkpoint_path, filters=filters,
+        mrsty_path=mrsty_path, mrrank_path=mrrank_path)
+
+    return {'pid': os.getpid(), 'start': start, 'end': end,
+            'served': served, 'indexed': indexed, 'dropped': dropped,
+            'elapsed': now() - start_time, 'metrics': metrics.snapshot(),
+            'profile': profiler.snapshot() if profiler.enabled else None}
+
+
+def parallel_import(config, index, doc_type, ranges):
+    """Parses and indexes the line-aligned byte ranges of MRCONSO with
+    config.workers processes, each with its own bulk stream"""
+    es_kwargs = dict(config.elasticsearch, index=index)
+    bulk_kwargs = dict(config.bulk)
+    tasks = [(es_kwargs, bulk_kwargs, config.mrconso_path, doc_type,
+              config.chunk_size, start, end, config.cache_dir,
+              config.checkpoint_path, import_filters(config),
+              config.mrsty_path, config.mrrank_path, metrics.enabled)
+             for start, end in ranges]
+    total_bytes = ranges[-1][1] if ranges else 0
+
+    print '[info] importing {} ranges with {} workers'.format(
+        len(tasks), config.workers)
+
+    start_time = now()
+    done_bytes = served = indexed = 0
+    per_worker, dropped = {}, {}
+
+    pool = Pool(config.workers)
+    try:
+        for i, resp in enumerate(pool.imap_unordered(import_range, tasks)):
+            done_bytes += resp['end'] - resp['start']
+            served += resp['served']
+            indexed += resp['indexed']
+            add_counts(dropped, resp['dropped'])
+            metrics.merge(resp['metrics'])
+            if resp['profile'] is not None:
+                profiler.merge(resp['profile'])
+
+            stats = per_worker.setdefault(resp['pid'], [0, 0, 0.0])
+            stats[0] += resp['served']
+            stats[1] += resp['indexed']
+            stats[2] += resp['elapsed']
+
+            elapsed = now() - start_time
+            print ('[info] {}/{} ranges, {:.1%} of input, {} served, '
+                   '{} indexed, {:.0f} docs/s'.format(
+                       i + 1, len(tasks),
+                       float(done_bytes) / total_bytes, served, indexed,
+                       indexed / elapsed if elapsed > 0 else 0))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    for pid, (w_served, w_indexed, w_elapsed) in sorted(per_worker.items()):
+        print '[info] worker {}: {} served, {} indexed in {:.1f} s'.format(
+            pid, w_served, w_indexed, w_elapsed)
+    print '[info] total: {} served, {} indexed in {:.1f} s'.format(
+        served, indexed, now() - start_time)
+    print_dropped(dropped)
+
+    return indexed
+
+
+def delta_import(config, doc_type):
+    """Applies to the index the changes from previous_mrconso_path to
+    mrconso_path; the index (or alias) must already exist"""
+    es = connect(**config.elasticsearch)
+    scroller = DeltaScroller(config.mrconso_path,
+                             config.previous_mrconso_path,
+                             config.elasticsearch.index, doc_type,
+                             notifiy_every=config.notifiy_every,
+                             cache_dir=config.cache_dir,
+                             filters=import_filters(config),
+                             **dict(config.delta))
+
+    start = now()
+    applied = bulk_create(client=es, docs=scroller,
+                          chunk_size=config.chunk_size, **dict(config.bulk))
+    print '[info] delta applied in {:.1f} s: {}'.format(
+        now() - start, ', '.join('{:,} {}'.format(v, k) for k, v
+                                 in sorted(scroller.changes.iteritems())))
+    return applied
+
+
+def make_scroller(config, index, doc_type):
+    """Bulk actions for every atom in mrconso_path, as set in layout;
+    documents are enriched if mrsty_path or mrrank_path are set"""
+    if config.layout.group_by != 'AUI':
+        return GroupedScroller(config.mrconso_path, index, doc_type,
+                               group_by=config.layout.group_by,
+                               notifiy_every=config.notifiy_every,
+                               cache_dir=config.cache_dir,
+                               buffer_size=config.layout.buffer_size,
+                               tmp_dir=config.layout.tmp_dir,
+                               filters=import_filters(config))
+
+    enricher = None
+    if config.mrsty_path or config.mrrank_path:
+        enricher = AtomEnricher(config.mrsty_path, config.mrrank_path)
+    return ElasticSearchScoller(config.mrconso_path, index, doc_type,
+                                notifiy_every=config.notifiy_every,
+                                cache_dir=config.cache_dir,
+                                filters=import_filters(config),
+                                enricher=enricher)
+
+
+def grouped_import(config, es, index, doc_type):
+    """Imports one document per group of atoms, as set in layout"""
+    scroller = make_scroller(config, index, doc_type)
+
+    start = now()
+    indexed = bulk_create(client=es, docs=scroller,
+                          chunk_size=config.chunk_size, **dict(config.bulk))
+    print '[info] {:,} atoms indexed as {:,} documents in {:.1f} s'.format(
+        scroller.atoms, indexed, now() - start)
+    if scroller.row_filter is not None:
+        print_dropped(scroller.row_filter.dropped)
+    return indexed
+
+
+def export_import(config, doc_type):
+    """Writes the bulk requests of a full import to payload_path instead
+    of sending them; see scripts/replay_elasticsearch.py"""
+    scroller = make_scroller(config, config.elasticsearch.index, doc_type)
+
+    start = now()
+    manifest = export_payloads(scroller, config.payload_path,
+                               chunk_size=config.chunk_size,
+                               max_chunk_bytes=config.bulk.max_chunk_bytes)
+    print ('[info] {:,} documents exported to "{}" in {:.1f} s: {:,} bulk '
+           'requests, {:,.1f} MB').format(
+               manifest['docs'], config.payload_path, now() - start,
+               len(manifest['files']), manifest['bytes'] / 2. ** 20)
+    if scroller.row_filter is not None:
+        print_dropped(scroller.row_filter.dropped)
+    return manifest['docs']
+
+
+def full_import(config, mapping, doc_type, resume=False):
+    """Creates the index and imports every atom in mrconso_path; if
+    resume, the import recorded in checkpoint_path continues instead"""
+    bulk_load = config.bulk_load
+    checkpoint = (ImportCheckpoint(config.checkpoint_path)
+                  if config.checkpoint_path else None)
+
+    workers = config.workers
+    if workers > 1 and not is_plain_input(config.mrconso_path):
+        # compressed files can only be read from the beginning
+        print '[info] compressed input is read by a single process'
+        workers = 1
+
+    if bulk_load.alias:
+        # fails before loading rather than when the alias is swapped
+        check_alias(connect(**config.elasticsearch),
+                    config.elasticsearch.index)
+
+    if resume:
+        if checkpoint is None:
+            raise ValueError('checkpoint_path is required to resume')
+        meta = checkpoint.load(config.mrconso_path)
+        index, ranges = meta['index'], meta['ranges']
+        resumed = sum(checkpoint.progress(start)[1] for start, _ in ranges)
+        print '[info] resuming import into "{}" after {:,} documents'.format(
+            index, resumed)
+    else:
+        # when loading through an alias, documents go to a new index
+        # that replaces the current one once the import is complete
+        if bulk_load.alias:
+            index = versioned_index_name(config.elasticsearch.index)
+        else:
+            index = config.elasticsearch.index
+
+        # create index
+        create_kwargs = dict(config.elasticsearch, index=index)
+        create_kwargs['mapping'] = mapping
+        create_kwargs['bulk_load'] = bulk_load.enabled
+        create_index(**create_kwargs)
+
+        if workers > 1:
+            # more ranges than workers, so that progress is reported
+            # regularly and workers that finish early pick up more work
+            ranges = split_byte_ranges(
+                config.mrconso_path,
+                config.workers * config.ranges_per_worker)
+        else:
+            # the whole file, whose size is not known if compressed
+            ranges = [(0, None)]
+
+        if checkpoint is not None:
+            checkpoint.start(index, config.mrconso_path, ranges)
 
     # connect to new index
     es = connect(**config.elasticsearch)
 
+    if config.cache_dir:
+        # built once here rather than by each worker
+        cache = RRFCache.open_or_build(
+            ConceptImporterFromRRF(config.mrconso_path), config.cache_dir)
+        print '[info] reading {:,} rows from cache "{}"'.format(
+            len(cache), cache.path)
+
+    if config.layout.group_by != 'AUI':
+        indexed = grouped_import(config, es, index, doc_type)
+    elif workers > 1:
+        indexed = parallel_import(config, index, doc_type, ranges)
+    else:
+        indexed, dropped = 0, {}
+        for start, end in ranges:
+            _, range_indexed, range_dropped = index_range(
+                es, index, doc_type, config.mrconso_path, config.chunk_size,
+                dict(config.bulk), start, end, cache_dir=config.cache_dir,
+                checkpoint_path=config.checkpoint_path,
+                notifiy_every=config.notifiy_every,
+                filters=import_filters(config),
+                mrsty_path=config.mrsty_path, mrrank_path=config.mrrank_path)
+            indexed += range_indexed
+            add_counts(dropped, range_dropped)
+        print_dropped(dropped)
+
+    if bulk_load.enabled:
+        print '[info] restoring settings of "{}"'.format(index)
+        finish_bulk_load(es, index, mapping,
+                         force_merge=bulk_load.force_merge,
+                         max_num_segments=bulk_load.max_num_segments)
+
+    if bulk_load.alias:
+        alias = config.elasticsearch.index
+        old_indices = swap_alias(es, alias, index,
+                                 delete_old=bulk_load.delete_old)
+        print '[info] alias "{}" moved to "{}" from {}'.format(
+            alias, index, ', '.join(old_indices) or 'no index')
+
+    if checkpoint is not None:
+        checkpoint.clear()
+
+    return indexed
+
+
+@profile
+def driver(config, resume=False):
+
+    with file(config.mapping_path) as f:
+        mapping = json.load(f)
     doc_type = mapping['mappings'].keys()[0]
-    scroller = ElasticSearchScoller(config.mrconso_path,
-                                    config.elasticsearch.index, doc_type,
-                                    notifiy_every=config.notifiy_every)
-    bulk_create(client=es, docs=scroller, chunk_size=config.chunk_size)
 
+    if config.layout.group_by != 'AUI':
+        # documents are built from atoms sorted by group, so neither
+        # byte offsets nor per-atom changes map to documents
+        if config.previous_mrconso_path or config.checkpoint_path:
+            raise ValueError('delta imports and checkpoints require the '
+                             '"AUI" layout')
+
+    if config.mrsty_path or config.mrrank_path:
+        # semantic types are joined in the order of MRCONSO
+        if config.previous_mrconso_path or config.layout.group_by != 'AUI':
+            raise ValueError('semantic types and ranks can only be added '
+                             'by full imports with the "AUI" layout')
+
+    if config.payload_path:
+        # documents are only written to disk, so there is no index to
+        # update or to resume importing into
+        if config.previous_mrconso_path or config.checkpoint_path:
+            raise ValueError('delta imports and checkpoints can not be '
+                             'exported to payload_path')
+    elif config.previous_mrconso_path and resume:
+        raise ValueError('delta imports can not be resumed')
+
+    reporter = None
+    if config.metrics.enabled:
+        metrics.enabled = True
+        reporter = MetricsReporter(metrics, config.metrics.log_every,
+                                   config.metrics.snapshot_path).start()
+
+    try:
+        if config.payload_path:
+            indexed = export_import(config, doc_type)
+        elif config.previous_mrconso_path:
+            indexed = delta_import(config, doc_type)
+        else:
+            indexed = full_import(config, mapping, doc_type, resume=resume)
+
+        if config.exact_index_path:
+            start = now()
+            exact_index = ExactIndex.from_mrconso(
+                config.mrconso_path, notifiy_every=config.notifiy_every,
+                cache_dir=config.cache_dir, filters=import_filters(config))
+            exact_index.save(config.exact_index_path)
+            print ('[info] exact index of {:,} strings saved in {:.1f} s'
+                   ''.format(len(exact_index), now() - start))
+    finally:
+        if reporter is not None:
+            reporter.stop()
+
+    return indexed
 
 
 if __name__ == '__main__':
+    ag = ArgumentParser()
+    ag.add_argument('--resume', action='store_true',
+                    help='continue the import recorded in checkpoint_path')
+    opts, _ = ag.parse_known_args()
+
     config = parse_config('config/import_elasticsearch.json')
-    driver(config)
+    configure_profiling(**dict(config.profiling))
+    driver(config, resume=opts.resume)
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  match strings against the umls index
+
+# default modules
+import json
+import codecs
+from itertools import islice
+from time import time as now
+
+# installed modules
+# no modules
+
+# project modules
+from utils.cache import DiskCache
+from utils.config import parse_config, config_fingerprint
+from utils.es_tools import connect
+from utils.matcher import UmlsMatcher
+from utils.profiling import profile, configure as configure_profiling
+
+
+# settings that change the candidates of a string
+RESULT_SETTINGS = ('elasticsearch', 'mapping_path', 'matcher',
+                   'exact_index_path')
+
+
+@profile
+def driver(config):
+    es = connect(config.elasticsearch.host, config.elasticsearch.port,
+                 username=config.elasticsearch.username,
+                 password=config.elasticsearch.password)
+    matcher_kwargs = dict(config.matcher)
+    if config.disk_cache.path:
+        # results are only valid for the settings they were found with
+        matcher_kwargs['result_cache'] = DiskCache(
+            config.disk_cache.path, max_bytes=config.disk_cache.max_bytes,
+            namespace=config_fingerprint(config, include=RESULT_SETTINGS))
+
+    matcher = UmlsMatcher(es, config.elasticsearch.index,
+                          config.mapping_path,
+                          exact_index=config.exact_index_path,
+                          **matcher_kwargs)
+
+    start, matched = now(), 0
+    with codecs.open(config.input_path, encoding='utf-8') as fin, \
+            open(config.output_path, 'w') as fout:
+        lines = (ln.rstrip(u'\r\n') for ln in fin)
+        while True:
+            strings = list(islice(lines, config.lines_per_round))
+            if not strings:
+                break
+            for candidates in matcher.match(strings):
+                fout.write(json.dumps(candidates) + '\n')
+            matched += len(strings)
+            print '[info] {:,} strings matched ({:.1f} strings/s)'.format(
+                matched, matched / (now() - start))
+
+    if matcher.result_cache is not None:
+        stats = matcher.result_cache.stats
+        print '[info] result cache: {:.1%} hits, {:,} evicted'.format(
+            stats['hit_rate'], stats['evictions'])
+
+    return matched
+
+
+if __name__ == '__main__':
+    config = parse_config('config/match_elasticsearch.json')
+    configure_profiling(**dict(config.profiling))
+    driver(config)
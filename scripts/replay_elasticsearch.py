@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  send exported bulk payloads to one or more clusters
+
+# default modules
+import json
+from time import time as now
+
+# installed modules
+# no modules
+
+# project modules
+from utils.bulk_payload import replay_payloads, load_manifest
+from utils.config import parse_config
+from utils.es_tools import (create_index, connect, finish_bulk_load,
+                            swap_alias, check_alias, versioned_index_name)
+
+
+def driver(config):
+    with file(config.mapping_path) as f:
+        mapping = json.load(f)
+    doc_type = mapping['mappings'].keys()[0]
+    bulk_load = config.bulk_load
+    manifest = load_manifest(config.payload_path)
+
+    # the same name in every cluster, so that they can be told apart
+    # by the release they hold
+    if bulk_load.alias:
+        index = versioned_index_name(config.index)
+    else:
+        index = config.index
+
+    clusters = [dict(cluster) for cluster in config.clusters]
+    if bulk_load.alias:
+        # every cluster is checked before any of them is loaded
+        for cluster in clusters:
+            check_alias(connect(**cluster), config.index)
+    for cluster in clusters:
+        create_index(index=index, mapping=mapping,
+                     bulk_load=bulk_load.enabled, **cluster)
+    clients = [connect(**cluster) for cluster in clusters]
+
+    print '[info] sending {:,} documents in {:,} payloads to {} cluster(s)' \
+        ''.format(manifest['docs'], len(manifest['files']), len(clients))
+    start = now()
+    indexed = replay_payloads(clients, config.payload_path, index,
+                              doc_type=doc_type,
+                              max_in_flight=config.max_in_flight,
+                              max_retries=config.max_retries,
+                              initial_backoff=config.initial_backoff,
+                              notifiy_every=config.notifiy_every)
+    elapsed = now() - start
+    print '[info] {:,.1f} MB sent to each cluster in {:.1f} s ({:,.1f} MB/s)' \
+        ''.format(manifest['bytes'] / 2. ** 20, elapsed,
+                  manifest['bytes'] / 2. ** 20 / elapsed if elapsed else 0)
+
+    for cluster, es, cluster_indexed in zip(clusters, clients, indexed):
+        name = '{}:{}'.format(cluster['host'], cluster['port'])
+        print '[info] {}: {:,} documents indexed'.format(
+            name, cluster_indexed)
+
+        if bulk_load.enabled:
+            print '[info] {}: restoring settings of "{}"'.format(name, index)
+            finish_bulk_load(es, index, mapping,
+                             force_merge=bulk_load.force_merge,
+                             max_num_segments=bulk_load.max_num_segments)
+
+        if bulk_load.alias:
+            old_indices = swap_alias(es, config.index, index,
+                                     delete_old=bulk_load.delete_old)
+            print '[info] {}: alias "{}" moved to "{}" from {}'.format(
+                name, config.index, index, ', '.join(old_indices) or
+                'no index')
+
+    return indexed
+
+
+if __name__ == '__main__':
+    config = parse_config('config/replay_elasticsearch.json')
+    driver(config)
@@ -0,0 +1,409 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  client-side replica of the analyzers of the umls index
+
+# default modules
+import os
+import re
+import json
+from threading import Lock
+
+# installed modules
+# no modules
+
+# project modules
+from src.porter import PorterStemmer
+from utils.cache import Cache
+
+
+# approximation of the word boundary rules (UAX #29) of the standard
+# tokenizer: letters and digits are joined with each other and with
+# underscores; MidLetter (e.g. ":") and MidNumLet (e.g. "." or "'")
+# characters are kept between two letters, MidNum (e.g. ",") and
+# MidNumLet characters between two digits. Ideographs and hiragana are
+# emitted one character at the time.
+_IDEOGRAPHIC = u'\u3040-\u309f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_MID_NUM_LETTER = u".'\u2018\u2019\u2024\ufe52\uff07\uff0e"
+_MID_LETTER = (u":\u00b7\u0387\u05f4\u2027\ufe13\ufe55\uff1a" +
+               _MID_NUM_LETTER)
+_MID_NUM = (u",;\u037e\u0589\u060c\u060d\u066c\u07f8\u2044\ufe10\ufe14"
+            u"\ufe50\ufe54\uff0c\uff1b" + _MID_NUM_LETTER)
+_WORD = u'(?:(?![{0}])\\w)'.format(_IDEOGRAPHIC)
+_LETTER = u'(?:(?![{0}])[^\\W\\d_])'.format(_IDEOGRAPHIC)
+_STANDARD_TOKEN = re.compile(
+    u'[{ideo}]|{w}+(?:(?:(?<={l})[{ml}](?={l})|(?<=\\d)[{mn}](?=\\d)){w}+)*'
+    u''.format(ideo=_IDEOGRAPHIC, w=_WORD, l=_LETTER,
+               ml=re.escape(_MID_LETTER), mn=re.escape(_MID_NUM)),
+    re.UNICODE)
+_HAS_ALNUM = re.compile(u'[^\\W_]', re.UNICODE)
+
+# default stop words of lucene's EnglishAnalyzer
+ENGLISH_STOPWORDS = frozenset([
+    u'a', u'an', u'and', u'are', u'as', u'at', u'be', u'but', u'by', u'for',
+    u'if', u'in', u'into', u'is', u'it', u'no', u'not', u'of', u'on', u'or',
+    u'such', u'that', u'the', u'their', u'then', u'there', u'these',
+    u'they', u'this', u'to', u'was', u'will', u'with'])
+
+_POSSESSIVE_QUOTES = frozenset([u"'", u'\u2019', u'\uff07'])
+
+_stemmer = PorterStemmer()
+
+
+def standard_tokenize(text, max_token_length=255):
+    """Splits text in tokens like the standard tokenizer; as in lucene 6,
+    tokens longer than max_token_length are dropped."""
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return [tok for tok in _STANDARD_TOKEN.findall(text)
+            if len(tok) <= max_token_length and _HAS_ALNUM.search(tok)]
+
+
+def lowercase_filter(tokens):
+    return [tok.lower() for tok in tokens]
+
+
+def ngram_filter(tokens, min_gram=1, max_gram=2):
+    """All n-grams of each token with min_gram <= n <= max_gram, ordered
+    by token, then by start offset, then by length"""
+    grams = []
+    for tok in tokens:
+        length = len(tok)
+        for start in xrange(length - min_gram + 1):
+            for n in xrange(min_gram, min(max_gram, length - start) + 1):
+                grams.append(tok[start:start + n])
+    return grams
+
+
+def english_possessive_filter(tokens):
+    """Removes trailing 's from tokens"""
+    return [tok[:-2] if (len(tok) >= 2 and tok[-1] in u'sS' and
+                         tok[-2] in _POSSESSIVE_QUOTES) else tok
+            for tok in tokens]
+
+
+def stop_filter(tokens, stopwords=ENGLISH_STOPWORDS):
+    return [tok for tok in tokens if tok not in stopwords]
+
+
+def porter_stem_filter(tokens):
+    return [_stemmer.stem(tok) for tok in tokens]
+
+
+def standard_tokenize_spans(text, max_token_length=255):
+    """Same tokens as standard_tokenize, as tuples (token, start, end)
+    where start and end are character offsets in text."""
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return [(m.group(), m.start(), m.end())
+            for m in _STANDARD_TOKEN.finditer(text)
+            if (m.end() - m.start() <= max_token_length and
+                _HAS_ALNUM.search(m.group()))]
+
+
+def whitespace_tokenize(text, max_token_length=255):
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return [tok for tok in text.split() if len(tok) <= max_token_length]
+
+
+def keyword_tokenize(text):
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return [text] if text else []
+
+
+def _make_standard_tokenizer(params):
+    max_token_length = params.get('max_token_length', 255)
+    return lambda text: standard_tokenize(text, max_token_length)
+
+
+def _make_whitespace_tokenizer(params):
+    max_token_length = params.get('max_token_length', 255)
+    return lambda text: whitespace_tokenize(text, max_token_length)
+
+
+def _make_ngram_filter(params):
+    min_gram = int(params.get('min_gram', 1))
+    max_gram = int(params.get('max_gram', 2))
+    return lambda tokens: ngram_filter(tokens, min_gram, max_gram)
+
+
+def _make_stop_filter(params):
+    stopwords = params.get('stopwords', '_english_')
+    if stopwords == '_english_':
+        stopwords = ENGLISH_STOPWORDS
+    elif stopwords == '_none_':
+        stopwords = frozenset()
+    elif isinstance(stopwords, basestring):
+        raise ValueError('unsupported stop words "{}"'.format(stopwords))
+
+    if params.get('ignore_case', False):
+        stopwords = frozenset(w.lower() for w in stopwords)
+        return lambda tokens: [tok for tok in tokens
+                               if tok.lower() not in stopwords]
+    stopwords = frozenset(stopwords)
+    return lambda tokens: stop_filter(tokens, stopwords)
+
+
+def _make_stemmer_filter(params):
+    language = params.get('language', params.get('name', 'english'))
+    if language in ('english', 'porter'):
+        return porter_stem_filter
+    elif language == 'possessive_english':
+        return english_possessive_filter
+    raise ValueError('unsupported stemmer "{}"'.format(language))
+
+
+# factories of tokenizers and token filters by elasticsearch type; each
+# factory receives the settings of the component
+TOKENIZERS = {
+    'standard': _make_standard_tokenizer,
+    'whitespace': _make_whitespace_tokenizer,
+    'keyword': lambda params: keyword_tokenize
+}
+
+TOKEN_FILTERS = {
+    'lowercase': lambda params: lowercase_filter,
+    'standard': lambda params: list,
+    'ngram': _make_ngram_filter,
+    'nGram': _make_ngram_filter,
+    'stop': _make_stop_filter,
+    'porter_stem': lambda params: porter_stem_filter,
+    'stemmer': _make_stemmer_filter
+}
+
+# built-in analyzers of elasticsearch 5, as (tokenizer, filters)
+BUILTIN_ANALYZERS = {
+    'standard': ('standard', ['lowercase']),
+    'whitespace': ('whitespace', []),
+    'keyword': ('keyword', []),
+    'english': ('standard', [{'type': 'stemmer',
+                              'language': 'possessive_english'},
+                             'lowercase', 'stop', 'porter_stem'])
+}
+
+DEFAULT_CACHE_SIZE = 10000
+
+# mapping of the umls index
+DEFAULT_MAPPING = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'maps', 'ngrams.json')
+
+
+class Analyzer(object):
+    """Tokenizer followed by a chain of token filters, with a LRU cache of
+    the tokens of the most recently analyzed strings.
+
+    Args:
+        name (str): name of the analyzer
+        tokenizer (function): maps a string to a list of tokens
+        filters (list): functions that map a list of tokens to another
+        cache_size (int, default=DEFAULT_CACHE_SIZE): number of strings
+            whose tokens are cached; 0 disables the cache.
+        cache_bytes (int, default=None): if set, the cache is also
+            bounded to about this many bytes (see utils.cache.Cache)
+    """
+    def __init__(self, name, tokenizer, filters=None,
+                 cache_size=DEFAULT_CACHE_SIZE, cache_bytes=None):
+        self.name = name
+        self.tokenizer = tokenizer
+        self.filters = filters if filters is not None else []
+        self.cache_size = cache_size
+        self.cache = Cache(max_entries=cache_size, max_bytes=cache_bytes)
+
+    @property
+    def hits(self):
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        return self.cache.misses
+
+    def __repr__(self):
+        return '<Analyzer "{}">'.format(self.name)
+
+    def analyze(self, text):
+        """Tokens of text, without looking at the cache"""
+        tokens = self.tokenizer(text)
+        for token_filter in self.filters:
+            tokens = token_filter(tokens)
+        return tokens
+
+    def _cache_get(self, text):
+        return self.cache.get(text)
+
+    def _cache_set(self, text, tokens):
+        self.cache.put(text, tokens)
+
+    def __call__(self, text):
+        if not self.cache_size:
+            return self.analyze(text)
+
+        tokens = self._cache_get(text)
+        if tokens is None:
+            tokens = tuple(self.analyze(text))
+            self._cache_set(text, tokens)
+        return list(tokens)
+
+    def analyze_many(self, texts):
+        """Tokens of each string in texts, in order; each distinct string
+        is analyzed once.
+
+        Args:
+            texts (iterable): strings to analyze
+
+        Returns:
+            tokens (list): one list of tokens per string
+        """
+        texts = list(texts)
+        analyzed = {}
+        for text in texts:
+            if text in analyzed:
+                continue
+            tokens = self._cache_get(text) if self.cache_size else None
+            if tokens is None:
+                tokens = tuple(self.analyze(text))
+                if self.cache_size:
+                    self._cache_set(text, tokens)
+            analyzed[text] = tokens
+        return [list(analyzed[text]) for text in texts]
+
+
+def _load_mapping(mapping):
+    if isinstance(mapping, basestring):
+        with file(mapping) as f:
+            mapping = json.load(f)
+    return mapping
+
+
+def _make_component(spec, custom, factories, kind):
+    """Builds a tokenizer or filter from its name or inline definition;
+    names are looked up in the custom components of the settings first"""
+    if isinstance(spec, basestring):
+        params = custom.get(spec, {'type': spec})
+    else:
+        params = spec
+    component_type = params.get('type', spec)
+    if component_type not in factories:
+        raise ValueError('unsupported {} "{}"'.format(kind, component_type))
+    return factories[component_type](params)
+
+
+def load_analyzers(mapping, cache_size=DEFAULT_CACHE_SIZE):
+    """Analyzers defined in the settings of an index, plus the built-in
+    ones.
+
+    Args:
+        mapping (dict or str): index body with settings and mappings (as
+            in maps/ngrams.json) or path to it
+        cache_size (int, default=DEFAULT_CACHE_SIZE): size of the cache
+            of each analyzer
+
+    Returns:
+        analyzers (dict): analyzers by name
+    """
+    mapping = _load_mapping(mapping)
+    analysis = mapping.get('settings', {}).get('analysis', {})
+    custom_tokenizers = analysis.get('tokenizer', {})
+    custom_filters = analysis.get('filter', {})
+
+    definitions = {name: {'tokenizer': tokenizer, 'filter': filters}
+                   for name, (tokenizer, filters)
+                   in BUILTIN_ANALYZERS.iteritems()}
+    for name, definition in analysis.get('analyzer', {}).iteritems():
+        analyzer_type = definition.get('type', 'custom')
+        if analyzer_type != 'custom':
+            if analyzer_type not in BUILTIN_ANALYZERS:
+                raise ValueError('unsupported analyzer type "{}"'
+                                 ''.format(analyzer_type))
+            tokenizer, filters = BUILTIN_ANALYZERS[analyzer_type]
+            definition = {'tokenizer': tokenizer, 'filter': filters}
+        elif definition.get('char_filter'):
+            raise ValueError('char filters are not supported '
+                             '(analyzer "{}")'.format(name))
+        definitions[name] = definition
+
+    analyzers = {}
+    for name, definition in definitions.iteritems():
+        tokenizer = _make_component(definition['tokenizer'],
+                                    custom_tokenizers, TOKENIZERS,
+                                    'tokenizer')
+        filters = [_make_component(spec, custom_filters, TOKEN_FILTERS,
+                                   'token filter')
+                   for spec in definition.get('filter', [])]
+        analyzers[name] = Analyzer(name, tokenizer, filters, cache_size)
+    return analyzers
+
+
+def load_field_analyzers(mapping, doc_type=None,
+                         cache_size=DEFAULT_CACHE_SIZE):
+    """Analyzers of the analyzed fields of a mapping.
+
+    Args:
+        mapping (dict or str): index body or path to it
+        doc_type (str, default=None): type whose fields are returned; the
+            first one in the mapping if not provided
+        cache_size (int, default=DEFAULT_CACHE_SIZE): size of the cache
+            of each analyzer
+
+    Returns:
+        analyzers (dict): analyzer of each field by field name
+    """
+    mapping = _load_mapping(mapping)
+    analyzers = load_analyzers(mapping, cache_size=cache_size)
+
+    if doc_type is None:
+        doc_type = mapping['mappings'].keys()[0]
+    properties = mapping['mappings'][doc_type]['properties']
+
+    fields = {}
+    for field, spec in properties.iteritems():
+        if spec.get('type') not in ('string', 'text'):
+            continue
+        if spec.get('index') in ('not_analyzed', 'no', False):
+            continue
+        name = spec.get('analyzer', 'standard')
+        if name not in analyzers:
+            raise ValueError('field "{}" uses unknown analyzer "{}"'
+                             ''.format(field, name))
+        fields[field] = analyzers[name]
+    return fields
+
+
+_NON_ALNUM = re.compile(u'[\\W_]+', re.UNICODE)
+
+
+def normalize_string(text):
+    """Lowercases text and replaces runs of punctuation and whitespace
+    with a single space; strings that only differ in case, spacing or
+    punctuation have the same normal form."""
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return _NON_ALNUM.sub(u' ', text.lower()).strip()
+
+
+_default_analyzers = {}
+_default_analyzers_lock = Lock()
+
+
+def default_field_analyzers():
+    """Analyzers of the fields of DEFAULT_MAPPING (see
+    load_field_analyzers), loaded on first use; they do not cache
+    tokens, as most strings are only analyzed once."""
+    if not _default_analyzers:
+        with _default_analyzers_lock:
+            if not _default_analyzers:
+                _default_analyzers.update(
+                    load_field_analyzers(DEFAULT_MAPPING, cache_size=0))
+    return _default_analyzers
+
+
+def analyze_ngrams(text):
+    """Tokens of text for the "ngrams" field of DEFAULT_MAPPING"""
+    return default_field_analyzers()['ngrams'](text)
+
+
+def analyze_english(text):
+    """Tokens of text for the "text" field of DEFAULT_MAPPING"""
+    return default_field_analyzers()['text'](text)
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  graph of the relations between concepts in MRREL
+
+# default modules
+import os
+import json
+
+# installed modules
+import numpy as np
+
+# project modules
+from src.concept_importer import ConceptImporterFromRRF, decode_utf8
+from utils.common import mkdir_p
+
+
+u = decode_utf8
+
+MRREL_SCHEMA = [('CUI1', u), ('AUI1', u), ('STYPE1', u), ('REL', u),
+                ('CUI2', u), ('AUI2', u), ('STYPE2', u), ('RELA', u),
+                ('RUI', u), ('SRUI', u), ('SAB', u), ('SL', u), ('RG', u),
+                ('DIR', u), ('SUPPRESS', u), ('CVF', int)]
+
+
+class ConceptGraph(object):
+    """Relations between concepts stored as a compressed sparse row
+    adjacency over integer concept ids.
+
+    Concepts are numbered by the order of their CUIs, which are kept
+    sorted in cuis, so that a CUI is mapped to its id with a binary
+    search. The relations of concept i are those at positions
+    indptr[i]:indptr[i + 1] of indices (the id of the other concept),
+    rel and rela (codes of REL and RELA, whose values are in rels and
+    relas). As in MRREL, REL is the relation of the other concept to
+    concept i: the ancestors of a concept are found following "PAR"
+    relations, its descendants following "CHD" ones. Relations that
+    only differ by source or atoms are stored once.
+
+    Arrays can be memory mapped (see load), so that processes share a
+    single copy of the graph.
+    """
+
+    arrays = ('cuis', 'indptr', 'indices', 'rel', 'rela')
+
+    def __init__(self, cuis, indptr, indices, rel, rela, rels, relas):
+        self.cuis = cuis
+        self.indptr = indptr
+        self.indices = indices
+        self.rel = rel
+        self.rela = rela
+        self.rels = rels
+        self.relas = relas
+
+    def __len__(self):
+        """Number of concepts"""
+        return len(self.cuis)
+
+    @property
+    def edges(self):
+        return len(self.indices)
+
+    @classmethod
+    def build(cls, records, notifiy_every=0):
+        """Builds the graph from batches of records with fields CUI1,
+        REL, CUI2 and RELA (see ConceptImporterFromRRF.iter_batches).
+
+        Memory is about 11 bytes per row of MRREL plus a dictionary of
+        the CUIs while building.
+        """
+        ids, rel_codes, rela_codes = {}, {}, {}
+        sources, targets, rel, rela = [], [], [], []
+        cnt = 0
+
+        for batch in records:
+            # ids are assigned by first appearance and sorted later
+            sources.append(np.fromiter(
+                (ids.setdefault(r.CUI1, len(ids)) for r in batch),
+                dtype=np.int32, count=len(batch)))
+            targets.append(np.fromiter(
+                (ids.setdefault(r.CUI2, len(ids)) for r in batch),
+                dtype=np.int32, count=len(batch)))
+            rel.append(np.fromiter(
+                (rel_codes.setdefault(r.REL, len(rel_codes))
+                 for r in batch), dtype=np.int8, count=len(batch)))
+            rela.append(np.fromiter(
+                (rela_codes.setdefault(r.RELA, len(rela_codes))
+                 for r in batch), dtype=np.int16, count=len(batch)))
+
+            previous, cnt = cnt, cnt + len(batch)
+            if (notifiy_every > 0 and
+                    cnt // notifiy_every > previous // notifiy_every):
+                print '[info] {:,} relations read'.format(cnt)
+
+        if len(rel_codes) > np.iinfo(np.int8).max + 1:
+            raise ValueError('too many values of REL ({})'.format(
+                len(rel_codes)))
+        if len(rela_codes) > np.iinfo(np.int16).max + 1:
+            raise ValueError('too many values of RELA ({})'.format(
+                len(rela_codes)))
+
+        cuis = sorted(ids)
+        rank = np.empty(len(ids), dtype=np.int32)
+        rank[[ids[cui] for cui in cuis]] = np.arange(len(ids),
+                                                     dtype=np.int32)
+        ids.clear()
+
+        def concatenate(chunks, dtype):
+            return (np.concatenate(chunks) if chunks
+                    else np.empty(0, dtype=dtype))
+
+        sources = rank[concatenate(sources, np.int32)]
+        targets = rank[concatenate(targets, np.int32)]
+        rel = concatenate(rel, np.int8)
+        rela = concatenate(rela, np.int16)
+
+        # sorts relations by source, dropping repeated ones
+        order = np.lexsort((rela, rel, targets, sources))
+        sources, targets = sources[order], targets[order]
+        rel, rela = rel[order], rela[order]
+        del order
+        if len(sources):
+            keep = np.ones(len(sources), dtype=bool)
+            keep[1:] = ((sources[1:] != sources[:-1]) |
+                        (targets[1:] != targets[:-1]) |
+                        (rel[1:] != rel[:-1]) | (rela[1:] != rela[:-1]))
+            sources, targets = sources[keep], targets[keep]
+            rel, rela = rel[keep], rela[keep]
+
+        indptr = np.searchsorted(sources, np.arange(len(cuis) + 1))
+        return cls(np.array([cui.encode('utf-8') for cui in cuis],
+                            dtype='S'),
+                   indptr.astype(np.int64), targets, rel, rela,
+                   sorted(rel_codes, key=rel_codes.get),
+                   sorted(rela_codes, key=rela_codes.get))
+
+    @classmethod
+    def from_mrrel(cls, mrrel_filepath, notifiy_every=0, **kwargs):
+        """Builds the graph from a MRREL file; kwargs are passed to
+        ConceptImporterFromRRF (e.g., filters on SAB or SUPPRESS)"""
+        kwargs.setdefault('mrconso_schema', MRREL_SCHEMA)
+        importer = ConceptImporterFromRRF(mrrel_filepath, **kwargs)
+        return cls.build(importer.iter_batches(('CUI1', 'REL', 'CUI2',
+                                                'RELA')),
+                         notifiy_every=notifiy_every)
+
+    def save(self, path):
+        mkdir_p(path)
+        for name in self.arrays:
+            np.save(os.path.join(path, '{}.npy'.format(name)),
+                    getattr(self, name))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'concepts': len(self), 'edges': self.edges,
+                       'rels': self.rels, 'relas': self.relas}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Loads a graph saved with save(); arrays are memory mapped
+        unless mmap_mode is None."""
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(path, '{}.npy'.format(name)),
+                          mmap_mode=mmap_mode).view(np.ndarray)
+                  for name in cls.arrays]
+        return cls(*(arrays + [meta['rels'], meta['relas']]))
+
+    def ids(self, cuis):
+        """Ids of cuis; -1 for those that are not in the graph"""
+        keys = np.array([cui.encode('utf-8') if isinstance(cui, unicode)
+                         else cui for cui in cuis], dtype='S')
+        if not len(keys) or not len(self.cuis):
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.searchsorted(self.cuis, keys)
+        pos[pos == len(self.cuis)] = 0
+        return np.where(self.cuis[pos] == keys, pos, -1)
+
+    def __codes_mask(self, values, vocabulary):
+        """Boolean array over the codes of vocabulary, true for values;
+        None if values is None"""
+        if values is None:
+            return None
+        values = set(values)
+        return np.array([v in values for v in vocabulary], dtype=bool)
+
+    def _expand(self, ids, rel_mask=None, rela_mask=None):
+        """Ids of the concepts related to ids (with repetitions), only
+        following relations allowed by the masks"""
+        starts, ends = self.indptr[ids], self.indptr[ids + 1]
+        lengths = ends - starts
+        total = int(lengths.sum())
+        if not total:
+            return np.empty(0, dtype=self.indices.dtype)
+
+        # positions of all the relations of ids, without a python loop
+        offsets = np.cumsum(lengths) - lengths
+        positions = (np.arange(total) - np.repeat(offsets, lengths) +
+                     np.repeat(starts, lengths))
+
+        neighbors = self.indices[positions]
+        if rel_mask is not None:
+            keep = rel_mask[self.rel[positions]]
+            if rela_mask is not None:
+                keep &= rela_mask[self.rela[positions]]
+            neighbors = neighbors[keep]
+        elif rela_mask is not None:
+            neighbors = neighbors[rela_mask[self.rela[positions]]]
+        return neighbors
+
+    def neighbors(self, cui, rels=None, relas=None):
+        """Relations of cui as a list of tuples (CUI, REL, RELA), where
+        REL is the relation of CUI to cui; only those with REL in rels
+        and RELA in relas are returned, if provided."""
+        i = int(self.ids([cui])[0])
+        if i < 0:
+            return []
+        start, end = self.indptr[i], self.indptr[i + 1]
+        rel_mask = self.__codes_mask(rels, self.rels)
+        rela_mask = self.__codes_mask(relas, self.relas)
+
+        result = []
+        for target, rel, rela in zip(self.indices[start:end].tolist(),
+                                     self.rel[start:end].tolist(),
+                                     self.rela[start:end].tolist()):
+            if ((rel_mask is None or rel_mask[rel]) and
+                    (rela_mask is None or rela_mask[rela])):
+                result.append((self.cuis[target].decode('utf-8'),
+                               self.rels[rel], self.relas[rela]))
+        return result
+
+    def k_hop(self, cuis, k=1, rels=None, relas=None):
+        """Concepts within k relations of any of cuis, following only
+        relations with REL in rels and RELA in relas, if provided; with
+        k=None, all the concepts that can be reached.
+
+        Returns:
+            distances (dict): number of relations from the closest of
+                cuis (0 for cuis themselves) of each concept reached
+        """
+        rel_mask = self.__codes_mask(rels, self.rels)
+        rela_mask = self.__codes_mask(relas, self.relas)
+
+        # neighborhoods are usually small, so the concepts visited are
+        # kept in a dictionary rather than in arrays
+        frontier = [i for i in set(self.ids(cuis).tolist()) if i >= 0]
+        distances = dict.fromkeys(frontier, 0)
+
+        depth = 0
+        while frontier and (k is None or depth < k):
+            depth += 1
+            reached = self._expand(np.array(frontier, dtype=np.int64),
+                                   rel_mask, rela_mask)
+            frontier = [i for i in set(reached.tolist())
+                        if i not in distances]
+            distances.update(dict.fromkeys(frontier, depth))
+
+        ids = distances.keys()
+        return {cui.decode('utf-8'): distances[i] for i, cui
+                in zip(ids, self.cuis[ids].tolist())}
+
+    def ancestors(self, cui, rels=('PAR', ), max_depth=None):
+        """Ancestors of cui with their depth, following relations with
+        REL in rels (by default, parents); cui itself is excluded"""
+        distances = self.k_hop([cui], k=max_depth, rels=rels)
+        distances.pop(cui if isinstance(cui, unicode)
+                      else cui.decode('utf-8'), None)
+        return distances
+
+    def descendants(self, cui, rels=('CHD', ), max_depth=None):
+        """Descendants of cui with their depth (see ancestors)"""
+        return self.ancestors(cui, rels=rels, max_depth=max_depth)
@@ -5,15 +5,173 @@
 # description:  Importer class for concepts
 
 # default modules
-import codecs
+import os
+from time import time as now
+from operator import itemgetter
+from collections import namedtuple, deque
 
 # installed modules
-# no modules
+import numpy as np
 
 # project modules
-# no modules
+from utils.compressed_input import open_input, is_plain_input
+from utils.metrics import metrics
 
 
+# size of the blocks read from disk by the batch parser
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def decode_utf8(s):
+    return s.decode('utf-8')
+
+
+def parse_ts(s):
+    return s.lower() == 'p'
+
+
+def parse_flag(s):
+    return s.lower() == 'y'
+
+
+# functions that give the same result when applied to a field that
+# has already been decoded; the batch parser uses them to decode
+# entire blocks at once instead of one field at the time.
+TEXT_SAFE_FUNCTIONS = set([parse_ts, parse_flag, int])
+
+__record_types = {}
+
+
+def make_record_type(columns):
+    """Returns a tuple-backed record type with fields columns"""
+    columns = tuple(columns)
+    if columns not in __record_types:
+        __record_types[columns] = namedtuple('MRCONSORecord', columns)
+    return __record_types[columns]
+
+
+def split_byte_ranges(filepath, n):
+    """Splits filepath in at most n ranges of roughly the same size.
+    Each range is returned as a tuple (start, end) of byte offsets;
+    ranges begin at the start of a line and end after a newline (or
+    at the end of the file)."""
+    if not is_plain_input(filepath):
+        raise ValueError('"{}" is not an uncompressed file, it can not be '
+                         'split in byte ranges'.format(filepath))
+    size = os.path.getsize(filepath)
+    boundaries = [0]
+    with open(filepath, 'rb') as f:
+        for i in xrange(1, n):
+            # moves to the beginning of the line following the one
+            # that contains the byte before the split point
+            f.seek(max(size * i // n, boundaries[-1] + 1) - 1)
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > boundaries[-1]:
+                boundaries.append(pos)
+    boundaries.append(size)
+    return zip(boundaries[:-1], boundaries[1:])
+
+
+def _both_encodings(values):
+    """values as both byte strings and unicode, so that they can be
+    compared with fields whether or not these have been decoded"""
+    variants = set()
+    for value in values:
+        variants.add(value)
+        if isinstance(value, unicode):
+            variants.add(value.encode('utf-8'))
+        else:
+            variants.add(value.decode('utf-8'))
+    return variants
+
+
+class RowFilter(object):
+    """Selects rows of an RRF file by the values of their columns.
+
+    filters maps column names to dictionaries with keys include and/or
+    exclude, lists of values as written in the file (e.g., "ENG" for
+    LAT, "P" for TS, "Y" for ISPREF; an empty string for a missing
+    value). A row is kept if the value of each column is in include,
+    if provided, and not in exclude. Conditions are checked on the
+    fields of the split line, before they are parsed; rows that are
+    dropped are counted in dropped under the first column that rejects
+    them, the others in kept.
+    """
+
+    def __init__(self, filters, schema):
+        names = [name for name, _ in schema]
+        funcs = dict(schema)
+        self.conditions = []
+        self.parsed_conditions = []
+        for column, condition in sorted(filters.iteritems()):
+            condition = dict(condition)
+            if column not in names:
+                raise ValueError('unknown column "{}" in filters'
+                                 ''.format(column))
+            unknown = set(condition).difference(('include', 'exclude'))
+            if unknown:
+                raise ValueError('unknown options {} of filter "{}"'.format(
+                    ', '.join(sorted(unknown)), column))
+
+            include = condition.get('include')
+            exclude = condition.get('exclude') or []
+            self.conditions.append((
+                column, names.index(column),
+                _both_encodings(include) if include is not None else None,
+                _both_encodings(exclude)))
+
+            # the same conditions on values parsed with the schema, as
+            # read from a columnar cache (see src.rrf_cache)
+            func = funcs[column]
+            parse = lambda v: (None if not v else v if func is decode_utf8
+                               else func(v.encode('utf-8')))
+            self.parsed_conditions.append((
+                column, len(self.parsed_conditions),
+                set(map(parse, include)) if include is not None else None,
+                set(map(parse, exclude))))
+
+        self.kept = 0
+        self.dropped = {column: 0 for column, _, _, _ in self.conditions}
+
+    @property
+    def columns(self):
+        return [column for column, _, _, _ in self.conditions]
+
+    @property
+    def positions(self):
+        """Positions in the schema of the columns filtered on"""
+        return [pos for _, pos, _, _ in self.conditions]
+
+    def __check(self, fields, conditions):
+        for column, pos, include, exclude in conditions:
+            value = fields[pos]
+            if ((include is not None and value not in include) or
+                    value in exclude):
+                self.dropped[column] += 1
+                return False
+        self.kept += 1
+        return True
+
+    def __call__(self, fields):
+        """Whether to keep the row with fields, the values of all its
+        columns (up to the last one filtered on) as found in the file"""
+        return self.__check(fields, self.conditions)
+
+    def mask(self, values):
+        """Whether to keep each of a sequence of rows, given the parsed
+        values of the columns filtered on (a list per column, in the
+        order of self.columns)"""
+        return [self.__check(fields, self.parsed_conditions)
+                for fields in zip(*values)]
+
+    def summary(self):
+        return ', '.join(['{:,} kept'.format(self.kept)] +
+                         ['{:,} dropped by {}'.format(cnt, column)
+                          for column, cnt in sorted(self.dropped.items())])
+
 
 class AbstractConceptImporter(object):
     """Abstract class for concept importer"""
@@ -32,40 +190,70 @@ class AbstractConceptImporter(object):
 
 
 class ConceptImporterFromRRF(AbstractConceptImporter):
-    """docstring for ConceptImporterFromRRF"""
-    def __init__(self, mrconso_filepath, mrconso_schema=None):
+    """Reads concepts from a MRCONSO.RRF file.
+
+    Rows can either be read one at the time as dictionaries using next()
+    or in batches of compact records using iter_batches() and
+    iter_records(); the latter only decodes the columns requested and
+    can be restricted to the byte range [start, end) of the file, which
+    must be aligned to lines (see split_byte_ranges). If cache_dir is
+    provided, the latter read from a columnar cache of the parsed file
+    kept there (see src.rrf_cache), which is built on first use.
+
+    If filters is provided, only the rows that satisfy it are read (see
+    RowFilter); the counts of rows kept and dropped are in row_filter.
+
+    The file can be compressed (.gz, .zst or .zip) or split in parts
+    (see utils.compressed_input.open_input); byte offsets are then those
+    of the decompressed content, and reaching start requires reading
+    everything before it.
+    """
+    def __init__(self, mrconso_filepath, mrconso_schema=None,
+                 block_size=DEFAULT_BLOCK_SIZE, start=0, end=None,
+                 cache_dir=None, filters=None):
         super(ConceptImporterFromRRF, self).__init__()
         self.filepath = mrconso_filepath
 
-
-        u = lambda s: s.decode('utf-8')
+        u = decode_utf8
 
         # uses the current MRCONSO schema if not provided
         if mrconso_schema is None:
             mrconso_schema = [('CUI', u), ('LAT', u),
-                ('TS', lambda x: True if x.lower() == 'p' else False),
+                ('TS', parse_ts),
                 ('LUI', u), ('STT', u), ('SUI', u),
-                ('ISPREF', lambda x: True if x.lower() == 'y' else False),
+                ('ISPREF', parse_flag),
                 ('AUI', u), ('SAUI', u), ('SCUI', u),
                 ('SDUI', u), ('SAB', u), ('TTY', u),
                 ('CODE', u), ('STR', u), ('SRL', int),
                 ('SUPPRESS', u), ('CFV', int)]
 
         self.schema = mrconso_schema
+        self.block_size = block_size
+        self.start = start
+        self.end = end
+        self.cache_dir = cache_dir
+        self.filters = filters
+        self.row_filter = (RowFilter(filters, mrconso_schema)
+                           if filters else None)
 
         self.__file = None
 
     def __open(self):
-        self.__file = codecs.open(self.filepath)
+        self.__file = open_input(self.filepath, block_size=self.block_size)
 
     def next(self):
         if self.__file is None:
             self.__open()
 
-        raw = self.__file.readline().strip().split('|')
+        while True:
+            ln = self.__file.readline()
+
+            if ln == '':
+                raise StopIteration
 
-        if raw == '':
-            raise StopIteration
+            raw = ln.strip().split('|')
+            if self.row_filter is None or self.row_filter(raw):
+                break
 
         # applies the function specified in the schema to the row
         parsed = {k: func(ln) if len(ln) > 0 else None
@@ -73,11 +261,177 @@ class ConceptImporterFromRRF(AbstractConceptImporter):
 
         return parsed
 
+    def iter_lines(self, with_offsets=False):
+        """Yields lists of raw lines read from the file in blocks of
+        self.block_size bytes; if with_offsets, tuples (lines, offset)
+        where offset is the position in the file of the first line."""
+        read_bytes = metrics.counter('read_bytes_total')
+        read_seconds = metrics.counter('read_seconds_total')
+        with open_input(self.filepath, self.start, self.block_size) as f:
+            to_read = None if self.end is None else self.end - self.start
+            position = self.start
+
+            remainder = ''
+            while True:
+                start = now()
+                if to_read is None:
+                    block = f.read(self.block_size)
+                else:
+                    block = f.read(min(self.block_size, to_read))
+                    to_read -= len(block)
+                read_seconds.inc(now() - start)
+                read_bytes.inc(len(block))
+
+                if not block:
+                    break
+
+                cut = block.rfind('\n')
+                if cut < 0:
+                    remainder += block
+                    continue
+
+                lines = (remainder + block[:cut]).split('\n')
+                if with_offsets:
+                    yield lines, position
+                else:
+                    yield lines
+                position += len(remainder) + cut + 1
+                remainder = block[cut + 1:]
+
+            if remainder:
+                yield ([remainder], position) if with_offsets else [remainder]
+
+    def iter_batches(self, columns=None, with_offsets=False):
+        """Yields one list of records per block read from disk.
+
+        Args:
+            columns (list, default=None): names of the columns to parse;
+                all the columns in the schema are parsed if not provided.
+            with_offsets (bool, default=False): if true, each list of
+                records comes with the list of the byte offsets in the
+                file where their lines end (newline included).
+
+        Returns:
+            batches (generator): lists of records of type
+                make_record_type(columns), or tuples (records, offsets)
+                if with_offsets.
+        """
+        if self.cache_dir is not None:
+            # imported here as src.rrf_cache depends on this module
+            from src.rrf_cache import RRFCache
+            cache = RRFCache.open_or_build(self, self.cache_dir)
+            parse_rows = metrics.counter('parse_rows_total')
+            for batch in cache.iter_batches(self.schema, columns,
+                                            self.start, self.end,
+                                            with_offsets=with_offsets,
+                                            row_filter=self.row_filter):
+                parse_rows.inc(len(batch[0] if with_offsets else batch))
+                yield batch
+            return
+
+        names = [name for name, _ in self.schema]
+        if columns is None:
+            columns = names
+
+        indices = [names.index(col) for col in columns]
+        funcs = [self.schema[i][1] for i in indices]
+        record_type = make_record_type(columns)
+        make_record = record_type._make
+
+        # no need to split past the last column that is requested or
+        # filtered on
+        row_filter = self.row_filter
+        maxsplit = max(indices + (row_filter.positions
+                                  if row_filter is not None else [])) + 1
+
+        # if all functions can be applied on decoded text, each block
+        # is decoded at once and fields that are just decoded are
+        # not touched again
+        block_decode = all(func is decode_utf8 or func in TEXT_SAFE_FUNCTIONS
+                           for func in funcs)
+        if block_decode:
+            conversions = [(pos, func) for pos, func in enumerate(funcs)
+                           if func is not decode_utf8]
+            sep, nl = u'|', u'\n'
+        else:
+            conversions = list(enumerate(funcs))
+            sep, nl = '|', '\n'
+
+        if len(indices) > 1:
+            project = itemgetter(*indices)
+        else:
+            project = lambda raw, i=indices[0]: (raw[i], )
+
+        parse_lines = metrics.counter('parse_lines_total')
+        parse_rows = metrics.counter('parse_rows_total')
+        parse_seconds = metrics.counter('parse_seconds_total')
+
+        for lines, position in self.iter_lines(with_offsets=True):
+            start = now()
+            parse_lines.inc(len(lines))
+            if with_offsets:
+                ends = position + np.cumsum([len(ln) + 1 for ln in lines])
+
+            if block_decode:
+                lines = '\n'.join(lines).decode('utf-8').split(nl)
+
+            batch, kept = [], []
+            for i, ln in enumerate(lines):
+                if not ln:
+                    continue
+                try:
+                    raw = ln.split(sep, maxsplit)
+                    if row_filter is not None and not row_filter(raw):
+                        continue
+                    fields = [f or None for f in project(raw)]
+                except IndexError:
+                    print '[error] could not parse "{}"'.format(
+                        ln.encode('utf-8') if block_decode else ln)
+                    continue
+
+                for pos, func in conversions:
+                    if fields[pos] is not None:
+                        fields[pos] = func(fields[pos])
+
+                batch.append(make_record(fields))
+                kept.append(i)
+
+            parse_rows.inc(len(batch))
+            parse_seconds.inc(now() - start)
+            if with_offsets:
+                yield batch, ends[kept].tolist()
+            else:
+                yield batch
+
+    def iter_records(self, columns=None):
+        """Yields records one at the time; see iter_batches"""
+        for batch in self.iter_batches(columns):
+            for record in batch:
+                yield record
+
+
 class ElasticSearchScoller(ConceptImporterFromRRF):
+    """Serves the bulk actions that index the atoms of MRCONSO.
+
+    If track_offsets, the byte offset where the line of each document
+    served ends is kept until acknowledged_offset() is called, so that
+    the import can be resumed after the last document indexed. If
+    enricher is provided (see src.enrichment.AtomEnricher), it adds
+    its fields to each document.
+    """
+
+    # columns of MRCONSO used to build documents
+    columns = ('AUI', 'CUI', 'SUI', 'STR')
+
     def __init__(self, mrconso_filepath, index, doc_type,
-                 mrconso_schema=None, demo=None, notifiy_every=0):
+                 mrconso_schema=None, demo=None, notifiy_every=0,
+                 block_size=DEFAULT_BLOCK_SIZE, start=0, end=None,
+                 cache_dir=None, track_offsets=False, filters=None,
+                 enricher=None):
         super(ElasticSearchScoller, self).__init__(mrconso_filepath,
-                                                   mrconso_schema)
+                                                   mrconso_schema,
+                                                   block_size, start, end,
+                                                   cache_dir, filters)
         self.index = index
         self.doc_type = doc_type
 
@@ -85,8 +439,59 @@ class ElasticSearchScoller(ConceptImporterFromRRF):
         # iterator raises StopIteration
         self.__demo = int(demo) if demo is not None else demo
         self.__cnt = 0
+        self.__records = None
         self.notifiy_every = notifiy_every
 
+        self.track_offsets = track_offsets
+        self.enricher = enricher
+        if enricher is not None:
+            self.columns = self.columns + tuple(
+                col for col in enricher.columns if col not in self.columns)
+        self.__offsets = deque()
+        self.__acknowledged = (0, start)
+
+    @property
+    def served(self):
+        """Number of documents served so far"""
+        return self.__cnt
+
+    def acknowledged_offset(self, count):
+        """Byte offset where the line of the count-th document served
+        ends, i.e., where reading should start again once the first
+        count documents are indexed; count can not decrease between
+        calls. Requires track_offsets."""
+        acknowledged, offset = self.__acknowledged
+        while acknowledged < count:
+            offset = self.__offsets.popleft()
+            acknowledged += 1
+        self.__acknowledged = (acknowledged, offset)
+        return offset
+
+    def iter_tracked_records(self, columns):
+        """Like iter_records, also recording the offset of each record"""
+        for batch, ends in self.iter_batches(columns, with_offsets=True):
+            for record, end in zip(batch, ends):
+                self.__offsets.append(end)
+                yield record
+
+    def make_doc(self, record):
+        """Builds the elasticsearch action for record"""
+        doc = {
+            '_index': self.index,
+            '_type': self.doc_type,
+            '_id': record.AUI,
+            '_source': {
+                'text': record.STR,
+                'ngrams': record.STR,
+                'AUI': record.AUI,
+                'CUI': record.CUI,
+                'SUI': record.SUI
+                }
+        }
+        if self.enricher is not None:
+            self.enricher.enrich(record, doc['_source'])
+        return doc
+
     def next(self):
 
         if self.__demo is not None:
@@ -95,25 +500,13 @@ class ElasticSearchScoller(ConceptImporterFromRRF):
             else:
                 raise StopIteration
 
-        error = True
-        while error:
-            row = super(ElasticSearchScoller, self).next()
-            try:
-                doc = {
-                    '_index': self.index,
-                    '_type': self.doc_type,
-                    '_id': row['AUI'],
-                    '_source': {
-                        'text': row['STR'],
-                        'ngrams': row['STR'],
-                        'AUI': row['AUI'],
-                        'CUI': row['CUI'],
-                        'SUI': row['SUI']
-                        }
-                }
-                error = False
-            except KeyError:
-                print '[error] could not parse "{}"'.format(str(row))
+        if self.__records is None:
+            if self.track_offsets:
+                self.__records = self.iter_tracked_records(self.columns)
+            else:
+                self.__records = self.iter_records(self.columns)
+
+        doc = self.make_doc(next(self.__records))
 
         self.__cnt += 1
         if self.notifiy_every > 0 and self.__cnt % self.notifiy_every == 0:
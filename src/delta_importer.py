@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  bulk actions for the atoms that changed between two
+#               MRCONSO releases
+
+# default modules
+# no modules
+
+# installed modules
+# no modules
+
+# project modules
+from src.concept_importer import (ConceptImporterFromRRF,
+                                  ElasticSearchScoller, make_record_type,
+                                  DEFAULT_BLOCK_SIZE)
+from utils.external_sort import external_sort, DEFAULT_BUFFER_SIZE
+
+
+def sorted_atoms(mrconso_filepath, columns, buffer_size=DEFAULT_BUFFER_SIZE,
+                 tmp_dir=None, **kwargs):
+    """Records of MRCONSO with fields columns sorted by their first
+    column, using an external sort bounded by buffer_size rows"""
+    importer = ConceptImporterFromRRF(mrconso_filepath, **kwargs)
+    make_record = make_record_type(columns)._make
+    rows = (tuple(record) for record in importer.iter_records(columns))
+    for row in external_sort(rows, buffer_size=buffer_size,
+                             tmp_dir=tmp_dir):
+        yield make_record(row)
+
+
+def diff_atoms(old_records, new_records):
+    """Merge join of two streams of records sorted by their first field
+    (the key). Yields tuples (change, record) where change is 'added'
+    or 'changed' (with the new record), 'deleted' (with the old record)
+    or 'unchanged'."""
+    old_records, new_records = iter(old_records), iter(new_records)
+    old, new = next(old_records, None), next(new_records, None)
+    previous_key = None
+
+    while old is not None or new is not None:
+        if new is not None and (old is None or new[0] < old[0]):
+            change, record = 'added', new
+            new = next(new_records, None)
+        elif new is None or old[0] < new[0]:
+            change, record = 'deleted', old
+            old = next(old_records, None)
+        else:
+            change = 'unchanged' if old == new else 'changed'
+            record = new
+            old, new = next(old_records, None), next(new_records, None)
+
+        # a key that shows up twice means that a file repeats an AUI
+        if record[0] == previous_key:
+            raise ValueError('duplicate key "{}"'.format(record[0]))
+        previous_key = record[0]
+
+        yield change, record
+
+
+class DeltaScroller(ElasticSearchScoller):
+    """Bulk actions that turn an index of previous_mrconso_filepath into
+    an index of mrconso_filepath: atoms (keyed by AUI, the _id of their
+    documents) that are new or whose fields changed are indexed again,
+    those that are gone are deleted, and the others are skipped.
+
+    Both files are sorted by AUI with an external sort, so memory is
+    bounded by buffer_size rows per file; filters apply to both. Counts
+    of each kind of change are kept in changes.
+    """
+
+    def __init__(self, mrconso_filepath, previous_mrconso_filepath, index,
+                 doc_type, mrconso_schema=None, notifiy_every=0,
+                 block_size=DEFAULT_BLOCK_SIZE, cache_dir=None,
+                 buffer_size=DEFAULT_BUFFER_SIZE, tmp_dir=None,
+                 filters=None):
+        super(DeltaScroller, self).__init__(
+            mrconso_filepath, index, doc_type, mrconso_schema=mrconso_schema,
+            notifiy_every=notifiy_every, block_size=block_size,
+            cache_dir=cache_dir, filters=filters)
+        self.previous_filepath = previous_mrconso_filepath
+        self.buffer_size = buffer_size
+        self.tmp_dir = tmp_dir
+        self.changes = {'added': 0, 'changed': 0, 'deleted': 0,
+                        'unchanged': 0}
+        self.__actions = None
+
+    def make_delete(self, record):
+        return {'_op_type': 'delete', '_index': self.index,
+                '_type': self.doc_type, '_id': record.AUI}
+
+    def iter_actions(self):
+        sort_kwargs = {'buffer_size': self.buffer_size,
+                       'tmp_dir': self.tmp_dir,
+                       'mrconso_schema': self.schema,
+                       'block_size': self.block_size,
+                       'cache_dir': self.cache_dir,
+                       'filters': self.filters}
+        diff = diff_atoms(
+            sorted_atoms(self.previous_filepath, self.columns,
+                         **sort_kwargs),
+            sorted_atoms(self.filepath, self.columns, **sort_kwargs))
+
+        for cnt, (change, record) in enumerate(diff, start=1):
+            self.changes[change] += 1
+            if self.notifiy_every > 0 and cnt % self.notifiy_every == 0:
+                print '[info] {} atoms compared ({})'.format(
+                    cnt, ', '.join('{} {}'.format(v, k) for k, v
+                                   in sorted(self.changes.iteritems())))
+
+            if change in ('added', 'changed'):
+                yield self.make_doc(record)
+            elif change == 'deleted':
+                yield self.make_delete(record)
+
+    def next(self):
+        if self.__actions is None:
+            self.__actions = self.iter_actions()
+        return next(self.__actions)
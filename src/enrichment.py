@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  semantic types (MRSTY) and source ranks (MRRANK) of atoms
+
+# default modules
+from itertools import groupby
+from operator import attrgetter
+
+# installed modules
+# no modules
+
+# project modules
+from src.concept_importer import (ConceptImporterFromRRF, decode_utf8,
+                                  DEFAULT_BLOCK_SIZE)
+
+
+u = decode_utf8
+
+MRSTY_SCHEMA = [('CUI', u), ('TUI', u), ('STN', u), ('STY', u),
+                ('ATUI', u), ('CVF', int)]
+
+MRRANK_SCHEMA = [('RANK', int), ('SAB', u), ('TTY', u), ('SUPPRESS', u)]
+
+
+def load_ranks(mrrank_filepath, block_size=DEFAULT_BLOCK_SIZE):
+    """Rank of each source and term type in MRRANK (higher ranks are
+    preferred), as a dictionary keyed by (SAB, TTY)"""
+    importer = ConceptImporterFromRRF(mrrank_filepath, MRRANK_SCHEMA,
+                                      block_size=block_size)
+    return {(record.SAB, record.TTY): record.RANK
+            for record in importer.iter_records(('RANK', 'SAB', 'TTY'))}
+
+
+class SemanticTypeJoin(object):
+    """Semantic types of concepts looked up in the order of MRCONSO.
+
+    MRCONSO and MRSTY are both sorted by CUI, so the semantic types of
+    the atoms of MRCONSO are found by advancing through MRSTY as atoms
+    are read (a merge join): memory does not depend on the size of
+    either file. Lookups must come with non-decreasing CUIs; concepts
+    skipped are read and discarded, so a join can start at any point
+    of MRCONSO (e.g., for a byte range of it).
+    """
+
+    def __init__(self, mrsty_filepath, block_size=DEFAULT_BLOCK_SIZE):
+        self.filepath = mrsty_filepath
+        importer = ConceptImporterFromRRF(mrsty_filepath, MRSTY_SCHEMA,
+                                          block_size=block_size)
+        self.__groups = groupby(importer.iter_records(('CUI', 'TUI', 'STY')),
+                                attrgetter('CUI'))
+        self.__current = None
+        self.__types = ([], [])
+        self.__last_lookup = None
+
+    def __advance(self):
+        previous = self.__current
+        try:
+            cui, records = next(self.__groups)
+        except StopIteration:
+            self.__current = None
+            self.__groups = iter(())
+            return False
+
+        if previous is not None and cui <= previous:
+            raise ValueError('"{}" is not sorted by CUI: {} follows {}'
+                             ''.format(self.filepath, cui, previous))
+        records = list(records)
+        self.__current = cui
+        self.__types = ([record.TUI for record in records],
+                        [record.STY for record in records])
+        return True
+
+    def lookup(self, cui):
+        """Tuple (TUIs, STYs) of the semantic types of cui; both lists
+        are empty if cui is not in MRSTY"""
+        if self.__last_lookup is not None and cui < self.__last_lookup:
+            raise ValueError('concepts must be looked up in CUI order: '
+                             '{} follows {}'.format(cui, self.__last_lookup))
+        self.__last_lookup = cui
+
+        while self.__current is None or self.__current < cui:
+            if not self.__advance():
+                return [], []
+        if self.__current == cui:
+            return self.__types
+        return [], []
+
+
+class AtomEnricher(object):
+    """Adds the semantic types of the concept of each atom (fields TUI
+    and STY, from MRSTY) and the rank of its source and term type
+    (field RANK, from MRRANK, along with SAB and TTY) to its document.
+
+    Either file is optional. Atoms must come in CUI order if mrsty
+    is given (see SemanticTypeJoin).
+    """
+
+    def __init__(self, mrsty_filepath=None, mrrank_filepath=None,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        self.join = (SemanticTypeJoin(mrsty_filepath, block_size)
+                     if mrsty_filepath else None)
+        self.ranks = (load_ranks(mrrank_filepath, block_size)
+                      if mrrank_filepath else None)
+
+    @property
+    def columns(self):
+        """Columns of MRCONSO needed besides those of the document"""
+        return ('SAB', 'TTY') if self.ranks is not None else ()
+
+    def enrich(self, record, source):
+        """Adds the fields of record to source, the document of the atom"""
+        if self.join is not None:
+            source['TUI'], source['STY'] = self.join.lookup(record.CUI)
+        if self.ranks is not None:
+            source['SAB'] = record.SAB
+            source['TTY'] = record.TTY
+            source['RANK'] = self.ranks.get((record.SAB, record.TTY))
+        return source
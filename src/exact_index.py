@@ -0,0 +1,173 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  on-disk lookup of atoms by normalized string
+
+# default modules
+import os
+import json
+import hashlib
+
+# installed modules
+import numpy as np
+
+# project modules
+from src.analysis import normalize_string
+from src.concept_importer import ConceptImporterFromRRF
+from utils.common import mkdir_p
+
+
+# version of the files written by ExactIndex.save
+FORMAT_VERSION = 2
+
+
+def string_hash(normalized):
+    """64 bit hash of a normalized string: the first 8 bytes of its md5.
+    Hashes are only used to find strings quickly; as two strings can
+    have the same hash, the strings themselves are compared too."""
+    digest = hashlib.md5(normalized.encode('utf-8')).digest()
+    return int(digest[:8].encode('hex'), 16)
+
+
+class ExactIndex(object):
+    """Atoms grouped by their normalized STR.
+
+    Each distinct normalized string has a key, its hash; keys are in
+    increasing order, and are repeated only if distinct strings have
+    the same hash. The string of keys[i] is the UTF-8 encoded
+    strings[string_offsets[i]:string_offsets[i + 1]], and its atoms are
+    auis[offsets[i]:offsets[i + 1]] (and the same slice of cuis), in
+    the order they appear in MRCONSO. The arrays are saved as .npy
+    files and memory mapped on load, so that loading takes a few
+    milliseconds and forked workers share the same pages.
+    """
+
+    files = ('keys', 'offsets', 'auis', 'cuis', 'strings',
+             'string_offsets')
+
+    def __init__(self, keys, offsets, auis, cuis, strings,
+                 string_offsets):
+        self.keys = keys
+        self.offsets = offsets
+        self.auis = auis
+        self.cuis = cuis
+        self.strings = strings
+        self.string_offsets = string_offsets
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, records, notifiy_every=0):
+        """Builds the index from records with fields AUI, CUI and STR"""
+        # position of each distinct normalized string in strings
+        positions, strings = {}, []
+        groups, auis, cuis = [], [], []
+        for cnt, record in enumerate(records, start=1):
+            normalized = normalize_string(record.STR)
+            if not normalized:
+                # nothing but punctuation
+                continue
+            pos = positions.get(normalized)
+            if pos is None:
+                pos = positions[normalized] = len(strings)
+                strings.append(normalized)
+            groups.append(pos)
+            auis.append(record.AUI.encode('utf-8'))
+            cuis.append(record.CUI.encode('utf-8'))
+
+            if notifiy_every > 0 and cnt % notifiy_every == 0:
+                print '[info] {} strings hashed'.format(cnt)
+        del positions
+
+        # strings sorted by hash, and by string if hashes are the same
+        hashes = [string_hash(s) for s in strings]
+        sorted_pos = sorted(xrange(len(strings)),
+                            key=lambda pos: (hashes[pos], strings[pos]))
+        rank = np.empty(len(strings), dtype=np.int64)
+        rank[sorted_pos] = np.arange(len(strings))
+        keys = np.array([hashes[pos] for pos in sorted_pos],
+                        dtype=np.uint64)
+
+        encoded = [strings[pos].encode('utf-8') for pos in sorted_pos]
+        string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=string_offsets[1:])
+        strings = np.frombuffer(''.join(encoded), dtype=np.uint8)
+
+        # stable, so that atoms with the same string stay in file order
+        groups = rank[np.array(groups, dtype=np.int64)]
+        order = np.argsort(groups, kind='mergesort')
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(groups, minlength=len(keys)),
+                  out=offsets[1:])
+
+        return cls(keys, offsets, np.array(auis)[order],
+                   np.array(cuis)[order], strings, string_offsets)
+
+    @classmethod
+    def from_mrconso(cls, mrconso_filepath, notifiy_every=0, **kwargs):
+        importer = ConceptImporterFromRRF(mrconso_filepath, **kwargs)
+        return cls.build(importer.iter_records(('AUI', 'CUI', 'STR')),
+                         notifiy_every=notifiy_every)
+
+    def save(self, path):
+        mkdir_p(path)
+        for name in self.files:
+            np.save(os.path.join(path, '{}.npy'.format(name)),
+                    getattr(self, name))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'strings': len(self.keys),
+                       'atoms': len(self.auis),
+                       'version': FORMAT_VERSION}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Loads an index saved with save(); arrays are memory mapped
+        unless mmap_mode is None."""
+        with open(os.path.join(path, 'meta.json')) as f:
+            version = json.load(f).get('version', 1)
+        if version != FORMAT_VERSION:
+            raise ValueError('exact index "{}" was saved in format {}, '
+                             'not {}; build it again'.format(
+                                 path, version, FORMAT_VERSION))
+        return cls(*[np.load(os.path.join(path, '{}.npy'.format(name)),
+                             mmap_mode=mmap_mode)
+                     for name in cls.files])
+
+    def _atoms(self, pos, k=None):
+        start, end = self.offsets[pos], self.offsets[pos + 1]
+        if k is not None:
+            end = min(end, start + k)
+        return [{'AUI': aui.decode('utf-8'), 'CUI': cui.decode('utf-8')}
+                for aui, cui in zip(self.auis[start:end].tolist(),
+                                    self.cuis[start:end].tolist())]
+
+    def _find(self, pos, key, normalized):
+        """Position of the key of normalized, starting from pos, the
+        first key not smaller than its hash key; None if not found"""
+        encoded = normalized.encode('utf-8')
+        while pos < len(self.keys) and self.keys[pos] == key:
+            start, end = self.string_offsets[pos:pos + 2]
+            if self.strings[start:end].tostring() == encoded:
+                return pos
+            pos += 1
+        return None
+
+    def lookup(self, string, k=None):
+        """Atoms whose STR has the same normal form as string, at most k
+        if k is provided; an empty list if there are none."""
+        return self.lookup_many([string], k=k)[0]
+
+    def lookup_many(self, strings, k=None):
+        """Atoms of each string in strings, in order (see lookup)"""
+        normalized = [normalize_string(s) for s in strings]
+        hashes = np.array([string_hash(s) for s in normalized],
+                          dtype=np.uint64)
+        positions = np.searchsorted(self.keys, hashes)
+
+        results = []
+        for pos, key, string in zip(positions.tolist(), hashes, normalized):
+            pos = self._find(pos, key, string) if string else None
+            results.append(self._atoms(pos, k) if pos is not None else [])
+        return results
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  bulk actions for an index with one document per string
+
+# default modules
+import hashlib
+from itertools import groupby
+from operator import itemgetter
+
+# installed modules
+# no modules
+
+# project modules
+from src.analysis import normalize_string
+from src.concept_importer import (ElasticSearchScoller, make_record_type,
+                                  DEFAULT_BLOCK_SIZE)
+from utils.external_sort import external_sort, DEFAULT_BUFFER_SIZE
+
+
+# functions that give the key of the group of a record, by the name of
+# the layout; "AUI" is the layout of ElasticSearchScoller
+GROUP_KEYS = {
+    'SUI': lambda record: record.SUI,
+    'string': lambda record: normalize_string(record.STR)
+}
+
+
+def grouped_atoms(importer, columns, key, buffer_size=DEFAULT_BUFFER_SIZE,
+                  tmp_dir=None):
+    """Records of importer with fields columns grouped by key(record),
+    using an external sort bounded by buffer_size rows; the records of
+    each group are sorted by their fields.
+
+    Returns:
+        groups (generator): tuples (key, records)
+    """
+    make_record = make_record_type(columns)._make
+    rows = ((key(record), ) + tuple(record)
+            for record in importer.iter_records(columns))
+    rows = external_sort(rows, buffer_size=buffer_size, tmp_dir=tmp_dir)
+    for group_key, group in groupby(rows, itemgetter(0)):
+        yield group_key, [make_record(row[1:]) for row in group]
+
+
+class GroupedScroller(ElasticSearchScoller):
+    """Bulk actions that index one document per group of atoms sharing
+    the same SUI (group_by "SUI") or the same normalized string
+    (group_by "string", see src.analysis.normalize_string) instead of
+    one per atom.
+
+    Documents have the STR of the first atom of the group as text and
+    ngrams, and the arrays AUI and CUI of its atoms (aligned, so that
+    the i-th CUI is the concept of the i-th AUI) and SUI of its strings.
+    Their _id is the SUI, or the md5 of the normalized string. MRCONSO
+    is sorted by group with an external sort, so memory is bounded by
+    buffer_size rows and the largest group. Counts of the groups and
+    atoms served are kept in groups and atoms.
+    """
+
+    def __init__(self, mrconso_filepath, index, doc_type, group_by='SUI',
+                 mrconso_schema=None, notifiy_every=0,
+                 block_size=DEFAULT_BLOCK_SIZE, cache_dir=None,
+                 buffer_size=DEFAULT_BUFFER_SIZE, tmp_dir=None,
+                 filters=None):
+        if group_by not in GROUP_KEYS:
+            raise ValueError('unknown layout "{}"; options are: AUI, {}'
+                             ''.format(group_by, ', '.join(GROUP_KEYS)))
+        super(GroupedScroller, self).__init__(
+            mrconso_filepath, index, doc_type, mrconso_schema=mrconso_schema,
+            notifiy_every=notifiy_every, block_size=block_size,
+            cache_dir=cache_dir, filters=filters)
+        self.group_by = group_by
+        self.buffer_size = buffer_size
+        self.tmp_dir = tmp_dir
+        self.groups = self.atoms = 0
+        self.__actions = None
+
+    def make_group_doc(self, key, records):
+        """Builds the elasticsearch action for a group of records"""
+        if self.group_by == 'SUI':
+            _id = key
+        else:
+            _id = hashlib.md5(key.encode('utf-8')).hexdigest()
+
+        return {
+            '_index': self.index,
+            '_type': self.doc_type,
+            '_id': _id,
+            '_source': {
+                'text': records[0].STR,
+                'ngrams': records[0].STR,
+                'AUI': [record.AUI for record in records],
+                'CUI': [record.CUI for record in records],
+                'SUI': sorted(set(record.SUI for record in records))
+                }
+        }
+
+    def iter_actions(self):
+        groups = grouped_atoms(self, self.columns, GROUP_KEYS[self.group_by],
+                               buffer_size=self.buffer_size,
+                               tmp_dir=self.tmp_dir)
+        for key, records in groups:
+            self.groups += 1
+            self.atoms += len(records)
+            if (self.notifiy_every > 0 and
+                    self.groups % self.notifiy_every == 0):
+                print '[info] {} groups of {} atoms served'.format(
+                    self.groups, self.atoms)
+            yield self.make_group_doc(key, records)
+
+    def next(self):
+        if self.__actions is None:
+            self.__actions = self.iter_actions()
+        return next(self.__actions)
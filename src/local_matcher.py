@@ -0,0 +1,419 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  in-process replica of the umls index and its scoring script
+
+# default modules
+import os
+import math
+import json
+import codecs
+from array import array
+
+# installed modules
+import numpy as np
+
+# project modules
+from src.analysis import load_field_analyzers, default_field_analyzers
+from src.concept_importer import ConceptImporterFromRRF
+from utils.common import mkdir_p
+
+
+def resolve_alpha_beta(alpha=None, beta=None):
+    """Defaults alpha and beta like UmlsScoringScript: both are 0.5 if
+    neither is provided; if only one is, the other is its complement."""
+    if alpha is None and beta is None:
+        alpha = beta = 0.5
+    elif alpha is None:
+        alpha = 1.0 - beta
+    elif beta is None:
+        beta = 1.0 - alpha
+
+    if alpha < 0.0 or alpha > 1.0 or beta < 0.0 or beta > 1.0:
+        raise ValueError('Alpha or beta not in range [0, 1]')
+    return alpha, beta
+
+
+def idf(doc_count, df):
+    """IDF of UmlsScoringScript; counts are cast to float32 as in
+    the script before being promoted to double."""
+    return math.log((float(np.float32(doc_count)) + 2.0) /
+                    (float(np.float32(df)) + 1.0))
+
+
+class InvertedIndex(object):
+    """Postings of a field stored as integer arrays: the doc ids of term
+    t are postings[offsets[t]:offsets[t + 1]], in increasing order."""
+
+    def __init__(self, vocabulary, offsets, postings, doc_count):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.postings = postings
+        self.doc_count = doc_count
+
+    def df(self, term_id):
+        return int(self.offsets[term_id + 1] - self.offsets[term_id])
+
+    def get(self, term_id):
+        return self.postings[self.offsets[term_id]:self.offsets[term_id + 1]]
+
+    def save(self, path, name):
+        np.save(os.path.join(path, '{}.offsets.npy'.format(name)),
+                self.offsets)
+        np.save(os.path.join(path, '{}.postings.npy'.format(name)),
+                self.postings)
+
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        with codecs.open(os.path.join(path, '{}.terms'.format(name)),
+                         'w', 'utf-8') as f:
+            f.write(u'\n'.join(terms))
+
+    @classmethod
+    def load(cls, path, name, doc_count, mmap_mode='r'):
+        offsets = np.load(os.path.join(path, '{}.offsets.npy'.format(name)),
+                          mmap_mode=mmap_mode)
+        postings = np.load(os.path.join(path,
+                                        '{}.postings.npy'.format(name)),
+                           mmap_mode=mmap_mode)
+        with codecs.open(os.path.join(path, '{}.terms'.format(name)),
+                         'r', 'utf-8') as f:
+            terms = f.read()
+        vocabulary = ({t: i for i, t in enumerate(terms.split(u'\n'))}
+                      if terms else {})
+        return cls(vocabulary, offsets, postings, doc_count)
+
+
+class _InvertedIndexBuilder(object):
+    def __init__(self):
+        self.vocabulary = {}
+        self.term_ids = array('i')
+        self.doc_ids = array('i')
+        self.doc_count = 0
+
+    def add(self, doc_id, terms):
+        if not terms:
+            return
+        self.doc_count += 1
+
+        vocabulary = self.vocabulary
+        ids = set()
+        for term in terms:
+            term_id = vocabulary.get(term)
+            if term_id is None:
+                term_id = vocabulary[term] = len(vocabulary)
+            ids.add(term_id)
+        self.term_ids.extend(ids)
+        self.doc_ids.extend([doc_id] * len(ids))
+
+    def build(self):
+        term_ids = np.frombuffer(self.term_ids, dtype=np.int32)
+        doc_ids = np.frombuffer(self.doc_ids, dtype=np.int32)
+
+        # stable sort keeps doc ids in increasing order within each term
+        order = np.argsort(term_ids, kind='mergesort')
+        postings = doc_ids[order]
+        offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(self.vocabulary)),
+                  out=offsets[1:])
+
+        return InvertedIndex(self.vocabulary, offsets, postings,
+                             self.doc_count)
+
+
+def _matcher_analyzers(mapping, fields):
+    """Mapping (loaded if a path) and analyzers of its fields; the
+    default analyzers and None if mapping is None"""
+    if mapping is None:
+        analyzers = default_field_analyzers()
+    else:
+        if isinstance(mapping, basestring):
+            with open(mapping) as f:
+                mapping = json.load(f)
+        analyzers = load_field_analyzers(mapping, cache_size=0)
+
+    missing = [field for field in fields if field not in analyzers]
+    if missing:
+        raise ValueError('mapping has no analyzed field {}'.format(
+            ', '.join('"{}"'.format(field) for field in missing)))
+    return mapping, analyzers
+
+
+class LocalUmlsMatcher(object):
+    """Scores MRCONSO atoms like UmlsScoringScript without a cluster.
+
+    Character 5-grams (field "ngrams") and english terms (field "text")
+    of every STR are kept in two inverted indices. Atoms are scored with
+    one of two formulas, where IDF is log((N + 2) / (df + 1)) as
+    computed by the script:
+
+    - "plugin": the formula of UmlsScoringScript, alpha times the IDFs
+      of the query n-grams plus beta times the IDFs of the query terms,
+      over every query n-gram and term found in the index. As it only
+      reads document frequencies, every atom that contains any query
+      n-gram or term gets the same score, and atoms are ranked by their
+      position in MRCONSO, as elasticsearch ranks ties by document.
+    - "coverage": the same sums, but only over the query n-grams and
+      terms each atom contains, so that atoms sharing more of the query
+      rank higher; for atoms that contain all of them, it is the score
+      of the plugin.
+
+    Document frequencies are computed over all atoms, which matches an
+    index with a single shard. Strings are analyzed with the analyzers
+    of the fields in mapping (see src.analysis.load_field_analyzers),
+    by default those of maps/ngrams.json; the mapping is saved with the
+    matcher, so that a loaded matcher analyzes queries as its atoms.
+    """
+
+    fields = ('ngrams', 'text')
+
+    def __init__(self, auis, cuis, ngrams_index, text_index, mapping=None):
+        self.auis = auis
+        self.cuis = cuis
+        self.indices = {'ngrams': ngrams_index, 'text': text_index}
+
+        self.mapping, self.analyzers = _matcher_analyzers(mapping,
+                                                         self.fields)
+
+    def __len__(self):
+        return len(self.auis)
+
+    @classmethod
+    def build(cls, records, notifiy_every=0, mapping=None):
+        """Builds the matcher from records with fields AUI, CUI and STR,
+        analyzed with the fields of mapping (path or dict)"""
+        builders = {field: _InvertedIndexBuilder() for field in cls.fields}
+        auis, cuis = [], []
+        mapping, analyzers = _matcher_analyzers(mapping, cls.fields)
+        analyze_ngrams, analyze_text = analyzers['ngrams'], analyzers['text']
+
+        for doc_id, record in enumerate(records):
+            auis.append(record.AUI.encode('utf-8'))
+            cuis.append(record.CUI.encode('utf-8'))
+            builders['ngrams'].add(doc_id, analyze_ngrams(record.STR))
+            builders['text'].add(doc_id, analyze_text(record.STR))
+
+            if notifiy_every > 0 and (doc_id + 1) % notifiy_every == 0:
+                print '[info] {} atoms indexed'.format(doc_id + 1)
+
+        return cls(np.array(auis), np.array(cuis),
+                   builders['ngrams'].build(), builders['text'].build(),
+                   mapping=mapping)
+
+    @classmethod
+    def from_mrconso(cls, mrconso_filepath, notifiy_every=0, mapping=None,
+                     **kwargs):
+        importer = ConceptImporterFromRRF(mrconso_filepath, **kwargs)
+        return cls.build(importer.iter_records(('AUI', 'CUI', 'STR')),
+                         notifiy_every=notifiy_every, mapping=mapping)
+
+    def save(self, path):
+        mkdir_p(path)
+        np.save(os.path.join(path, 'auis.npy'), self.auis)
+        np.save(os.path.join(path, 'cuis.npy'), self.cuis)
+        for field, index in self.indices.iteritems():
+            index.save(path, field)
+        meta = {field: {'doc_count': index.doc_count}
+                for field, index in self.indices.iteritems()}
+        meta['mapping'] = self.mapping
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Loads a matcher saved with save(); arrays are memory mapped
+        unless mmap_mode is None."""
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        indices = {field: InvertedIndex.load(path, field,
+                                             meta[field]['doc_count'],
+                                             mmap_mode)
+                   for field in cls.fields}
+        return cls(np.load(os.path.join(path, 'auis.npy'),
+                           mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, 'cuis.npy'),
+                           mmap_mode=mmap_mode),
+                   indices['ngrams'], indices['text'],
+                   mapping=meta.get('mapping'))
+
+    def query_terms(self, ngrams, text, alpha=None, beta=None):
+        """Returns the query terms found in the index as a list of tuples
+        (index, term_id, weight); the weight of a term is its IDF times
+        the number of times it appears in the query times alpha (for
+        n-grams) or beta (for text terms). Terms are sorted by decreasing
+        weight, which is also the most a term adds to a score; all
+        scoring methods add up weights in this order, so that they
+        return the exact same scores."""
+        alpha, beta = resolve_alpha_beta(alpha, beta)
+
+        terms = []
+        for field, query, factor in (('ngrams', ngrams, alpha),
+                                     ('text', text, beta)):
+            index = self.indices[field]
+            counts = {}
+            for term in query:
+                counts[term] = counts.get(term, 0) + 1
+
+            for term, count in counts.iteritems():
+                term_id = index.vocabulary.get(term)
+                if term_id is None or factor == 0.0:
+                    continue
+                weight = factor * count * idf(index.doc_count,
+                                              index.df(term_id))
+                terms.append((index, term_id, weight))
+
+        terms.sort(key=lambda t: (-t[2], t[0] is self.indices['text'], t[1]))
+        return terms
+
+    def plugin_score(self, ngrams, text, alpha=None, beta=None):
+        """Score UmlsScoringScript gives to every atom matched by a query,
+        added up in the same order as the script"""
+        alpha, beta = resolve_alpha_beta(alpha, beta)
+        field_scores = []
+        for field, query in (('ngrams', ngrams), ('text', text)):
+            index = self.indices[field]
+            field_score = 0.0
+            for term in query:
+                # terms in the vocabulary are those with df > 0
+                term_id = index.vocabulary.get(term)
+                if term_id is not None:
+                    field_score += idf(index.doc_count, index.df(term_id))
+            field_scores.append(field_score)
+        return alpha * field_scores[0] + beta * field_scores[1]
+
+    def score(self, ngrams, text, alpha=None, beta=None, k=10,
+              method='exhaustive', formula='plugin'):
+        """Top k atoms for the n-grams and text terms of a query, which
+        are the parameters of UmlsScoringScript.
+
+        Args:
+            method (str, default='exhaustive'): 'exhaustive' scores every
+                atom that contains any query term; 'maxscore' skips atoms
+                that can not make it to the top k (see _score_maxscore
+                and _score_plugin). Both return the same results.
+            formula (str, default='plugin'): 'plugin' or 'coverage' (see
+                LocalUmlsMatcher)
+
+        Returns:
+            candidates (list): dictionaries with keys AUI, CUI and score,
+                sorted by decreasing score (ties by index order).
+        """
+        if method not in ('exhaustive', 'maxscore'):
+            raise ValueError('unknown scoring method "{}"'.format(method))
+        if formula == 'plugin':
+            return self._score_plugin(ngrams, text, alpha, beta, k, method)
+        elif formula != 'coverage':
+            raise ValueError('unknown scoring formula "{}"'.format(formula))
+
+        terms = self.query_terms(ngrams, text, alpha, beta)
+        if not terms or k < 1:
+            return []
+
+        if method == 'maxscore':
+            return self._top_k(*self._score_maxscore(terms, k), k=k)
+
+        postings = [index.get(term_id) for index, term_id, _ in terms]
+        doc_ids = np.concatenate(postings)
+        weights = np.repeat([weight for _, _, weight in terms],
+                            [len(p) for p in postings])
+
+        candidates, inverse = np.unique(doc_ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights)
+        return self._top_k(candidates, scores, k)
+
+    def match(self, string, k=10, alpha=None, beta=None,
+              method='exhaustive', formula='plugin'):
+        """Top k atoms for string, analyzed like the umls index would"""
+        return self.score(self.analyzers['ngrams'](string),
+                          self.analyzers['text'](string),
+                          alpha=alpha, beta=beta, k=k, method=method,
+                          formula=formula)
+
+    def _score_plugin(self, ngrams, text, alpha, beta, k, method):
+        """Top k atoms with the formula of the plugin: the first k atoms
+        that contain any query n-gram or term, whatever alpha and beta
+        (the query of utils.matcher selects them). Postings are sorted,
+        so with 'maxscore' only the first k of each term are read."""
+        score = self.plugin_score(ngrams, text, alpha, beta)
+        if k < 1:
+            return []
+
+        postings = []
+        for field, query in (('ngrams', ngrams), ('text', text)):
+            index = self.indices[field]
+            for term in set(query):
+                term_id = index.vocabulary.get(term)
+                if term_id is None:
+                    continue
+                term_postings = index.get(term_id)
+                postings.append(term_postings[:k] if method == 'maxscore'
+                                else term_postings)
+        if not postings:
+            return []
+
+        doc_ids = np.unique(np.concatenate(postings))[:k]
+        return self._top_k(doc_ids, np.full(len(doc_ids), score), k)
+
+    def _score_maxscore(self, terms, k):
+        """MaxScore pruning, term at a time.
+
+        Terms are visited by decreasing weight. An atom that contains
+        none of the terms visited so far scores at most the sum of the
+        remaining weights; once that is below the k-th best score seen
+        (a lower bound of the final threshold), no new atom can enter the
+        top k, so the postings of the remaining terms, which are the
+        longest ones, are only probed for the current candidates
+        instead of being merged. Candidates whose score plus remaining
+        weights is below the threshold are dropped as well.
+        """
+        weights = [weight for _, _, weight in terms]
+        remaining = np.cumsum(weights[::-1])[::-1].tolist() + [0.0]
+
+        # bounds are compared with some slack to be robust to rounding
+        slack = 1e-9 * remaining[0]
+
+        candidates = np.empty(0, dtype=np.int32)
+        scores = np.empty(0, dtype=np.float64)
+        threshold = -np.inf
+
+        for i, (index, term_id, weight) in enumerate(terms):
+            postings = index.get(term_id)
+
+            if remaining[i] >= threshold - slack:
+                # new atoms can still make it to the top k
+                # both lists are sorted: atoms already in candidates are
+                # updated in place, the others are inserted in order
+                pos = np.searchsorted(candidates, postings)
+                found = pos < len(candidates)
+                found[found] = candidates[pos[found]] == postings[found]
+                scores[pos[found]] += weight
+                new = ~found
+                candidates = np.insert(candidates, pos[new], postings[new])
+                scores = np.insert(scores, pos[new], weight)
+            else:
+                pos = np.searchsorted(postings, candidates)
+                found = pos < len(postings)
+                found[found] = postings[pos[found]] == candidates[found]
+                scores[found] += weight
+
+            if len(scores) >= k:
+                threshold = np.partition(scores, len(scores) - k)[-k]
+                keep = scores + remaining[i + 1] >= threshold - slack
+                if not keep.all():
+                    candidates, scores = candidates[keep], scores[keep]
+
+        return candidates, scores
+
+    def _top_k(self, doc_ids, scores, k):
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            # includes documents tied with the k-th so that ties are
+            # broken by doc id as in the full sort
+            top = np.flatnonzero(scores >= scores[top].min())
+            doc_ids, scores = doc_ids[top], scores[top]
+
+        order = np.lexsort((doc_ids, -scores))[:k]
+        return [{'AUI': self.auis[d].decode('utf-8'),
+                 'CUI': self.cuis[d].decode('utf-8'),
+                 'score': float(s)}
+                for d, s in zip(doc_ids[order], scores[order])]
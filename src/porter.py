@@ -0,0 +1,223 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  Porter stemmer, as implemented by lucene's PorterStemmer
+
+# default modules
+# no modules
+
+# installed modules
+# no modules
+
+# project modules
+# no modules
+
+
+class PorterStemmer(object):
+    """Porter stemming algorithm; this is a port of the implementation
+    used by lucene's PorterStemFilter (and therefore by the english
+    analyzer of elasticsearch), which includes the departures from the
+    original paper of Martin Porter's reference implementation."""
+
+    def stem(self, word):
+        """Returns the stem of word, which should be lowercased"""
+        self.b = list(word)
+        self.k = len(word) - 1
+        self.k0 = 0
+        self.j = 0
+
+        # words of one or two letters are not stemmed
+        if self.k > self.k0 + 1:
+            self.__step1()
+            self.__step2()
+            self.__step3()
+            self.__step4()
+            self.__step5()
+            self.__step6()
+
+        return u''.join(self.b[:self.k + 1])
+
+    def __cons(self, i):
+        ch = self.b[i]
+        if ch in u'aeiou':
+            return False
+        if ch == u'y':
+            return True if i == self.k0 else not self.__cons(i - 1)
+        return True
+
+    def __m(self):
+        """Number of consonant sequences between k0 and j"""
+        n, i, j = 0, self.k0, self.j
+        while True:
+            if i > j:
+                return n
+            if not self.__cons(i):
+                break
+            i += 1
+        i += 1
+        while True:
+            while True:
+                if i > j:
+                    return n
+                if self.__cons(i):
+                    break
+                i += 1
+            i += 1
+            n += 1
+            while True:
+                if i > j:
+                    return n
+                if not self.__cons(i):
+                    break
+                i += 1
+            i += 1
+
+    def __vowelinstem(self):
+        return any(not self.__cons(i) for i in xrange(self.k0, self.j + 1))
+
+    def __doublec(self, j):
+        if j < self.k0 + 1:
+            return False
+        if self.b[j] != self.b[j - 1]:
+            return False
+        return self.__cons(j)
+
+    def __cvc(self, i):
+        if (i < self.k0 + 2 or not self.__cons(i) or self.__cons(i - 1) or
+                not self.__cons(i - 2)):
+            return False
+        return self.b[i] not in u'wxy'
+
+    def __ends(self, s):
+        length = len(s)
+        o = self.k - length + 1
+        if o < self.k0:
+            return False
+        if u''.join(self.b[o:self.k + 1]) != s:
+            return False
+        self.j = self.k - length
+        return True
+
+    def __setto(self, s):
+        self.b[self.j + 1:] = list(s)
+        self.k = self.j + len(s)
+
+    def __r(self, s):
+        if self.__m() > 0:
+            self.__setto(s)
+
+    def __step1(self):
+        """Removes plurals and -ed or -ing"""
+        if self.b[self.k] == u's':
+            if self.__ends(u'sses'):
+                self.k -= 2
+            elif self.__ends(u'ies'):
+                self.__setto(u'i')
+            elif self.b[self.k - 1] != u's':
+                self.k -= 1
+
+        if self.__ends(u'eed'):
+            if self.__m() > 0:
+                self.k -= 1
+        elif ((self.__ends(u'ed') or self.__ends(u'ing')) and
+                self.__vowelinstem()):
+            self.k = self.j
+            if self.__ends(u'at'):
+                self.__setto(u'ate')
+            elif self.__ends(u'bl'):
+                self.__setto(u'ble')
+            elif self.__ends(u'iz'):
+                self.__setto(u'ize')
+            elif self.__doublec(self.k):
+                ch = self.b[self.k]
+                self.k -= 1
+                if ch in u'lsz':
+                    self.k += 1
+            elif self.__m() == 1 and self.__cvc(self.k):
+                self.__setto(u'e')
+
+    def __step2(self):
+        """Turns terminal y to i when there is another vowel in the stem"""
+        if self.__ends(u'y') and self.__vowelinstem():
+            self.b[self.k] = u'i'
+
+    __step3_suffixes = {
+        u'a': ((u'ational', u'ate'), (u'tional', u'tion')),
+        u'c': ((u'enci', u'ence'), (u'anci', u'ance')),
+        u'e': ((u'izer', u'ize'), ),
+        u'l': ((u'bli', u'ble'), (u'alli', u'al'), (u'entli', u'ent'),
+               (u'eli', u'e'), (u'ousli', u'ous')),
+        u'o': ((u'ization', u'ize'), (u'ation', u'ate'), (u'ator', u'ate')),
+        u's': ((u'alism', u'al'), (u'iveness', u'ive'), (u'fulness', u'ful'),
+               (u'ousness', u'ous')),
+        u't': ((u'aliti', u'al'), (u'iviti', u'ive'), (u'biliti', u'ble')),
+        u'g': ((u'logi', u'log'), ),
+    }
+
+    def __step3(self):
+        """Maps double suffixes to single ones"""
+        if self.k == self.k0:
+            return
+        for suffix, replacement in self.__step3_suffixes.get(
+                self.b[self.k - 1], ()):
+            if self.__ends(suffix):
+                self.__r(replacement)
+                break
+
+    __step4_suffixes = {
+        u'e': ((u'icate', u'ic'), (u'ative', u''), (u'alize', u'al')),
+        u'i': ((u'iciti', u'ic'), ),
+        u'l': ((u'ical', u'ic'), (u'ful', u'')),
+        u's': ((u'ness', u''), ),
+    }
+
+    def __step4(self):
+        """Deals with -ic-, -full, -ness etc."""
+        for suffix, replacement in self.__step4_suffixes.get(
+                self.b[self.k], ()):
+            if self.__ends(suffix):
+                self.__r(replacement)
+                break
+
+    __step5_suffixes = {
+        u'a': (u'al', ),
+        u'c': (u'ance', u'ence'),
+        u'e': (u'er', ),
+        u'i': (u'ic', ),
+        u'l': (u'able', u'ible'),
+        u'n': (u'ant', u'ement', u'ment', u'ent'),
+        u'o': (u'ion', u'ou'),
+        u's': (u'ism', ),
+        u't': (u'ate', u'iti'),
+        u'u': (u'ous', ),
+        u'v': (u'ive', ),
+        u'z': (u'ize', ),
+    }
+
+    def __step5(self):
+        """Takes off -ant, -ence etc., in context <c>vcvc<v>"""
+        if self.k == self.k0:
+            return
+        for suffix in self.__step5_suffixes.get(self.b[self.k - 1], ()):
+            if self.__ends(suffix):
+                if (suffix == u'ion' and not
+                        (self.j >= 0 and self.b[self.j] in u'st')):
+                    continue
+                break
+        else:
+            return
+
+        if self.__m() > 1:
+            self.k = self.j
+
+    def __step6(self):
+        """Removes a final -e and changes -ll to -l if m() > 1"""
+        self.j = self.k
+        if self.b[self.k] == u'e':
+            a = self.__m()
+            if a > 1 or a == 1 and not self.__cvc(self.k - 1):
+                self.k -= 1
+        if (self.b[self.k] == u'l' and self.__doublec(self.k) and
+                self.__m() > 1):
+            self.k -= 1
@@ -0,0 +1,365 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  columnar binary cache of parsed RRF files
+
+# default modules
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from itertools import compress
+
+# installed modules
+import numpy as np
+
+# project modules
+from src.concept_importer import (decode_utf8, parse_ts, parse_flag,
+                                  make_record_type, ConceptImporterFromRRF,
+                                  DEFAULT_BLOCK_SIZE)
+from utils.common import mkdir_p
+from utils.compressed_input import input_parts, input_stat
+
+
+# how the values of a column are stored, by function in the schema
+TEXT, FLAG, INT, RAW = 'text', 'flag', 'int', 'raw'
+COLUMN_KINDS = {decode_utf8: TEXT, parse_ts: FLAG, parse_flag: FLAG,
+                int: INT}
+
+# rows decoded at the time when reading from the cache
+DEFAULT_BATCH_SIZE = 100000
+
+_FLAG_VALUES = {-1: None, 0: False, 1: True}
+
+CACHE_VERSION = 1
+
+
+def file_checksum(filepath, block_size=DEFAULT_BLOCK_SIZE):
+    """md5 of the content of filepath, as stored on disk (compressed or
+    split in parts, see utils.compressed_input.input_parts)"""
+    digest = hashlib.md5()
+    for part in input_parts(filepath):
+        with open(part, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), ''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _update_code_digest(digest, code):
+    """Adds the bytecode, names and constants of code to digest; the
+    line numbers of the code are left out"""
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names))
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            # functions defined in code
+            _update_code_digest(digest, const)
+        else:
+            digest.update(repr(const))
+
+
+def function_signature(func, _seen=()):
+    """Module and name of func and, for functions written in python, a
+    digest of their code, default arguments and closure, so that two
+    lambdas (or a function that has been changed) differ. Defaults or
+    closures whose repr changes at every run give a new signature every
+    time."""
+    name = '{}.{}'.format(getattr(func, '__module__', None),
+                          getattr(func, '__name__', repr(func)))
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return name
+
+    digest = hashlib.md5()
+    _update_code_digest(digest, code)
+    digest.update(repr(func.__defaults__))
+    for cell in func.__closure__ or ():
+        value = cell.cell_contents
+        if not callable(value):
+            digest.update(repr(value))
+        elif value is func or value in _seen:
+            # recursive functions refer to themselves
+            digest.update(name)
+        else:
+            digest.update(function_signature(value, _seen + (func, )))
+    return '{}:{}'.format(name, digest.hexdigest())
+
+
+def schema_signature(schema):
+    """Names of the columns and signatures of the functions of a schema
+    (see function_signature)"""
+    return [[name, function_signature(func)] for name, func in schema]
+
+
+class RRFCache(object):
+    """Columns of a parsed RRF file stored as memory mapped arrays.
+
+    Text columns are stored as the utf-8 encoded values of all rows,
+    each followed by a newline (which can not appear in RRF fields), in
+    <column>.bytes, with the offset of each row in <column>.offsets.npy;
+    so the values of many rows are decoded at once. Flags are stored as
+    int8 and integers as int64, with -1 for missing values. Columns
+    parsed with any other function are stored as text and the function
+    is applied when reading. line_offsets.npy holds the byte offset of
+    each row in the RRF file, so that byte ranges of the file (see
+    split_byte_ranges) can be read from the cache.
+
+    A cache lives in a directory of cache_dir named after the checksum
+    of the RRF file and the schema (see open_or_build).
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.rows = self.meta['rows']
+        self.kinds = dict(self.meta['kinds'])
+        self.mmap_mode = mmap_mode
+        self.line_offsets = self.__load('line_offsets.npy')
+        self.__columns = {}
+
+    def __len__(self):
+        return self.rows
+
+    def __load(self, name):
+        return np.load(os.path.join(self.path, name),
+                       mmap_mode=self.mmap_mode).view(np.ndarray)
+
+    def column(self, name):
+        """Arrays of column name: (offsets, bytes) for text columns,
+        values for the others"""
+        if name not in self.__columns:
+            if self.kinds[name] in (TEXT, RAW):
+                data = os.path.join(self.path, '{}.bytes'.format(name))
+                values = (np.memmap(data, dtype=np.uint8, mode='r')
+                          if os.path.getsize(data) else
+                          np.empty(0, dtype=np.uint8)).view(np.ndarray)
+                self.__columns[name] = (
+                    self.__load('{}.offsets.npy'.format(name)), values)
+            else:
+                self.__columns[name] = self.__load('{}.npy'.format(name))
+        return self.__columns[name]
+
+    def row_range(self, start=0, end=None):
+        """Rows whose line starts in the byte range [start, end)"""
+        first = int(np.searchsorted(self.line_offsets[:-1], start))
+        if end is None:
+            return first, self.rows
+        return first, int(np.searchsorted(self.line_offsets[:-1], end))
+
+    def _values(self, name, func, first, last):
+        kind = self.kinds[name]
+        if kind in (TEXT, RAW):
+            offsets, data = self.column(name)
+            if first == last:
+                return []
+            # strips the newline after the last value
+            block = data[offsets[first]:offsets[last] - 1].tobytes()
+            values = [v or None
+                      for v in block.decode('utf-8').split(u'\n')]
+            if kind == RAW:
+                values = [func(v.encode('utf-8')) if v is not None
+                          else None for v in values]
+            return values
+
+        values = self.column(name)[first:last].tolist()
+        if kind == FLAG:
+            return [_FLAG_VALUES[v] for v in values]
+        return [v if v >= 0 else None for v in values]
+
+    def iter_batches(self, schema, columns=None, start=0, end=None,
+                     batch_size=DEFAULT_BATCH_SIZE, with_offsets=False,
+                     row_filter=None):
+        """Yields lists of records like ConceptImporterFromRRF.iter_batches
+        for the rows in the byte range [start, end) of the RRF file;
+        with_offsets also works the same way. If row_filter is provided,
+        only the rows it keeps are returned (see RowFilter.mask)."""
+        funcs = dict(schema)
+        if columns is None:
+            columns = [name for name, _ in schema]
+        make_record = make_record_type(columns)._make
+
+        first, last = self.row_range(start, end)
+        for pos in xrange(first, last, batch_size):
+            stop = min(pos + batch_size, last)
+            values = [self._values(col, funcs[col], pos, stop)
+                      for col in columns]
+            batch = map(make_record, zip(*values))
+            if with_offsets:
+                ends = self.line_offsets[pos + 1:stop + 1].tolist()
+
+            if row_filter is not None:
+                keep = row_filter.mask(
+                    [self._values(col, funcs[col], pos, stop)
+                     for col in row_filter.columns])
+                batch = list(compress(batch, keep))
+                if with_offsets:
+                    ends = list(compress(ends, keep))
+
+            if with_offsets:
+                yield batch, ends
+            else:
+                yield batch
+
+    @classmethod
+    def build(cls, importer, path):
+        """Parses the file of importer and writes its cache in path,
+        which must not exist; the cache is written in a temporary
+        directory first, then moved to path."""
+        kinds = [(name, COLUMN_KINDS.get(func, RAW))
+                 for name, func in importer.schema]
+        mkdir_p(os.path.dirname(os.path.abspath(path)))
+        tmp_path = tempfile.mkdtemp(
+            prefix='.{}.'.format(os.path.basename(path)),
+            dir=os.path.dirname(os.path.abspath(path)))
+
+        try:
+            rows = cls.__write_columns(importer, kinds, tmp_path)
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'rows': rows,
+                           'kinds': kinds,
+                           'schema': schema_signature(importer.schema),
+                           'source': os.path.abspath(importer.filepath)},
+                          f, indent=2)
+            # mkdtemp makes directories only readable by their owner
+            os.chmod(tmp_path, 0755)
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process built the same cache in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(os.path.join(path, 'meta.json')):
+                raise
+        except:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        return cls(path)
+
+    @staticmethod
+    def __write_columns(importer, kinds, path):
+        n_columns = len(kinds)
+        text_files = {}
+        offsets = {name: [np.zeros(1, dtype=np.int64)]
+                   for name, kind in kinds if kind in (TEXT, RAW)}
+        arrays = {name: [] for name, kind in kinds
+                  if kind not in (TEXT, RAW)}
+        line_offsets = [np.array([importer.start], dtype=np.int64)]
+        position, rows = importer.start, 0
+
+        try:
+            for name in offsets:
+                text_files[name] = open(
+                    os.path.join(path, '{}.bytes'.format(name)), 'wb')
+
+            for lines in importer.iter_lines():
+                # byte offset of the end of each line, newline included
+                ends = position + np.cumsum([len(ln) + 1 for ln in lines],
+                                            dtype=np.int64)
+                position = int(ends[-1])
+
+                kept, columns = [], [[] for _ in kinds]
+                decoded = '\n'.join(lines).decode('utf-8').split(u'\n')
+                for i, ln in enumerate(decoded):
+                    if not ln:
+                        continue
+                    fields = ln.split(u'|', n_columns)
+                    if len(fields) < n_columns:
+                        print '[error] could not parse "{}"'.format(
+                            ln.encode('utf-8'))
+                        continue
+                    kept.append(i)
+                    for values, field in zip(columns, fields):
+                        values.append(field)
+
+                if not kept:
+                    continue
+                rows += len(kept)
+                # rows are attributed the bytes after the previous row,
+                # including those of lines that were skipped
+                line_offsets.append(ends[kept])
+
+                for (name, kind), values in zip(kinds, columns):
+                    if kind in (TEXT, RAW):
+                        encoded = [v.encode('utf-8') for v in values]
+                        text_files[name].write('\n'.join(encoded) + '\n')
+                        offsets[name].append(
+                            offsets[name][-1][-1] +
+                            np.cumsum([len(v) + 1 for v in encoded],
+                                      dtype=np.int64))
+                    elif kind == FLAG:
+                        func = dict(importer.schema)[name]
+                        arrays[name].append(np.array(
+                            [func(v) if v else -1 for v in values],
+                            dtype=np.int8))
+                    else:
+                        arrays[name].append(np.array(
+                            [int(v) if v else -1 for v in values],
+                            dtype=np.int64))
+        finally:
+            for f in text_files.itervalues():
+                f.close()
+
+        for name, chunks in offsets.iteritems():
+            np.save(os.path.join(path, '{}.offsets.npy'.format(name)),
+                    np.concatenate(chunks))
+        for name, chunks in arrays.iteritems():
+            dtype = np.int8 if dict(kinds)[name] == FLAG else np.int64
+            np.save(os.path.join(path, '{}.npy'.format(name)),
+                    np.concatenate(chunks) if chunks
+                    else np.empty(0, dtype=dtype))
+        np.save(os.path.join(path, 'line_offsets.npy'),
+                np.concatenate(line_offsets))
+        return rows
+
+    @classmethod
+    def open_or_build(cls, importer, cache_dir):
+        """Cache of the file of importer in cache_dir, built if missing.
+
+        The cache is keyed by the checksum of the file and the schema of
+        importer; checksums are remembered in cache_dir/checksums.json
+        by path, size and modification time, so that the file is only
+        read once to compute them.
+        """
+        checksum = cached_file_checksum(importer.filepath, cache_dir)
+        key = hashlib.md5(json.dumps(
+            [CACHE_VERSION, checksum,
+             schema_signature(importer.schema)])).hexdigest()
+        path = os.path.join(cache_dir, key)
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            return cls(path)
+
+        print '[info] caching "{}" in "{}"'.format(importer.filepath, path)
+        # the whole file is cached, whatever range importer reads
+        full = ConceptImporterFromRRF(importer.filepath, importer.schema,
+                                      block_size=importer.block_size)
+        return cls.build(full, path)
+
+
+def cached_file_checksum(filepath, cache_dir):
+    """Checksum of filepath, memoized in cache_dir/checksums.json"""
+    entry_key = os.path.abspath(filepath)
+    entry = list(input_stat(filepath))
+
+    memo_path = os.path.join(cache_dir, 'checksums.json')
+    try:
+        with open(memo_path) as f:
+            memo = json.load(f)
+    except (IOError, ValueError):
+        memo = {}
+
+    if entry_key in memo and memo[entry_key][:2] == entry:
+        return memo[entry_key][2]
+
+    checksum = file_checksum(filepath)
+    memo[entry_key] = entry + [checksum]
+
+    # written to a temporary file and renamed, so that readers never
+    # see a partial file
+    mkdir_p(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.checksums.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(memo, f, indent=2)
+    os.rename(tmp_path, memo_path)
+    return checksum
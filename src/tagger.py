@@ -0,0 +1,352 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  dictionary tagger of umls strings in free text
+
+# default modules
+import os
+import json
+import codecs
+from multiprocessing import Pool
+
+# installed modules
+import numpy as np
+
+# project modules
+from src.analysis import standard_tokenize_spans
+from src.concept_importer import ConceptImporterFromRRF
+from utils.common import mkdir_p, error_wrapper_pool
+
+
+def tokenize_for_tagging(text):
+    """Lowercased standard tokens of text with their character offsets"""
+    return [(tok.lower(), start, end)
+            for tok, start, end in standard_tokenize_spans(text)]
+
+
+class DictionaryTagger(object):
+    """Token-level Aho-Corasick automaton over the strings of MRCONSO.
+
+    States are numbered from 0 (the root). The edges of the trie are
+    stored in edge_keys, sorted, as state * len(vocabulary) + token id,
+    with the target state of each edge in edge_targets, so that moving
+    along an edge is a binary search. For each state, fail is the
+    longest proper suffix of its path that is also a path of the trie,
+    output is the id of the string it spells (-1 if none), and
+    output_link is the nearest state on the fail chain with an output.
+    The concepts of string i are cuis[cui_offsets[i]:cui_offsets[i + 1]].
+
+    Documents are tagged in batches that move through the automaton in
+    lockstep, one token at the time, so that every step is a handful of
+    numpy operations for the whole batch.
+    """
+
+    arrays = ('edge_keys', 'edge_targets', 'fail', 'output', 'output_link',
+              'depth', 'cui_offsets', 'cuis')
+
+    def __init__(self, vocabulary, edge_keys, edge_targets, fail, output,
+                 output_link, depth, cui_offsets, cuis):
+        self.vocabulary = vocabulary
+        self.edge_keys = edge_keys
+        self.edge_targets = edge_targets
+        self.fail = fail
+        self.output = output
+        self.output_link = output_link
+        self.depth = depth
+        self.cui_offsets = cui_offsets
+        self.cuis = cuis
+
+    def __len__(self):
+        """Number of strings in the dictionary"""
+        return len(self.cui_offsets) - 1
+
+    @classmethod
+    def build(cls, records, min_length=3, notifiy_every=0):
+        """Builds the automaton from records with fields CUI and STR.
+
+        Args:
+            records (iterable): records with fields CUI and STR
+            min_length (int, default=3): strings with fewer characters
+                (spaces between tokens excluded) are skipped
+            notifiy_every (int, default=0): print progress every
+                notifiy_every records if > 0
+        """
+        vocabulary = {}
+        strings = {}
+        for cnt, record in enumerate(records, start=1):
+            tokens = [tok for tok, _, _ in tokenize_for_tagging(record.STR)]
+            if sum(len(tok) for tok in tokens) >= min_length:
+                tokens = tuple(vocabulary.setdefault(tok, len(vocabulary))
+                               for tok in tokens)
+                strings.setdefault(tokens, set()).add(
+                    record.CUI.encode('utf-8'))
+
+            if notifiy_every > 0 and cnt % notifiy_every == 0:
+                print '[info] {} strings read'.format(cnt)
+
+        return cls.from_strings(vocabulary, strings)
+
+    @classmethod
+    def from_mrconso(cls, mrconso_filepath, min_length=3, notifiy_every=0,
+                     **kwargs):
+        importer = ConceptImporterFromRRF(mrconso_filepath, **kwargs)
+        return cls.build(importer.iter_records(('CUI', 'STR')),
+                         min_length=min_length, notifiy_every=notifiy_every)
+
+    @classmethod
+    def from_strings(cls, vocabulary, strings):
+        """Builds the automaton from strings, a dictionary that maps
+        tuples of token ids (from vocabulary) to sets of CUIs."""
+        n_labels = max(len(vocabulary), 1)
+
+        # states are created walking the strings in lexicographic order,
+        # reusing the prefix shared with the previous string
+        parents, labels, depth = [-1], [-1], [0]
+        output = [-1]
+        cui_offsets, cuis = [0], []
+        path = [0]
+        previous = ()
+        for tokens in sorted(strings):
+            shared = 0
+            for a, b in zip(previous, tokens):
+                if a != b:
+                    break
+                shared += 1
+            del path[shared + 1:]
+            for pos in xrange(shared, len(tokens)):
+                parents.append(path[-1])
+                labels.append(tokens[pos])
+                depth.append(pos + 1)
+                output.append(-1)
+                path.append(len(parents) - 1)
+            output[path[-1]] = len(cui_offsets) - 1
+            cuis.extend(sorted(strings[tokens]))
+            cui_offsets.append(len(cuis))
+            previous = tokens
+
+        parents = np.array(parents, dtype=np.int64)
+        labels = np.array(labels, dtype=np.int64)
+        depth = np.array(depth, dtype=np.int32)
+        output = np.array(output, dtype=np.int32)
+
+        edge_keys = parents[1:] * n_labels + labels[1:]
+        order = np.argsort(edge_keys, kind='mergesort')
+        tagger = cls(
+            vocabulary, edge_keys[order],
+            np.arange(1, len(parents), dtype=np.int32)[order],
+            np.zeros(len(parents), dtype=np.int32), output,
+            np.full(len(parents), -1, dtype=np.int32), depth,
+            np.array(cui_offsets, dtype=np.int64),
+            np.array(cuis, dtype='S'))
+
+        # fail and output links of each state only depend on those of
+        # shallower states, so they are computed one depth at the time
+        by_depth = np.argsort(depth, kind='mergesort')
+        bounds = np.searchsorted(depth[by_depth],
+                                 np.arange(depth.max() + 2))
+        for d in xrange(2, depth.max() + 1):
+            states = by_depth[bounds[d]:bounds[d + 1]]
+            tagger.fail[states] = tagger._transition(
+                tagger.fail[parents[states]], labels[states])
+        for d in xrange(2, depth.max() + 1):
+            states = by_depth[bounds[d]:bounds[d + 1]]
+            fail = tagger.fail[states]
+            tagger.output_link[states] = np.where(
+                tagger.output[fail] >= 0, fail, tagger.output_link[fail])
+
+        return tagger
+
+    def save(self, path):
+        mkdir_p(path)
+        for name in self.arrays:
+            np.save(os.path.join(path, '{}.npy'.format(name)),
+                    getattr(self, name))
+
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        with codecs.open(os.path.join(path, 'vocabulary.terms'), 'w',
+                         encoding='utf-8') as f:
+            f.write(u'\n'.join(terms))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'strings': len(self), 'states': len(self.fail),
+                       'terms': len(terms)}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Loads a tagger saved with save(); arrays are memory mapped
+        unless mmap_mode is None, the vocabulary is read in memory."""
+        with codecs.open(os.path.join(path, 'vocabulary.terms'),
+                         encoding='utf-8') as f:
+            terms = f.read()
+        vocabulary = ({term: i for i, term in enumerate(terms.split(u'\n'))}
+                      if terms else {})
+        # plain array views of the memory maps skip the overhead of the
+        # memmap subclass on every indexing operation
+        return cls(vocabulary,
+                   *[np.load(os.path.join(path, '{}.npy'.format(name)),
+                             mmap_mode=mmap_mode).view(np.ndarray)
+                     for name in cls.arrays])
+
+    def _goto(self, states, labels):
+        """Targets of the edges labeled labels leaving states; -1 where
+        there is no such edge"""
+        if not len(self.edge_keys):
+            return np.full(len(states), -1, dtype=np.int32)
+        keys = (states.astype(np.int64) * max(len(self.vocabulary), 1) +
+                labels)
+        pos = np.searchsorted(self.edge_keys, keys)
+        pos[pos == len(self.edge_keys)] = 0
+        found = self.edge_keys[pos] == keys
+        return np.where(found, self.edge_targets[pos], -1)
+
+    def _transition(self, states, labels):
+        """Aho-Corasick transition of each state on each label: edges are
+        followed if present, fail links otherwise."""
+        states = np.array(states, dtype=np.int32)
+        result = np.zeros(len(states), dtype=np.int32)
+        pending = np.arange(len(states))
+        while len(pending):
+            targets = self._goto(states[pending], labels[pending])
+            found = targets >= 0
+            result[pending[found]] = targets[found]
+            # states that are not at the root fall back to their fail
+            pending = pending[~found & (states[pending] != 0)]
+            states[pending] = self.fail[states[pending]]
+        return result
+
+    def _scan(self, token_ids):
+        """Runs the automaton over token ids, a 2d array with one padded
+        row per document (-1 for unknown tokens, -2 for padding).
+
+        Returns:
+            matches (list): one list per document of tuples
+                (first token, last token, string id)
+        """
+        n_docs, length = token_ids.shape
+        states = np.zeros(n_docs, dtype=np.int32)
+        matches = [[] for _ in xrange(n_docs)]
+
+        for i in xrange(length):
+            labels = token_ids[:, i]
+            known = np.flatnonzero(labels >= 0)
+            new_states = np.zeros(n_docs, dtype=np.int32)
+            new_states[known] = self._transition(states[known],
+                                                 labels[known])
+            states = new_states
+
+            docs = known
+            current = states[known]
+            while len(docs):
+                strings = self.output[current]
+                hit = strings >= 0
+                starts = i + 1 - self.depth[current[hit]]
+                for doc, start, string in zip(docs[hit].tolist(),
+                                              starts.tolist(),
+                                              strings[hit].tolist()):
+                    matches[doc].append((start, i, string))
+                current = self.output_link[current]
+                docs, current = docs[current >= 0], current[current >= 0]
+
+        return matches
+
+    @staticmethod
+    def _longest_non_overlapping(matches):
+        """Leftmost-longest selection of matches that do not overlap"""
+        selected, last = [], -1
+        for start, end, string in sorted(matches,
+                                         key=lambda m: (m[0], -m[1])):
+            if start > last:
+                selected.append((start, end, string))
+                last = end
+        return selected
+
+    def tag_many(self, documents):
+        """Concept mentions in each document.
+
+        Args:
+            documents (list): texts to tag
+
+        Returns:
+            mentions (list): for each document, a list of dictionaries
+                with keys start and end (character offsets), text and
+                CUIs; mentions are the longest dictionary strings that
+                do not overlap, preferring those starting first.
+        """
+        tokenized = [tokenize_for_tagging(doc) for doc in documents]
+        length = max([len(toks) for toks in tokenized] + [0])
+        token_ids = np.full((len(documents), length), -2, dtype=np.int64)
+        for row, toks in zip(token_ids, tokenized):
+            row[:len(toks)] = [self.vocabulary.get(tok, -1)
+                               for tok, _, _ in toks]
+
+        results, string_cuis = [], {}
+        for doc, toks, matches in zip(documents, tokenized,
+                                      self._scan(token_ids)):
+            if isinstance(doc, str):
+                doc = doc.decode('utf-8')
+            mentions = []
+            for first, last, string in self._longest_non_overlapping(
+                    matches):
+                if string not in string_cuis:
+                    cuis = self.cuis[self.cui_offsets[string]:
+                                     self.cui_offsets[string + 1]]
+                    string_cuis[string] = [c.decode('utf-8')
+                                           for c in cuis.tolist()]
+                start, end = toks[first][1], toks[last][2]
+                mentions.append({'start': start, 'end': end,
+                                 'text': doc[start:end],
+                                 'CUIs': list(string_cuis[string])})
+            results.append(mentions)
+        return results
+
+    def tag(self, document):
+        return self.tag_many([document])[0]
+
+
+# tagger of each worker of the pool, loaded by _init_worker
+_worker_tagger = None
+
+
+def _init_worker(tagger_path):
+    global _worker_tagger
+    _worker_tagger = DictionaryTagger.load(tagger_path)
+
+
+@error_wrapper_pool
+def _tag_batch(documents):
+    return _worker_tagger.tag_many(documents)
+
+
+def tag_documents(tagger_path, documents, workers=1, batch_size=256):
+    """Tags documents with the tagger saved in tagger_path.
+
+    Documents are tagged in batches of batch_size; if workers > 1, the
+    batches are spread across a pool of processes, each memory mapping
+    the same tagger.
+
+    Returns:
+        mentions (generator): mentions of each document (see
+            DictionaryTagger.tag_many), in order
+    """
+    documents = iter(documents)
+    batches = iter(lambda: [doc for _, doc in
+                            zip(xrange(batch_size), documents)], [])
+
+    if workers > 1:
+        pool = Pool(workers, initializer=_init_worker,
+                    initargs=(tagger_path, ))
+        try:
+            for mentions in pool.imap(_tag_batch, batches):
+                for doc_mentions in mentions:
+                    yield doc_mentions
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        tagger = DictionaryTagger.load(tagger_path)
+        for batch in batches:
+            for doc_mentions in tagger.tag_many(batch):
+                yield doc_mentions
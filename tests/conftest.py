@@ -0,0 +1,22 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  fixtures shared by the tests
+
+# default modules
+# no modules
+
+# installed modules
+import pytest
+
+# project modules
+from utils.synthetic_mrconso import generate_mrconso
+
+
+@pytest.fixture(scope='session')
+def mrconso_path(tmpdir_factory):
+    """Synthetic MRCONSO of 3,000 rows, some with non-ASCII strings"""
+    path = str(tmpdir_factory.mktemp('umls').join('MRCONSO.RRF'))
+    generate_mrconso(path, rows=3000, seed=7)
+    return path
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  client-side analyzers built from the mapping of the index
+
+# default modules
+import json
+import codecs
+from copy import deepcopy
+from collections import namedtuple
+
+# installed modules
+import pytest
+
+# project modules
+from scripts.check_analyzers import check
+from src.analysis import (DEFAULT_MAPPING, analyze_ngrams, analyze_english,
+                          load_analyzers, load_field_analyzers)
+from src.local_matcher import LocalUmlsMatcher
+
+
+CASES = 'maps/ngrams_analyzer_cases.json'
+
+Record = namedtuple('Record', ('AUI', 'CUI', 'STR'))
+
+
+@pytest.fixture(scope='module')
+def mapping():
+    with open(DEFAULT_MAPPING) as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope='module')
+def cases():
+    with codecs.open(CASES, encoding='utf-8') as f:
+        return json.load(f)['cases']
+
+
+def test_cases(mapping, cases):
+    # regression cases: their tokens were written by hand (see the
+    # source of the corpus), not returned by elasticsearch
+    mismatches = check(load_analyzers(mapping, cache_size=0), cases)
+    assert [(case['analyzer'], case['text'], tokens)
+            for case, tokens in mismatches] == []
+
+
+def test_default_analyzers_follow_mapping(mapping, cases):
+    fields = load_field_analyzers(mapping)
+    for case in cases:
+        assert analyze_ngrams(case['text']) == fields['ngrams'](case['text'])
+        assert analyze_english(case['text']) == fields['text'](case['text'])
+    assert analyze_ngrams(u'Infarction')[:2] == [u'infar', u'nfarc']
+    assert analyze_english(u"The patient's kidneys") == [u'patient',
+                                                          u'kidnei']
+
+
+def test_analyzer_cache(mapping):
+    analyzer = load_field_analyzers(mapping, cache_size=2)['ngrams']
+    texts = [u'heart attack', u'heart attack', u'renal failure']
+    tokens = analyzer.analyze_many(texts)
+    assert tokens == [analyzer.analyze(text) for text in texts]
+    assert (analyzer.hits, analyzer.misses) == (0, 2)
+    assert analyzer(u'heart attack') == tokens[0]
+    assert analyzer.hits == 1
+
+    # returned tokens are copies of the cached ones
+    analyzer(u'heart attack').append(u'altered')
+    assert analyzer(u'heart attack') == tokens[0]
+
+
+def trigram_mapping(mapping):
+    mapping = deepcopy(mapping)
+    ngram_filter = mapping['settings']['analysis']['filter']['ngram_filter']
+    ngram_filter['min_gram'] = ngram_filter['max_gram'] = 3
+    return mapping
+
+
+def test_local_matcher_uses_mapping(tmpdir, mapping):
+    records = [Record(u'A{}'.format(i), u'C{}'.format(i), string)
+               for i, string in enumerate([u'Heart attack', u'Heart failure',
+                                           u'Renal failure'])]
+    default = LocalUmlsMatcher.build(records)
+    assert set(map(len, default.indices['ngrams'].vocabulary)) == {5}
+
+    trigrams = LocalUmlsMatcher.build(records,
+                                      mapping=trigram_mapping(mapping))
+    assert set(map(len, trigrams.indices['ngrams'].vocabulary)) == {3}
+    # "hea" and "ear" are 3-grams of "heat" and of the first two atoms
+    assert ([atom['AUI'] for atom
+             in trigrams.match(u'heat', formula='coverage')] == [u'A0', u'A1'])
+    assert default.match(u'heat') == []
+
+    # saved matchers analyze queries with the mapping they were built with
+    path = str(tmpdir.join('matcher'))
+    trigrams.save(path)
+    loaded = LocalUmlsMatcher.load(path)
+    assert loaded.mapping == trigrams.mapping
+    assert (loaded.match(u'heat', formula='coverage') ==
+            trigrams.match(u'heat', formula='coverage'))
+
+
+def test_local_matcher_requires_fields(mapping):
+    mapping = deepcopy(mapping)
+    del mapping['mappings']['AUI']['properties']['ngrams']
+    with pytest.raises(ValueError):
+        LocalUmlsMatcher.build([], mapping=mapping)
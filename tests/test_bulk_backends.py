@@ -0,0 +1,77 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  bulk backends of utils.es_tools against a fake endpoint
+
+# default modules
+# no modules
+
+# installed modules
+import pytest
+from elasticsearch import Elasticsearch
+
+# project modules
+from utils.es_tools import bulk_create, BULK_BACKENDS
+from utils.fake_es import FakeElasticsearch
+
+
+def make_docs(n):
+    return [{'_index': 'umls', '_type': 'atom', '_id': 'A{:08d}'.format(i),
+             '_source': {'STR': u'na\xefve caf\xe9 \u764c {}'.format(i)}}
+            for i in xrange(n)]
+
+
+@pytest.mark.parametrize('backend', sorted(BULK_BACKENDS))
+def test_backend_indexes_all_documents(backend):
+    docs = make_docs(500)
+    progress = []
+    with FakeElasticsearch(reject_rate=0.05, store=True, seed=1) as fake:
+        client = Elasticsearch([{'host': fake.host, 'port': fake.port}])
+        indexed = bulk_create(client, docs, chunk_size=40, backend=backend,
+                              max_retries=20, initial_backoff=0.001,
+                              max_in_flight=3, on_progress=progress.append)
+
+        assert indexed == len(docs)
+        assert fake.count('umls') == len(docs)
+        assert progress[-1] == len(docs)
+
+        # rejected documents were sent again
+        assert fake.stats['rejected_items'] > 0
+        assert fake.stats['items'] == (len(docs) +
+                                       fake.stats['rejected_items'])
+
+        # non-ASCII text arrives intact
+        stored = fake.indices['umls']['docs']
+        for doc in docs:
+            assert stored[doc['_id']]['STR'] == doc['_source']['STR']
+
+
+@pytest.mark.parametrize('backend', sorted(BULK_BACKENDS))
+def test_backend_retries_rejected_requests(backend):
+    docs = make_docs(200)
+    with FakeElasticsearch(reject_request_rate=0.3, seed=2) as fake:
+        client = Elasticsearch([{'host': fake.host, 'port': fake.port}])
+        indexed = bulk_create(client, docs, chunk_size=20, backend=backend,
+                              max_retries=20, initial_backoff=0.001)
+
+        assert indexed == len(docs)
+        assert fake.count('umls') == len(docs)
+        assert fake.stats['rejected_requests'] > 0
+
+
+def test_async_backend_uses_url_prefix():
+    docs = make_docs(50)
+    with FakeElasticsearch() as fake:
+        client = Elasticsearch([{'host': fake.host, 'port': fake.port,
+                                 'url_prefix': 'es'}])
+        indexed = bulk_create(client, docs, chunk_size=10, backend='async')
+        assert indexed == len(docs)
+        assert fake.count('umls') == len(docs)
+
+
+def test_async_backend_rejects_tls():
+    client = Elasticsearch([{'host': 'localhost', 'port': 9200,
+                             'use_ssl': True}], verify_certs=False)
+    with pytest.raises(ValueError):
+        bulk_create(client, make_docs(1), backend='async')
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  export and replay of bulk payloads against fake endpoints
+
+# default modules
+import os
+
+# installed modules
+import pytest
+from elasticsearch import Elasticsearch
+
+# project modules
+from utils.bulk_payload import export_payloads, load_manifest, \
+    replay_payloads
+from utils.fake_es import FakeElasticsearch
+
+
+def make_docs(n):
+    return [{'_id': 'A{:08d}'.format(i),
+             '_source': {'STR': u'caf\xe9 na\xefve \u764c {}'.format(i)}}
+            for i in xrange(n)]
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_export_writes_manifest(tmpdir, compress):
+    path = str(tmpdir.join('payloads'))
+    manifest = export_payloads(make_docs(25), path, chunk_size=10,
+                               compress=compress)
+
+    assert load_manifest(path) == manifest
+    assert manifest['docs'] == 25
+    assert [entry['docs'] for entry in manifest['files']] == [10, 10, 5]
+    for entry in manifest['files']:
+        assert os.path.exists(os.path.join(path, entry['name']))
+
+    with pytest.raises(IOError):
+        export_payloads(make_docs(1), path)
+
+
+def test_replay_non_ascii_documents(tmpdir):
+    docs = make_docs(200)
+    path = str(tmpdir.join('payloads'))
+    export_payloads(docs, path, chunk_size=30)
+
+    with FakeElasticsearch(store=True) as first, \
+            FakeElasticsearch(reject_rate=0.1, store=True, seed=3) as second:
+        clients = [Elasticsearch([{'host': fake.host, 'port': fake.port}])
+                   for fake in (first, second)]
+        indexed = replay_payloads(clients, path, 'umls', doc_type='atom',
+                                  max_retries=20, initial_backoff=0.001)
+
+        assert indexed == [len(docs), len(docs)]
+        # rejected documents were sent again in a smaller body
+        assert second.stats['rejected_items'] > 0
+        for fake in (first, second):
+            stored = fake.indices['umls']['docs']
+            assert len(stored) == len(docs)
+            for doc in docs:
+                assert stored[doc['_id']]['STR'] == doc['_source']['STR']
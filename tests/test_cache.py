@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  in-memory and on-disk caches
+
+# default modules
+import os
+
+# installed modules
+import pytest
+
+# project modules
+from utils import cache as cache_module
+from utils.cache import Cache, DiskCache, memoize
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the time of the cache module with a settable one"""
+    time = [1000.0]
+    monkeypatch.setattr(cache_module, 'now', lambda: time[0])
+    return time
+
+
+def unit_size(obj):
+    return 1
+
+
+def test_lru_evicts_least_recently_used():
+    cache = Cache(max_entries=3)
+    for key in 'abc':
+        cache[key] = key.upper()
+    assert cache.get('a') == 'A'
+    cache['d'] = 'D'
+    assert 'b' not in cache
+    assert all(key in cache for key in 'acd')
+    assert cache.stats['evictions'] == 1
+
+
+def test_lfu_evicts_least_frequently_used():
+    cache = Cache(max_entries=3, policy='lfu')
+    for key in 'abc':
+        cache[key] = key.upper()
+    for _ in range(3):
+        cache.get('a')
+    cache.get('c')
+    # b is the only entry used once
+    cache['d'] = 'D'
+    assert 'b' not in cache
+
+    # d and c were used as often, but c was used less recently than d
+    cache.get('d')
+    cache['e'] = 'E'
+    assert 'c' not in cache
+    assert all(key in cache for key in 'ade')
+
+
+def test_lfu_keeps_frequency_of_updated_entries():
+    cache = Cache(max_entries=2, policy='lfu')
+    cache['a'] = 1
+    cache['b'] = 2
+    cache.get('a')
+    cache.get('a')
+    cache['a'] = 3
+    cache['c'] = 4
+    assert cache.get('a') == 3
+    assert 'b' not in cache
+
+
+def test_ttl_expires_entries(clock):
+    cache = Cache(ttl=10)
+    cache['a'] = 1
+    clock[0] += 5
+    cache['b'] = 2
+    assert cache.get('a') == 1
+
+    clock[0] += 5
+    assert 'a' not in cache
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert cache.stats['expirations'] == 1
+
+    clock[0] += 5
+    assert cache.pop('b', 'gone') == 'gone'
+    assert cache.stats['expirations'] == 2
+    assert len(cache) == 0 and cache.bytes == 0
+
+
+def test_max_bytes_bounds_size():
+    cache = Cache(max_bytes=10, sizeof=len)
+    assert cache.put('a', 'xxxx')
+    assert cache.put('b', 'xxxx')
+    assert cache.bytes == 10
+
+    # replacing an entry frees its old size first
+    assert cache.put('a', 'xx')
+    assert cache.bytes == 8 and len(cache) == 2
+
+    assert cache.put('c', 'xxxxx')
+    assert 'b' not in cache
+    assert cache.bytes == 9 <= cache.max_bytes
+
+    assert not cache.put('d', 'x' * 10)
+    assert 'd' not in cache
+    assert cache.bytes == sum(len(k) + len(cache[k]) for k in 'ac')
+
+
+def test_entries_and_bytes_bounds_together():
+    cache = Cache(max_entries=4, max_bytes=3, sizeof=unit_size)
+    for i in range(10):
+        cache[str(i)] = i
+    assert len(cache) == 1
+    assert cache.bytes == 2
+    assert cache.stats['evictions'] == 9
+
+
+def test_stats_and_invalid_policy():
+    cache = Cache(max_entries=1)
+    cache['a'] = 1
+    cache.get('a')
+    cache.get('b')
+    with pytest.raises(KeyError):
+        cache['c']
+    stats = cache.stats
+    assert (stats['hits'], stats['misses']) == (1, 2)
+    assert stats['hit_rate'] == pytest.approx(1 / 3.)
+
+    with pytest.raises(ValueError):
+        Cache(policy='fifo')
+
+
+def test_memoize():
+    calls = []
+
+    @memoize(max_entries=2)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    assert [square(x) for x in (1, 2, 1, 3, 1, 2)] == [1, 4, 1, 9, 1, 4]
+    assert calls == [1, 2, 3, 2]
+    assert square.cache.stats['hits'] == 2
+
+
+def test_disk_cache_round_trip(tmpdir):
+    cache = DiskCache(str(tmpdir), namespace='test')
+    other = DiskCache(str(tmpdir), namespace='other')
+    cache[('key', 1)] = {'value': [1, 2]}
+    assert cache[('key', 1)] == {'value': [1, 2]}
+    assert ('key', 1) in cache
+    assert ('key', 1) not in other
+    assert cache.pop(('key', 1)) == {'value': [1, 2]}
+    assert cache.get(('key', 1), 'missing') == 'missing'
+    assert len(cache) == 0
+
+
+def test_disk_cache_overwrite_keeps_bytes(tmpdir):
+    cache = DiskCache(str(tmpdir), max_bytes=10 ** 6)
+    cache.evict()
+    assert cache.bytes == 0
+    for size in (100, 1000, 10):
+        cache['key'] = 'x' * size
+    assert cache.bytes == os.path.getsize(cache.entry_path('key'))
+    assert len(cache) == 1
+
+
+def test_disk_cache_evicts_least_recently_used(tmpdir):
+    cache = DiskCache(str(tmpdir), max_bytes=1000, low_water=0.5)
+    value = 'x' * 180
+    for i in range(5):
+        cache[i] = value
+        path = cache.entry_path(i)
+        os.utime(path, (i, i))
+    # a hit refreshes the modification time of the entry
+    cache.get(0)
+    cache[5] = value
+
+    remaining = [i for i in range(6) if i in cache]
+    assert remaining[0] == 0
+    assert 1 not in remaining and 5 in remaining
+    assert cache.bytes == sum(os.path.getsize(cache.entry_path(i))
+                              for i in remaining)
+    assert cache.bytes <= 0.5 * cache.max_bytes
+    assert cache.stats['evictions'] == 6 - len(remaining)
+
+
+def test_disk_cache_rejects_large_values(tmpdir):
+    cache = DiskCache(str(tmpdir), max_bytes=100)
+    assert not cache.put('key', 'x' * 200)
+    assert 'key' not in cache
+
+
+@pytest.mark.parametrize('corrupt', [
+    lambda data: data[:len(data) // 2], lambda data: '', lambda data: 'junk'])
+def test_disk_cache_corrupt_entry_is_a_miss(tmpdir, corrupt):
+    cache = DiskCache(str(tmpdir), max_bytes=10 ** 6)
+    cache['key'] = {'value': range(100)}
+    path = cache.entry_path('key')
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(corrupt(data))
+    cache.evict()
+
+    assert cache.get('key', 'missing') == 'missing'
+    assert not os.path.exists(path)
+    assert cache.bytes == 0
+    assert cache.stats['misses'] == 1
+
+    cache['key'] = 'value'
+    assert cache['key'] == 'value'
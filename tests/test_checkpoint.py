@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  resuming imports from checkpointed offsets
+
+# default modules
+import os
+import shutil
+
+# installed modules
+import pytest
+from elasticsearch import Elasticsearch
+
+# project modules
+from src.concept_importer import ElasticSearchScoller, split_byte_ranges
+from scripts.import_elasticsearch import index_range
+from utils.checkpoint import ImportCheckpoint
+from utils.fake_es import FakeElasticsearch
+
+
+class Crash(Exception):
+    pass
+
+
+def test_acknowledged_offsets_resume_after_last_document(mrconso_path):
+    scroller = ElasticSearchScoller(mrconso_path, 'umls', 'atom',
+                                    block_size=1000, track_offsets=True)
+    served = [next(scroller)['_id'] for _ in xrange(1234)]
+    offset = scroller.acknowledged_offset(1000)
+    assert scroller.acknowledged_offset(1000) == offset
+
+    with open(mrconso_path, 'rb') as f:
+        lines = f.readlines()
+    assert offset == sum(len(ln) for ln in lines[:1000])
+
+    rest = [doc['_id'] for doc in ElasticSearchScoller(
+        mrconso_path, 'umls', 'atom', start=offset)]
+    assert served[:1000] + rest == [ln.split('|')[7] for ln in lines]
+
+
+def test_checkpoint_progress(mrconso_path, tmpdir):
+    checkpoint = ImportCheckpoint(str(tmpdir.join('ckpt', 'import.json')))
+    ranges = split_byte_ranges(mrconso_path, 3)
+    meta = checkpoint.start('umls_1', mrconso_path, ranges)
+
+    checkpoint.update(ranges[1][0], ranges[1][0] + 100, 7)
+    resumed = ImportCheckpoint(checkpoint.path)
+    assert resumed.load(mrconso_path) == meta
+    assert resumed.progress(ranges[0][0]) == (ranges[0][0], 0)
+    assert resumed.progress(ranges[1][0]) == (ranges[1][0] + 100, 7)
+
+    resumed.clear()
+    assert not resumed.exists()
+    assert os.listdir(str(tmpdir.join('ckpt'))) == []
+    with pytest.raises(IOError):
+        resumed.load(mrconso_path)
+
+
+def test_checkpoint_of_another_file(mrconso_path, tmpdir):
+    path = str(tmpdir.join('MRCONSO.RRF'))
+    shutil.copy(mrconso_path, path)
+    checkpoint = ImportCheckpoint(str(tmpdir.join('import.json')))
+    checkpoint.start('umls', path, [(0, None)])
+
+    with open(path, 'ab') as f:
+        f.write('C1|ENG|P|L1|PF|S1|Y|A1||||MSH|PT|D1|x|0|N||\n')
+    with pytest.raises(ValueError):
+        checkpoint.load(path)
+
+
+def test_import_resumes_after_crash(mrconso_path, tmpdir, monkeypatch):
+    checkpoint = ImportCheckpoint(str(tmpdir.join('import.json')))
+    ranges = split_byte_ranges(mrconso_path, 3)
+    checkpoint.start('umls', mrconso_path, ranges)
+
+    # the import stops right after the progress of the second chunk of
+    # the second range is recorded
+    update = ImportCheckpoint.update
+
+    def crashing_update(self, start, offset, docs):
+        update(self, start, offset, docs)
+        if start == ranges[1][0] and docs == 200:
+            raise Crash()
+
+    def run():
+        return [index_range(es, 'umls', 'atom', mrconso_path, 100, {},
+                            start, end, checkpoint_path=checkpoint.path)
+                for start, end in ranges]
+
+    with FakeElasticsearch(store=True) as fake:
+        es = Elasticsearch([{'host': fake.host, 'port': fake.port}])
+
+        monkeypatch.setattr(ImportCheckpoint, 'update', crashing_update)
+        with pytest.raises(Crash):
+            run()
+        first_range = checkpoint.progress(ranges[0][0])[1]
+        assert fake.stats['items'] == first_range + 200
+
+        monkeypatch.setattr(ImportCheckpoint, 'update', update)
+        results = run()
+
+        # the first range is skipped and the second is read from the
+        # offset after its 200th document, so no document is sent twice
+        assert results[0] == (0, 0, {})
+        assert sum(served for served, _, _ in results) == (
+            3000 - first_range - 200)
+        assert fake.stats['items'] == 3000
+        assert fake.count('umls') == 3000
+
+    assert sum(checkpoint.progress(start)[1]
+               for start, _ in ranges) == 3000
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  batch parser of src.concept_importer
+
+# default modules
+import gzip
+
+# installed modules
+import pytest
+
+# project modules
+from src.concept_importer import (ConceptImporterFromRRF, decode_utf8,
+                                  split_byte_ranges)
+
+
+def parse_lines(path, schema, columns):
+    """Rows of path parsed one at the time, as reference"""
+    names = [name for name, _ in schema]
+    rows = []
+    with open(path, 'rb') as f:
+        for ln in f:
+            raw = ln.rstrip('\n').split('|')
+            rows.append(tuple(
+                schema[names.index(col)][1](raw[names.index(col)])
+                if raw[names.index(col)] else None for col in columns))
+    return rows
+
+
+@pytest.mark.parametrize('block_size', [7, 1024, 8 * 1024 * 1024])
+@pytest.mark.parametrize('columns', [('AUI', 'STR'),
+                                     ('CUI', 'TS', 'ISPREF', 'SRL', 'CFV'),
+                                     None])
+def test_batches_match_line_parser(mrconso_path, block_size, columns):
+    importer = ConceptImporterFromRRF(mrconso_path, block_size=block_size)
+    expected = parse_lines(mrconso_path, importer.schema,
+                           columns or [n for n, _ in importer.schema])
+
+    records = list(importer.iter_records(columns))
+    assert [tuple(r) for r in records] == expected
+    if columns is not None:
+        assert records[0]._fields == columns
+
+
+def test_blocks_are_decoded_as_utf8(mrconso_path):
+    # blocks of 5 bytes split multibyte characters between reads
+    records = list(ConceptImporterFromRRF(
+        mrconso_path, block_size=5).iter_records(('STR', )))
+    strings = [r.STR for r in records]
+    assert all(isinstance(s, unicode) for s in strings)
+    assert any(ord(c) > 127 for s in strings for c in s)
+    with open(mrconso_path, 'rb') as f:
+        assert strings == [ln.split('|')[14].decode('utf-8') for ln in f]
+
+
+def test_raw_fields_are_parsed_one_at_the_time(mrconso_path):
+    # a function that is not text safe requires the bytes of the field
+    importer = ConceptImporterFromRRF(mrconso_path, block_size=100)
+    importer.schema = [(name, len if name == 'STR' else func)
+                       for name, func in importer.schema]
+    with open(mrconso_path, 'rb') as f:
+        expected = [(ln.split('|')[7].decode('utf-8'),
+                     len(ln.split('|')[14])) for ln in f]
+    assert ([tuple(r) for r in importer.iter_records(('AUI', 'STR'))] ==
+            expected)
+
+
+def test_next_returns_dictionaries(mrconso_path):
+    importer = ConceptImporterFromRRF(mrconso_path)
+    rows = parse_lines(mrconso_path, importer.schema,
+                       [n for n, _ in importer.schema])
+    first = next(importer)
+    assert first == dict(zip([n for n, _ in importer.schema], rows[0]))
+    assert len(list(importer)) == len(rows) - 1
+
+
+def test_offsets_are_line_ends(mrconso_path):
+    importer = ConceptImporterFromRRF(mrconso_path, block_size=333)
+    offsets = [offset for _, batch_offsets
+               in importer.iter_batches(('AUI', ), with_offsets=True)
+               for offset in batch_offsets]
+    ends, position = [], 0
+    with open(mrconso_path, 'rb') as f:
+        for ln in f:
+            position += len(ln)
+            ends.append(position)
+    assert offsets == ends
+
+
+def test_last_line_without_newline(tmpdir):
+    path = str(tmpdir.join('MRCONSO.RRF'))
+    schema = [('AUI', decode_utf8), ('STR', decode_utf8), ('SRL', int)]
+    with open(path, 'wb') as f:
+        f.write(u'A1|caf\xe9|0\nA2||3\nA3|na\xefve|'.encode('utf-8'))
+    importer = ConceptImporterFromRRF(path, mrconso_schema=schema,
+                                      block_size=4)
+    assert [tuple(r) for r in importer.iter_records()] == [
+        (u'A1', u'caf\xe9', 0), (u'A2', None, 3), (u'A3', u'na\xefve', None)]
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 7, 64])
+def test_byte_ranges_are_aligned_to_lines(mrconso_path, n):
+    with open(mrconso_path, 'rb') as f:
+        content = f.read()
+    ranges = split_byte_ranges(mrconso_path, n)
+
+    assert 1 <= len(ranges) <= n
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(content)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+    for start, end in ranges:
+        assert start < end
+        assert start == 0 or content[start - 1] == '\n'
+        assert content[end - 1] == '\n'
+
+
+def test_byte_ranges_read_every_row_once(mrconso_path):
+    expected = list(ConceptImporterFromRRF(mrconso_path).iter_records(
+        ('AUI', 'STR')))
+    records = []
+    for start, end in split_byte_ranges(mrconso_path, 5):
+        records.extend(ConceptImporterFromRRF(
+            mrconso_path, start=start, end=end,
+            block_size=1000).iter_records(('AUI', 'STR')))
+    assert records == expected
+
+
+def test_byte_ranges_of_short_files(tmpdir):
+    path = str(tmpdir.join('MRCONSO.RRF'))
+    with open(path, 'wb') as f:
+        f.write('a|b\nc|d\n')
+    assert split_byte_ranges(path, 10) == [(0, 4), (4, 8)]
+
+    with open(path, 'wb') as f:
+        f.write('a much longer line|b\n')
+    assert split_byte_ranges(path, 4) == [(0, 21)]
+
+
+def test_compressed_files_can_not_be_split(tmpdir):
+    path = str(tmpdir.join('MRCONSO.RRF.gz'))
+    with gzip.open(path, 'wb') as f:
+        f.write('a|b\n')
+    with pytest.raises(ValueError):
+        split_byte_ranges(path, 2)
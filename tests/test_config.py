@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  fingerprints of configurations and methods memoized by them
+
+# default modules
+# no modules
+
+# installed modules
+import pytest
+
+# project modules
+from utils.cache import disk_memoize
+from utils.config import ConfigDict, config_fingerprint
+
+
+CONFIG = {
+    'name': 'umls',
+    'bulk': {'chunk_size': 500, 'threads': 4},
+    'sources': ['MTH', 'SNOMEDCT_US'],
+    'filters': [{'column': 'LAT', 'values': ['ENG']}],
+    'cache': {'path': '/tmp/cache'}
+}
+
+
+@pytest.fixture
+def config():
+    return ConfigDict(CONFIG)
+
+
+def fresh_fingerprint(config, include=None, ignore=None):
+    """Fingerprint of a copy of config built from scratch, which has
+    nothing memoized"""
+    return config_fingerprint(ConfigDict(to_plain(config)),
+                              include=include, ignore=ignore)
+
+
+def to_plain(value):
+    if isinstance(value, ConfigDict):
+        return {k: to_plain(v) for k, v in value.iteritems()}
+    if isinstance(value, list):
+        return [to_plain(v) for v in value]
+    return value
+
+
+MUTATIONS = [
+    lambda c: setattr(c, 'name', 'other'),
+    lambda c: setattr(c, 'extra', 1),
+    lambda c: delattr(c, 'name'),
+    lambda c: c.pop('name'),
+    lambda c: c.update({'name': 'other'}),
+    lambda c: setattr(c.bulk, 'threads', 8),
+    lambda c: c.sources.append('RXNORM'),
+    lambda c: c.sources.extend(['RXNORM']),
+    lambda c: c.sources.insert(0, 'RXNORM'),
+    lambda c: c.sources.pop(),
+    lambda c: c.sources.remove('MTH'),
+    lambda c: c.sources.reverse(),
+    lambda c: c.sources.__setitem__(0, 'RXNORM'),
+    lambda c: c.sources.__delitem__(0),
+    lambda c: c.sources.__setslice__(0, 1, ['A', 'B']),
+    lambda c: c.sources.__delslice__(0, 1),
+    lambda c: c.sources.__iadd__(['RXNORM']),
+    lambda c: c.sources.__imul__(2),
+    lambda c: c.sources.update(['RXNORM']),
+    lambda c: setattr(c.filters[0], 'column', 'SAB'),
+    lambda c: c.filters[0].values.append('SPA'),
+]
+
+
+@pytest.mark.parametrize('mutate', MUTATIONS)
+def test_mutation_changes_fingerprint(config, mutate):
+    before = config_fingerprint(config)
+    bulk_before = config_fingerprint(config, include=['bulk'])
+    mutate(config)
+    after = config_fingerprint(config)
+    assert after != before
+    assert after == fresh_fingerprint(config)
+    assert (config_fingerprint(config, include=['bulk']) ==
+            fresh_fingerprint(config, include=['bulk']))
+    if to_plain(config).get('bulk') == CONFIG['bulk']:
+        assert config_fingerprint(config, include=['bulk']) == bulk_before
+
+
+def test_sort_changes_fingerprint(config):
+    config.sources[:] = ['b', 'a']
+    before = config_fingerprint(config)
+    config.sources.sort()
+    assert config_fingerprint(config) != before
+    assert config_fingerprint(config) == fresh_fingerprint(config)
+
+
+def test_include_and_ignore(config):
+    bulk = config_fingerprint(config, include=['bulk'])
+    no_cache = config_fingerprint(config, ignore=['cache'])
+    config.cache.path = '/tmp/other'
+    assert config_fingerprint(config, include=['bulk']) == bulk
+    assert config_fingerprint(config, ignore=['cache']) == no_cache
+
+    config.bulk.chunk_size = 1000
+    assert config_fingerprint(config, include=['bulk']) != bulk
+    assert config_fingerprint(config, ignore=['cache']) != no_cache
+
+
+def test_fingerprint_is_memoized(config):
+    config_fingerprint(config)
+    # the memoized fingerprint is returned until the config changes
+    config.__dict__['_fingerprints'][(None, ())] = 'memoized'
+    assert config_fingerprint(config) == 'memoized'
+    config.bulk.threads = 1
+    assert config_fingerprint(config) != 'memoized'
+
+
+def test_copy_is_independent(config):
+    before = config_fingerprint(config)
+    copy = config.copy()
+    assert config_fingerprint(copy) == before
+    copy.sources.append('RXNORM')
+    copy.bulk.threads = 8
+    assert config_fingerprint(config) == before
+    assert config_fingerprint(copy) == fresh_fingerprint(copy)
+
+
+def test_adopted_values_invalidate_parent(config):
+    bulk = ConfigDict({'chunk_size': 1})
+    config.bulk = bulk
+    before = config_fingerprint(config)
+    bulk.chunk_size = 2
+    assert config_fingerprint(config) != before
+
+    config.update({'more': ConfigDict({'a': 1})})
+    before = config_fingerprint(config)
+    config.more.a = 2
+    assert config_fingerprint(config) != before
+
+
+class Counter(object):
+    def __init__(self, config):
+        self.config = config
+        self.calls = 0
+
+
+def test_disk_memoize_invalidated_by_mutation(config, tmpdir):
+    @disk_memoize(str(tmpdir), ignore=['cache'])
+    def compute(self, x):
+        self.calls += 1
+        return x * self.config.bulk.chunk_size
+
+    counter = Counter(config)
+    assert compute(counter, 2) == 1000
+    assert compute(counter, 2) == 1000
+    assert counter.calls == 1
+
+    # ignored keys do not invalidate results
+    config.cache.path = '/tmp/other'
+    assert compute(counter, 2) == 1000
+    assert counter.calls == 1
+
+    config.bulk.chunk_size = 10
+    assert compute(counter, 2) == 20
+    assert counter.calls == 2
+
+    config.sources.append('RXNORM')
+    assert compute(counter, 2) == 20
+    assert counter.calls == 3
+
+    # results are reused by equal configurations built anew
+    counter = Counter(ConfigDict(to_plain(config)))
+    assert compute(counter, 2) == 20
+    assert counter.calls == 0
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  changes between two MRCONSO releases
+
+# default modules
+import random
+
+# installed modules
+import pytest
+from elasticsearch import Elasticsearch
+
+# project modules
+from src.concept_importer import ElasticSearchScoller
+from src.delta_importer import diff_atoms, DeltaScroller
+from utils.es_tools import bulk_create
+from utils.fake_es import FakeElasticsearch
+
+
+def test_diff_atoms():
+    old = [('A1', 'x'), ('A2', 'y'), ('A4', 'z')]
+    new = [('A0', 'w'), ('A2', 'y'), ('A3', 'v'), ('A4', 'Z')]
+    assert list(diff_atoms(old, new)) == [
+        ('added', ('A0', 'w')), ('deleted', ('A1', 'x')),
+        ('unchanged', ('A2', 'y')), ('added', ('A3', 'v')),
+        ('changed', ('A4', 'Z'))]
+    assert list(diff_atoms([], new[:1])) == [('added', ('A0', 'w'))]
+    assert list(diff_atoms(old[:1], [])) == [('deleted', ('A1', 'x'))]
+
+
+def test_diff_atoms_rejects_duplicate_keys():
+    with pytest.raises(ValueError):
+        list(diff_atoms([('A1', 'x'), ('A1', 'y')], [('A1', 'x')]))
+
+
+@pytest.fixture(scope='module')
+def releases(mrconso_path, tmpdir_factory):
+    """A release with the rows of mrconso_path in random order, some of
+    them deleted, changed or added, and the AUIs of each change"""
+    rnd = random.Random(0)
+    with open(mrconso_path, 'rb') as f:
+        lines = f.readlines()
+
+    new_lines, changes = [], {'deleted': set(), 'changed': set(),
+                              'added': set()}
+    for i, ln in enumerate(lines):
+        fields = ln.split('|')
+        if i % 10 == 1:
+            changes['deleted'].add(fields[7])
+            continue
+        if i % 10 == 2:
+            fields[14] = fields[14] + ' (changed)'
+            changes['changed'].add(fields[7])
+        new_lines.append('|'.join(fields))
+    for i in xrange(50):
+        fields = lines[i].split('|')
+        fields[7] = 'A9{:07d}'.format(i)
+        fields[14] = 'new atom {}'.format(i)
+        changes['added'].add(fields[7])
+        new_lines.append('|'.join(fields))
+    rnd.shuffle(new_lines)
+
+    new_path = str(tmpdir_factory.mktemp('release').join('MRCONSO.RRF'))
+    with open(new_path, 'wb') as f:
+        f.writelines(new_lines)
+    return mrconso_path, new_path, changes
+
+
+def test_delta_actions(releases, tmpdir):
+    old_path, new_path, changes = releases
+    # a small buffer so that the sort spills to disk
+    scroller = DeltaScroller(new_path, old_path, 'umls', 'atom',
+                             buffer_size=100, tmp_dir=str(tmpdir))
+    actions = list(scroller)
+
+    deleted = [a['_id'] for a in actions if a.get('_op_type') == 'delete']
+    indexed = {a['_id']: a['_source'] for a in actions
+               if a.get('_op_type') != 'delete'}
+    assert set(deleted) == changes['deleted']
+    assert set(indexed) == changes['changed'] | changes['added']
+    assert all(indexed[aui]['text'].endswith(u' (changed)')
+               for aui in changes['changed'])
+    assert scroller.changes == {
+        'deleted': len(changes['deleted']),
+        'changed': len(changes['changed']),
+        'added': len(changes['added']),
+        'unchanged': 3000 - sum(len(v) for k, v in changes.iteritems()
+                                if k != 'added')}
+
+
+def test_delta_turns_old_index_into_new(releases):
+    old_path, new_path, _ = releases
+    with FakeElasticsearch(store=True) as old, \
+            FakeElasticsearch(store=True) as new:
+        clients = [Elasticsearch([{'host': fake.host, 'port': fake.port}])
+                   for fake in (old, new)]
+        bulk_create(clients[0], ElasticSearchScoller(old_path, 'umls',
+                                                     'atom'))
+        bulk_create(clients[0], DeltaScroller(new_path, old_path, 'umls',
+                                              'atom'))
+        bulk_create(clients[1], ElasticSearchScoller(new_path, 'umls',
+                                                     'atom'))
+
+        assert old.indices['umls']['docs'] == new.indices['umls']['docs']
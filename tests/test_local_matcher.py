@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  local matcher against the formula of UmlsScoringScript
+
+# default modules
+import math
+from collections import namedtuple
+
+# installed modules
+import numpy as np
+import pytest
+
+# project modules
+from src.analysis import analyze_ngrams, analyze_english
+from src.local_matcher import LocalUmlsMatcher, resolve_alpha_beta
+
+
+Record = namedtuple('Record', ('AUI', 'CUI', 'STR'))
+
+STRINGS = [u'Myocardial infarction', u'Acute myocardial infarction',
+           u'Heart attack', u'Heart failure', u'Congestive heart failure',
+           u'Renal failure', u'Acute renal failure', u'Chest pain',
+           u'Pain in chest', u'Infarction of kidney', u'Kidney failure',
+           u'Acute chest syndrome', u'Attack', u'...']
+
+QUERIES = [u'acute heart attack', u'myocardial infarction',
+           u'failure of the kidney', u'chest', u'pain pain pain',
+           u'zzzzzz', u'']
+
+
+@pytest.fixture(scope='module')
+def docs():
+    return [{'AUI': u'A{:07d}'.format(i), 'CUI': u'C{:07d}'.format(i // 2),
+             'ngrams': analyze_ngrams(string),
+             'text': analyze_english(string)}
+            for i, string in enumerate(STRINGS)]
+
+
+@pytest.fixture(scope='module')
+def matcher():
+    return LocalUmlsMatcher.build(
+        Record(u'A{:07d}'.format(i), u'C{:07d}'.format(i // 2), string)
+        for i, string in enumerate(STRINGS))
+
+
+def script_score(docs, ngrams, text, alpha=None, beta=None):
+    """runAsDouble of UmlsScoringScript, with df and docCount counted
+    over the analyzed documents"""
+    alpha, beta = resolve_alpha_beta(alpha, beta)
+    scores = []
+    for field, query in (('ngrams', ngrams), ('text', text)):
+        doc_count = sum(1 for doc in docs if doc[field])
+        score = 0.0
+        for term in query:
+            df = sum(1 for doc in docs if term in doc[field])
+            if df != 0:
+                score += math.log((float(np.float32(doc_count)) + 2.0) /
+                                  (float(np.float32(df)) + 1.0))
+        scores.append(score)
+    return alpha * scores[0] + beta * scores[1]
+
+
+def matched(docs, ngrams, text):
+    """Documents selected by the should clauses of utils.matcher"""
+    return [doc for doc in docs
+            if set(ngrams) & set(doc['ngrams']) or
+            set(text) & set(doc['text'])]
+
+
+@pytest.mark.parametrize('query', QUERIES)
+@pytest.mark.parametrize('alpha,beta', [(None, None), (0.2, None),
+                                        (None, 0.0), (1.0, 1.0)])
+@pytest.mark.parametrize('method', ['exhaustive', 'maxscore'])
+def test_plugin_formula(docs, matcher, query, alpha, beta, method):
+    ngrams, text = analyze_ngrams(query), analyze_english(query)
+    k = 4
+    candidates = matcher.score(ngrams, text, alpha=alpha, beta=beta, k=k,
+                               method=method)
+
+    expected = matched(docs, ngrams, text)[:k]
+    assert [c['AUI'] for c in candidates] == [d['AUI'] for d in expected]
+    assert [c['CUI'] for c in candidates] == [d['CUI'] for d in expected]
+    score = script_score(docs, ngrams, text, alpha, beta)
+    assert all(c['score'] == score for c in candidates)
+
+
+@pytest.mark.parametrize('query', QUERIES)
+@pytest.mark.parametrize('method', ['exhaustive', 'maxscore'])
+def test_coverage_formula(docs, matcher, query, method):
+    ngrams, text = analyze_ngrams(query), analyze_english(query)
+    candidates = matcher.score(ngrams, text, k=len(docs), method=method,
+                               formula='coverage')
+
+    # the score of the plugin over the query terms each atom contains
+    expected = []
+    for doc in matched(docs, ngrams, text):
+        score = script_score(
+            docs, [t for t in ngrams if t in doc['ngrams']],
+            [t for t in text if t in doc['text']])
+        expected.append((doc['AUI'], score))
+    expected.sort(key=lambda item: -item[1])
+
+    assert len(candidates) == len(expected)
+    for candidate, (aui, score) in zip(candidates, expected):
+        assert candidate['score'] == pytest.approx(score)
+    assert (sorted(c['AUI'] for c in candidates) ==
+            sorted(aui for aui, _ in expected))
+
+
+def test_methods_agree(matcher):
+    for query in QUERIES:
+        for formula in ('plugin', 'coverage'):
+            for k in (1, 3, 20):
+                assert (matcher.match(query, k=k, formula=formula) ==
+                        matcher.match(query, k=k, method='maxscore',
+                                      formula=formula))
+
+
+def test_save_and_load(tmpdir, matcher):
+    path = str(tmpdir.join('matcher'))
+    matcher.save(path)
+    loaded = LocalUmlsMatcher.load(path)
+    assert len(loaded) == len(matcher)
+    for query in QUERIES:
+        assert loaded.match(query) == matcher.match(query)
+
+
+def test_invalid_arguments(matcher):
+    with pytest.raises(ValueError):
+        matcher.match(u'heart', alpha=1.5)
+    with pytest.raises(ValueError):
+        matcher.match(u'heart', method='wand')
+    with pytest.raises(ValueError):
+        matcher.match(u'heart', formula='bm25')
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  batch matcher over _msearch against a fake endpoint
+
+# default modules
+import codecs
+
+# installed modules
+import pytest
+
+# project modules
+from src.concept_importer import ElasticSearchScoller
+from utils.cache import Cache
+from utils.common import backoff_delay
+from utils.es_tools import connect, bulk_create
+from utils.fake_es import FakeElasticsearch
+from utils.matcher import UmlsMatcher
+
+
+@pytest.fixture(scope='module')
+def client(mrconso_path):
+    with FakeElasticsearch(store=True) as fake:
+        es = connect(fake.host, fake.port)
+        es.indices.create(index='umls', body={})
+        bulk_create(es, ElasticSearchScoller(mrconso_path, 'umls', 'AUI'),
+                    chunk_size=1000)
+        yield es
+
+
+@pytest.fixture(scope='module')
+def strings(mrconso_path):
+    with codecs.open(mrconso_path, encoding='utf-8') as f:
+        return [next(f).split('|')[14] for _ in range(5)]
+
+
+@pytest.mark.parametrize('result_cache', [None, {'max_entries': 10}])
+def test_duplicate_strings_get_distinct_lists(client, strings,
+                                              result_cache):
+    matcher = UmlsMatcher(client, 'umls', 'maps/ngrams.json', k=3,
+                          result_cache=result_cache)
+    first, second, other = matcher.match(
+        [strings[0], strings[0], strings[1]])
+    assert first and first == second
+    assert first is not second
+    assert all(a is not b for a, b in zip(first, second))
+
+    # altering the candidates of one occurrence leaves the others intact
+    expected = [dict(candidate) for candidate in second]
+    first[0]['CUI'] = 'altered'
+    first.append({})
+    assert second == expected
+    assert matcher.match_one(strings[0]) == expected
+
+
+def test_matches_are_cached(client, strings):
+    matcher = UmlsMatcher(client, 'umls', 'maps/ngrams.json', k=3,
+                          result_cache=Cache(max_entries=10))
+    expected = matcher.match(strings)
+    assert matcher.match(strings) == expected
+    assert matcher.result_cache.stats['hits'] == len(set(strings))
+
+
+def test_backoff_delay():
+    assert [backoff_delay(attempt, 2, 20) for attempt in range(1, 6)] == \
+        [2, 4, 8, 16, 20]
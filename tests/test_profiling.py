@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  profiler of nested spans across worker processes
+
+# default modules
+import os
+import json
+from multiprocessing import Pool
+
+# installed modules
+import pytest
+
+# project modules
+from utils import profiling
+from utils.profiling import Profiler, RESERVOIR_SIZE
+
+
+def calls(profiler):
+    return {row['span']: row['calls'] for row in profiler.stats()}
+
+
+def run_range(n):
+    """Task of a worker, as import_range of scripts.import_elasticsearch"""
+    profiler = profiling.profiler
+    profiler.reset()
+    for _ in xrange(n):
+        with profiler.span('range'):
+            with profiler.span('chunk'):
+                pass
+    return profiler.snapshot()
+
+
+@pytest.fixture
+def profiler():
+    profiler = profiling.profiler
+    profiler.enabled = True
+    profiler.reset()
+    yield profiler
+    profiler.enabled = False
+    profiler.reset()
+
+
+def test_worker_spans_are_merged_under_current_span(profiler):
+    with profiler.span('driver'):
+        pool = Pool(2)
+        try:
+            for snapshot in pool.imap_unordered(run_range, [1, 2, 3]):
+                profiler.merge(json.loads(json.dumps(snapshot)))
+        finally:
+            pool.close()
+            pool.join()
+
+    # spans the workers inherited when forked are not counted again
+    assert calls(profiler) == {'driver': 1, 'driver/range': 6,
+                               'driver/range/chunk': 6}
+    rows = {row['span']: row for row in profiler.stats()}
+    assert rows['driver/range']['sampled'] == 6
+    assert rows['driver/range']['p50'] is not None
+
+
+def test_merge_bounds_reservoir():
+    source = Profiler(enabled=True)
+    for _ in xrange(RESERVOIR_SIZE):
+        with source.span('span'):
+            pass
+    target = Profiler(enabled=True)
+    for _ in xrange(2):
+        target.merge(source.snapshot())
+    row, = target.stats()
+    assert (row['calls'], row['sampled']) == (2 * RESERVOIR_SIZE,
+                                              2 * RESERVOIR_SIZE)
+    assert row['max'] == source.stats()[0]['max']
+
+
+def test_reset_forgets_open_spans():
+    profiler = Profiler(enabled=True)
+    with profiler.span('outer'):
+        profiler.reset()
+        with profiler.span('inner'):
+            pass
+    assert calls(profiler) == {'inner': 1}
+
+
+def dump_in_worker(path):
+    profiling.profiler.dump(path)
+    return os.getpid()
+
+
+def test_forked_processes_dump_to_own_path(tmpdir, profiler):
+    path = str(tmpdir.join('profile.json'))
+    profiler.install(path, at_exit=False, signum=None)
+    pool = Pool(1)
+    try:
+        pid = pool.apply(dump_in_worker, (path, ))
+    finally:
+        pool.close()
+        pool.join()
+    profiler.dump(path)
+    assert sorted(os.listdir(str(tmpdir))) == sorted(
+        ['profile.json', 'profile.{}.json'.format(pid)])
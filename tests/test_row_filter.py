@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  filters of rows read from MRCONSO and from its cache
+
+# default modules
+# no modules
+
+# installed modules
+import pytest
+
+# project modules
+from src.concept_importer import ConceptImporterFromRRF, RowFilter
+
+
+FILTERS = [
+    {'LAT': {'include': ['ENG', 'SPA']}},
+    {'SUPPRESS': {'exclude': ['O', 'E', 'Y']}, 'TS': {'include': ['P']}},
+    {'SAB': {'exclude': ['MDR']}, 'ISPREF': {'include': ['Y']},
+     'SRL': {'include': ['0', '3']}},
+    # an empty string selects rows without a value
+    {'CFV': {'include': ['']}, 'LAT': {'exclude': ['JPN']}},
+    {'CFV': {'exclude': ['']}},
+]
+
+COLUMNS = {'LAT': 1, 'TS': 2, 'ISPREF': 6, 'SAB': 11, 'SRL': 15,
+           'SUPPRESS': 16, 'CFV': 17}
+
+
+def expected_rows(path, filters):
+    """AUIs of the rows kept, and rows dropped by column (the first one,
+    in alphabetical order, that rejects them)"""
+    kept, dropped = [], {column: 0 for column in filters}
+    with open(path, 'rb') as f:
+        for ln in f:
+            fields = ln.rstrip('\n').split('|')
+            for column, condition in sorted(filters.items()):
+                value = fields[COLUMNS[column]]
+                if ((condition.get('include') is not None and
+                     value not in condition['include']) or
+                        value in condition.get('exclude', [])):
+                    dropped[column] += 1
+                    break
+            else:
+                kept.append(fields[7].decode('utf-8'))
+    return kept, dropped
+
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_filters_on_every_path(mrconso_path, tmpdir, filters):
+    kept, dropped = expected_rows(mrconso_path, filters)
+    assert 0 < len(kept) < 3000
+
+    raw = ConceptImporterFromRRF(mrconso_path, filters=filters)
+    assert [r.AUI for r in raw.iter_records(('AUI', 'STR'))] == kept
+    assert raw.row_filter.dropped == dropped
+    assert raw.row_filter.kept == len(kept)
+
+    # columns that are not text safe are split without decoding
+    undecoded = ConceptImporterFromRRF(mrconso_path, filters=filters)
+    undecoded.schema = [(name, len if name == 'CODE' else func)
+                        for name, func in undecoded.schema]
+    assert [r.AUI for r in undecoded.iter_records(('AUI', 'CODE'))] == kept
+
+    rows = ConceptImporterFromRRF(mrconso_path, filters=filters)
+    assert [row['AUI'] for row in rows] == kept
+
+    cache_dir = str(tmpdir.join('cache'))
+    for _ in xrange(2):
+        # the cache is built by the first importer, read by the second
+        cached = ConceptImporterFromRRF(mrconso_path, filters=filters,
+                                        cache_dir=cache_dir)
+        assert [r.AUI for r in cached.iter_records(('AUI', ))] == kept
+        assert cached.row_filter.dropped == dropped
+
+
+def flatten(importer):
+    """(AUI, offset) of every row, whatever batches they come in"""
+    return [(record.AUI, offset) for batch, offsets
+            in importer.iter_batches(('AUI', ), with_offsets=True)
+            for record, offset in zip(batch, offsets)]
+
+
+@pytest.mark.parametrize('filters', FILTERS[:3])
+def test_filtered_offsets_on_every_path(mrconso_path, tmpdir, filters):
+    raw = ConceptImporterFromRRF(mrconso_path, filters=filters,
+                                 block_size=4096)
+    cached = ConceptImporterFromRRF(mrconso_path, filters=filters,
+                                    cache_dir=str(tmpdir.join('cache')))
+    assert flatten(cached) == flatten(raw)
+
+
+def test_invalid_filters():
+    schema = ConceptImporterFromRRF('MRCONSO.RRF').schema
+    with pytest.raises(ValueError):
+        RowFilter({'LANGUAGE': {'include': ['ENG']}}, schema)
+    with pytest.raises(ValueError):
+        RowFilter({'LAT': {'only': ['ENG']}}, schema)
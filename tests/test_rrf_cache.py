@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  columnar cache of parsed RRF files
+
+# default modules
+import os
+import shutil
+
+# installed modules
+import pytest
+
+# project modules
+from src.concept_importer import ConceptImporterFromRRF, split_byte_ranges
+from src.rrf_cache import RRFCache, schema_signature
+
+
+@pytest.fixture
+def cache_dir(tmpdir):
+    return str(tmpdir.join('cache'))
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    """Paths of the caches built during a test"""
+    paths = []
+    build = RRFCache.build.__func__
+
+    def counting_build(cls, importer, path):
+        paths.append(path)
+        return build(cls, importer, path)
+    monkeypatch.setattr(RRFCache, 'build', classmethod(counting_build))
+    return paths
+
+
+def records(importer, columns=None):
+    return [tuple(r) for r in importer.iter_records(columns)]
+
+
+@pytest.mark.parametrize('columns', [None, ('AUI', 'STR'),
+                                     ('TS', 'ISPREF', 'SRL', 'CFV')])
+def test_cache_returns_parsed_records(mrconso_path, cache_dir, columns):
+    expected = records(ConceptImporterFromRRF(mrconso_path), columns)
+    cached = ConceptImporterFromRRF(mrconso_path, cache_dir=cache_dir)
+    assert records(cached, columns) == expected
+
+
+def test_cache_reads_byte_ranges(mrconso_path, cache_dir):
+    for start, end in split_byte_ranges(mrconso_path, 4):
+        plain = ConceptImporterFromRRF(mrconso_path, start=start, end=end)
+        cached = ConceptImporterFromRRF(mrconso_path, start=start, end=end,
+                                        cache_dir=cache_dir)
+        assert (list(cached.iter_batches(('AUI', ), with_offsets=True)) ==
+                list(plain.iter_batches(('AUI', ), with_offsets=True)))
+
+
+def test_cache_is_built_once(mrconso_path, cache_dir, builds):
+    importer = ConceptImporterFromRRF(mrconso_path)
+    first = RRFCache.open_or_build(importer, cache_dir)
+    second = RRFCache.open_or_build(
+        ConceptImporterFromRRF(mrconso_path), cache_dir)
+    assert builds == [first.path]
+    assert second.path == first.path
+    assert len(second) == 3000
+
+
+def test_changed_file_invalidates_cache(mrconso_path, tmpdir, cache_dir,
+                                        builds):
+    path = str(tmpdir.join('MRCONSO.RRF'))
+    shutil.copy(mrconso_path, path)
+    first = RRFCache.open_or_build(ConceptImporterFromRRF(path), cache_dir)
+
+    with open(path, 'rb') as f:
+        lines = f.readlines()
+    with open(path, 'wb') as f:
+        f.writelines(lines[:100])
+    # same size and time would be taken for the same file
+    os.utime(path, (1, 1))
+
+    importer = ConceptImporterFromRRF(path, cache_dir=cache_dir)
+    assert len(records(importer)) == 100
+    assert len(builds) == 2 and builds[1] != first.path
+
+
+def test_changed_schema_invalidates_cache(mrconso_path, cache_dir, builds):
+    importer = ConceptImporterFromRRF(mrconso_path)
+    lower = [(name, (lambda s: s.lower()) if name == 'STR' else func)
+             for name, func in importer.schema]
+    upper = [(name, (lambda s: s.upper()) if name == 'STR' else func)
+             for name, func in importer.schema]
+    assert schema_signature(lower) != schema_signature(upper)
+
+    for schema, convert in ((lower, str.lower), (upper, str.upper)):
+        importer = ConceptImporterFromRRF(mrconso_path, schema,
+                                          cache_dir=cache_dir)
+        with open(mrconso_path, 'rb') as f:
+            expected = [convert(ln.split('|')[14]) for ln in f]
+        assert [r.STR for r in importer.iter_records(('STR', ))] == expected
+    assert len(builds) == 2
+
+
+def test_signature_of_closures():
+    def make_parser(suffix):
+        return lambda s: s + suffix
+    first = schema_signature([('STR', make_parser('a'))])
+    assert first == schema_signature([('STR', make_parser('a'))])
+    assert first != schema_signature([('STR', make_parser('b'))])
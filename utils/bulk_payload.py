@@ -0,0 +1,217 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  bulk requests serialized once and sent to many clusters
+
+# default modules
+import os
+import json
+import gzip
+import shutil
+import tempfile
+from time import sleep
+from multiprocessing.pool import ThreadPool
+
+# installed modules
+from elasticsearch.helpers import BulkIndexError
+from elasticsearch.exceptions import TransportError
+from elasticsearch.serializer import JSONSerializer
+
+# project modules
+from utils.common import mkdir_p, backoff_delay
+from utils.es_tools import chunk_actions, bulk_body, process_bulk_response
+
+
+PAYLOAD_VERSION = 1
+
+# fields of bulk responses needed to find the items that failed
+RESPONSE_FILTER = 'errors,items.*.status,items.*.error'
+
+
+def _payload_name(seq, compress):
+    return 'payload-{:06d}.ndjson{}'.format(seq, '.gz' if compress else '')
+
+
+def export_payloads(docs, path, chunk_size=1000, max_chunk_bytes=None,
+                    compress=True, compresslevel=6, notifiy_every=0):
+    """Writes docs to directory path as the bodies of bulk requests of
+    at most chunk_size documents and max_chunk_bytes bytes, one per
+    file (gzip compressed if compress), along with a manifest.json.
+
+    The index and type of the actions are not written, so that the
+    payloads can be sent to any index (see replay_payloads). The
+    directory is written under a temporary name and renamed when
+    complete; path must not exist.
+
+    Returns:
+        manifest (dict): files written, with their documents and bytes
+    """
+    if os.path.exists(path):
+        raise IOError('"{}" already exists'.format(path))
+    parent = os.path.dirname(os.path.abspath(path))
+    mkdir_p(parent)
+    tmp_path = tempfile.mkdtemp(
+        prefix='.{}.'.format(os.path.basename(path)), dir=parent)
+
+    docs = ({k: v for k, v in doc.iteritems()
+             if k not in ('_index', '_type')} for doc in docs)
+    chunks = chunk_actions(docs, chunk_size, JSONSerializer(),
+                            max_chunk_bytes)
+
+    manifest = {'version': PAYLOAD_VERSION, 'compress': compress,
+                'files': [], 'docs': 0, 'bytes': 0}
+    try:
+        for seq, chunk in enumerate(chunks):
+            body = bulk_body(chunk)
+            name = _payload_name(seq, compress)
+            if compress:
+                f = gzip.open(os.path.join(tmp_path, name), 'wb',
+                              compresslevel)
+            else:
+                f = open(os.path.join(tmp_path, name), 'wb')
+            with f:
+                f.write(body)
+
+            manifest['files'].append({'name': name, 'docs': len(chunk),
+                                      'bytes': len(body)})
+            previous = manifest['docs']
+            manifest['docs'] += len(chunk)
+            manifest['bytes'] += len(body)
+            if (notifiy_every > 0 and
+                    manifest['docs'] // notifiy_every >
+                    previous // notifiy_every):
+                print '[info] {:,} documents exported'.format(
+                    manifest['docs'])
+
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        # mkdtemp makes directories only readable by their owner
+        os.chmod(tmp_path, 0755)
+        os.rename(tmp_path, path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    return manifest
+
+
+def load_manifest(path):
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != PAYLOAD_VERSION:
+        raise ValueError('unsupported payloads in "{}" (version {})'.format(
+            path, manifest.get('version')))
+    return manifest
+
+
+def read_payload(path, entry, compress):
+    opener = gzip.open if compress else open
+    with opener(os.path.join(path, entry['name']), 'rb') as f:
+        return f.read()
+
+
+def _split_payload(body):
+    """Items of a bulk body as (op_type, lines), as in chunk_actions;
+    only needed when some of its documents have to be sent again"""
+    lines = body.split('\n')
+    items, pos = [], 0
+    while pos < len(lines) and lines[pos]:
+        op_type = next(iter(json.loads(lines[pos])))
+        size = 1 if op_type == 'delete' else 2
+        items.append((op_type, lines[pos:pos + size]))
+        pos += size
+    return items
+
+
+def send_payload(client, body, docs, index, doc_type=None, max_retries=3,
+                 initial_backoff=2, max_backoff=600):
+    """Sends the bulk body of docs documents to index as it is; only
+    if some documents are rejected with HTTP 429 is the body split to
+    send them again, with exponential backoff.
+
+    Returns:
+        successes (int): documents indexed
+        errors (list): items of the documents that failed
+    """
+    successes, errors, chunk = 0, [], None
+    for attempt in xrange(max_retries + 1):
+        if attempt > 0:
+            sleep(backoff_delay(attempt, initial_backoff, max_backoff))
+        retry = attempt < max_retries
+        try:
+            # the client appends a unicode newline to the body if
+            # missing, which fails on non-ASCII bytes
+            resp = client.bulk(body=body.decode('utf-8'), index=index,
+                               doc_type=doc_type,
+                               filter_path=RESPONSE_FILTER)
+        except TransportError as e:
+            if e.status_code == 429 and retry:
+                continue
+            raise
+
+        if not resp.get('errors'):
+            successes += docs if chunk is None else len(chunk)
+            break
+
+        if chunk is None:
+            chunk = _split_payload(body)
+        ok, failed, chunk, _ = process_bulk_response(chunk, resp, retry)
+        successes += ok
+        errors.extend(failed)
+        if not chunk:
+            break
+        body = bulk_body(chunk)
+    return successes, errors
+
+
+def replay_payloads(clients, path, index, doc_type=None, max_in_flight=4,
+                    max_retries=3, initial_backoff=2, max_backoff=600,
+                    notifiy_every=0):
+    """Sends the payloads exported in path to index in each of clients.
+
+    Each payload is read and decompressed once and sent as it is to
+    every cluster, with up to max_in_flight payloads in flight.
+
+    Returns:
+        indexed (list): documents indexed in each cluster
+
+    Raises:
+        BulkIndexError: as soon as some documents fail to index.
+    """
+    manifest = load_manifest(path)
+    compress = manifest['compress']
+
+    def send(entry):
+        body = read_payload(path, entry, compress)
+        return [send_payload(client, body, entry['docs'], index, doc_type,
+                             max_retries=max_retries,
+                             initial_backoff=initial_backoff,
+                             max_backoff=max_backoff)
+                for client in clients]
+
+    indexed = [0] * len(clients)
+    sent = 0
+    pool = ThreadPool(max_in_flight)
+    try:
+        for entry, results in zip(manifest['files'], pool.imap(
+                send, manifest['files'])):
+            for i, (successes, errors) in enumerate(results):
+                indexed[i] += successes
+                if errors:
+                    raise BulkIndexError('{} document(s) failed to index.'
+                                         ''.format(len(errors)), errors)
+
+            previous, sent = sent, sent + entry['docs']
+            if (notifiy_every > 0 and
+                    sent // notifiy_every > previous // notifiy_every):
+                print '[info] {:,} of {:,} documents sent'.format(
+                    sent, manifest['docs'])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return indexed
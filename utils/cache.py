@@ -0,0 +1,483 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  caches bounded by entries and bytes, in memory or on disk
+
+# default modules
+import os
+import sys
+import errno
+import hashlib
+import tempfile
+import cPickle as pickle
+from time import time as now
+from functools import wraps
+from threading import Lock
+
+# installed modules
+# no modules
+
+# project modules
+from utils.common import mkdir_p
+from utils.config import config_fingerprint
+
+
+POLICIES = ('lru', 'lfu')
+
+# fields of the nodes of the linked lists of entries
+PREV, NEXT, KEY, VALUE, SIZE, EXPIRES, FREQ = range(7)
+
+_MISSING = object()
+
+
+def approx_sizeof(obj):
+    """Approximate memory used by obj, following the items of lists,
+    tuples, sets and dictionaries; objects shared by several of them
+    are counted each time."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approx_sizeof(item) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(approx_sizeof(k) + approx_sizeof(v)
+                    for k, v in obj.iteritems())
+    return size
+
+
+class Cache(object):
+    """Cache holding at most max_entries entries and max_bytes bytes
+    (as measured by sizeof(key) + sizeof(value)); either bound can be
+    None. When full, the least recently used entry is evicted (policy
+    "lru") or the least frequently used one, the least recent among
+    those used as often (policy "lfu"). If ttl is set, entries expire
+    ttl seconds after they are set.
+
+    All operations take a lock, so the cache can be shared by threads;
+    lookups and updates are O(1). Hits, misses, evictions and
+    expirations are counted (see stats).
+
+    Args:
+        max_entries (int, default=None): maximum number of entries
+        max_bytes (int, default=None): maximum size of the entries;
+            values larger than this are not cached
+        policy (str, default="lru"): either "lru" or "lfu"
+        ttl (float, default=None): seconds entries are valid for
+        sizeof (function, default=approx_sizeof): size of an object
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, policy='lru',
+                 ttl=None, sizeof=approx_sizeof):
+        if policy not in POLICIES:
+            raise ValueError('unknown policy "{}"; options are: {}'.format(
+                policy, ', '.join(POLICIES)))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.ttl = ttl
+        self.sizeof = sizeof
+
+        self._lock = Lock()
+        self.__entries = {}
+        # entries are kept in circular doubly linked lists from least to
+        # most recently used, one per number of uses with "lfu" and a
+        # single one with "lru"
+        self.__lists = {}
+        self.__min_freq = None
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __repr__(self):
+        return '<Cache {} of {:,} entries, {:,} bytes>'.format(
+            self.policy, len(self), self.bytes)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        """Whether key is cached and not expired; not counted in stats"""
+        with self._lock:
+            node = self.__entries.get(key)
+            return node is not None and not self.__expired(node)
+
+    @property
+    def stats(self):
+        """Counters of the cache as a dictionary"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.__entries), 'bytes': self.bytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'hit_rate': (float(self.hits) / lookups
+                                 if lookups else 0.0)}
+
+    def __list_of(self, node):
+        return node[FREQ] if self.policy == 'lfu' else 0
+
+    def __link(self, node):
+        """Makes node the most recently used of its list"""
+        freq = self.__list_of(node)
+        root = self.__lists.get(freq)
+        if root is None:
+            root = self.__lists[freq] = []
+            root[:] = [root, root, None, None, 0, None, freq]
+            if self.__min_freq is None or freq < self.__min_freq:
+                self.__min_freq = freq
+        last = root[PREV]
+        node[PREV], node[NEXT] = last, root
+        last[NEXT] = root[PREV] = node
+
+    def __unlink(self, node):
+        node[PREV][NEXT], node[NEXT][PREV] = node[NEXT], node[PREV]
+        freq = self.__list_of(node)
+        root = self.__lists[freq]
+        if root[NEXT] is root:
+            del self.__lists[freq]
+            if freq == self.__min_freq:
+                self.__min_freq = min(self.__lists) if self.__lists else None
+
+    def __remove(self, node):
+        self.__unlink(node)
+        del self.__entries[node[KEY]]
+        self.bytes -= node[SIZE]
+
+    def __expired(self, node):
+        return node[EXPIRES] is not None and node[EXPIRES] <= now()
+
+    def get(self, key, default=None):
+        """Value of key, or default if it is not cached"""
+        with self._lock:
+            node = self.__entries.get(key)
+            if node is not None and self.__expired(node):
+                self.__remove(node)
+                self.expirations += 1
+                node = None
+            if node is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.__unlink(node)
+            node[FREQ] += 1
+            self.__link(node)
+            return node[VALUE]
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def put(self, key, value):
+        """Caches value under key, evicting other entries if needed;
+        returns False if value can not fit in the cache."""
+        size = (self.sizeof(key) + self.sizeof(value)
+                if self.max_bytes is not None else 0)
+
+        with self._lock:
+            old = self.__entries.get(key)
+            if old is not None:
+                self.__remove(old)
+            if ((self.max_entries is not None and self.max_entries < 1) or
+                    (self.max_bytes is not None and size > self.max_bytes)):
+                return False
+
+            # entries are evicted before adding the new one, which
+            # would otherwise be the first to go with "lfu"
+            while self.__entries and (
+                    (self.max_entries is not None and
+                     len(self.__entries) >= self.max_entries) or
+                    (self.max_bytes is not None and
+                     self.bytes + size > self.max_bytes)):
+                self.__remove(self.__lists[self.__min_freq][NEXT])
+                self.evictions += 1
+
+            node = [None, None, key, value, size,
+                    now() + self.ttl if self.ttl is not None else None,
+                    old[FREQ] if old is not None else 1]
+            self.__entries[key] = node
+            self.__link(node)
+            self.bytes += size
+            return True
+
+    __setitem__ = put
+
+    def pop(self, key, default=None):
+        """Removes key, returning its value (or default)"""
+        with self._lock:
+            node = self.__entries.get(key)
+            if node is None:
+                return default
+            self.__remove(node)
+            if self.__expired(node):
+                self.expirations += 1
+                return default
+            return node[VALUE]
+
+    def clear(self):
+        with self._lock:
+            self.__entries.clear()
+            self.__lists.clear()
+            self.__min_freq = None
+            self.bytes = 0
+
+
+def memoize(cache=None, key=None, **cache_kwargs):
+    """Decorator that caches the results of a function by its arguments
+    in cache (a new Cache built with cache_kwargs if not provided),
+    available as the attribute cache of the function.
+
+    Arguments must be hashable, unless key is provided: it is called
+    with the arguments of the function and returns the key of the
+    result. Concurrent calls with the same arguments might all compute
+    the result.
+    """
+    if cache is None:
+        cache = Cache(**cache_kwargs)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if key is not None:
+                cache_key = key(*args, **kwargs)
+            elif kwargs:
+                cache_key = args + tuple(sorted(kwargs.iteritems()))
+            else:
+                cache_key = args
+
+            value = cache.get(cache_key, _MISSING)
+            if value is _MISSING:
+                value = func(*args, **kwargs)
+                cache.put(cache_key, value)
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+def key_digest(obj):
+    """md5 of the pickle of obj; equal objects built in different ways
+    (e.g., sharing some of their items or not) might have different
+    digests, never the other way around"""
+    return hashlib.md5(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+
+class DiskCache(object):
+    """Cache of picklable values stored as files in directory path,
+    which can be shared by processes.
+
+    Each entry is written to a temporary file that is renamed in place,
+    so readers never see partial entries. If max_bytes is set, the
+    least recently used entries (by modification time, refreshed on
+    every hit) are removed once the files take more than max_bytes,
+    until they take less than low_water * max_bytes. Keys are digests
+    of namespace and of the pickle of the key (see key_digest). The
+    interface is the same as Cache.
+    """
+
+    suffix = '.pkl'
+
+    def __init__(self, path, max_bytes=None, namespace='', low_water=0.9):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.low_water = low_water
+        mkdir_p(path)
+
+        self._lock = Lock()
+        # size of the entries, known after the first scan of path and
+        # then kept up to date with the entries written by this process
+        self.bytes = None
+        self.hits = self.misses = self.writes = self.evictions = 0
+
+    def __repr__(self):
+        return '<DiskCache "{}">'.format(self.path)
+
+    def __len__(self):
+        return len(self.__scan())
+
+    def entry_path(self, key):
+        digest = hashlib.md5('{}\0{}'.format(
+            self.namespace, key_digest(key))).hexdigest()
+        return os.path.join(self.path, digest[:2], digest + self.suffix)
+
+    @property
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'bytes': self.bytes, 'hits': self.hits,
+                    'misses': self.misses, 'writes': self.writes,
+                    'evictions': self.evictions,
+                    'hit_rate': (float(self.hits) / lookups
+                                 if lookups else 0.0)}
+
+    def __count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key, default=None):
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.__count('misses')
+            return default
+        except (EOFError, pickle.UnpicklingError, ValueError, TypeError,
+                AttributeError, ImportError, IndexError, KeyError):
+            # truncated or corrupt entry (e.g., disk full while writing
+            # or pickled by an incompatible version of the code)
+            self.__discard(path)
+            self.__count('misses')
+            return default
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            # removed by another process in the meantime
+            pass
+        self.__count('hits')
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return os.path.exists(self.entry_path(key))
+
+    def __discard(self, path):
+        """Removes the entry in path, if any, from disk and from bytes"""
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+        except OSError:
+            # already removed by another process
+            return
+        with self._lock:
+            if self.bytes is not None:
+                self.bytes -= size
+
+    def put(self, key, value):
+        """Stores value under key; returns False if it is larger than
+        max_bytes"""
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            return False
+
+        path = self.entry_path(key)
+        directory = os.path.dirname(path)
+        mkdir_p(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # size of the entry being replaced, if any
+            try:
+                old_size = os.stat(path).st_size
+            except OSError:
+                old_size = 0
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self.writes += 1
+            if self.bytes is not None:
+                self.bytes += len(data) - old_size
+            evict = self.max_bytes is not None and (
+                self.bytes is None or self.bytes > self.max_bytes)
+        if evict:
+            self.evict()
+        return True
+
+    __setitem__ = put
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self.__discard(self.entry_path(key))
+        return value
+
+    def __scan(self):
+        """(mtime, size, path) of the entries in the cache"""
+        entries = []
+        for directory, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if not filename.endswith(self.suffix):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """Removes the least recently used entries if they take more
+        than max_bytes"""
+        entries = self.__scan()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        if self.max_bytes is not None and total > self.max_bytes:
+            entries.sort()
+            target = self.low_water * self.max_bytes
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    evicted += 1
+                except OSError:
+                    # already removed by another process
+                    pass
+                total -= size
+
+        with self._lock:
+            self.bytes = total
+            self.evictions += evicted
+        return evicted
+
+    def clear(self):
+        for _, _, path in self.__scan():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self.bytes = 0
+
+
+def disk_memoize(path, include=None, ignore=None, max_bytes=None):
+    """Decorator that stores the results of a method of an object with
+    a config (as for utils.config.generate_config_cache_comment) in a
+    DiskCache in path, available as the attribute cache of the method.
+
+    Results are keyed by the name of the method, the fingerprint of the
+    keys of the config in include and not in ignore (see
+    utils.config.config_fingerprint) and the arguments, so they are
+    reused across runs with the same configuration and computed again
+    when it changes. Arguments and results must be picklable.
+    """
+    cache = DiskCache(path, max_bytes=max_bytes)
+
+    def decorator(method):
+        name = '{}.{}'.format(method.__module__, method.__name__)
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            key = (name, config_fingerprint(self.config, include, ignore),
+                   args, sorted(kwargs.iteritems()))
+            value = cache.get(key, _MISSING)
+            if value is _MISSING:
+                value = method(self, *args, **kwargs)
+                cache.put(key, value)
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
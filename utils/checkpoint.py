@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  durable progress of imports, so that they can be resumed
+
+# default modules
+import os
+import json
+import glob
+import tempfile
+
+# installed modules
+# no modules
+
+# project modules
+from utils.common import mkdir_p
+from utils.compressed_input import input_stat
+
+
+def write_json_durably(obj, path):
+    """Writes obj to path through a temporary file that is flushed to
+    disk and renamed, so that path is always either the old or the new
+    content, even if the machine crashes"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+class ImportCheckpoint(object):
+    """Progress of an import of MRCONSO, kept in path.
+
+    path holds the index being loaded, the MRCONSO file (with its size
+    and modification time, so that a checkpoint is not used with a
+    different file) and the byte ranges the file was split in. The
+    progress of each range is kept in its own file, path.<start>, as
+    the offset where reading must start again and the number of
+    documents indexed so far; separate files let the workers of a
+    parallel import update their progress without coordinating.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def __progress_path(self, start):
+        return '{}.{}'.format(self.path, start)
+
+    def start(self, index, mrconso_path, ranges):
+        """Starts a new checkpoint, discarding any previous one"""
+        self.clear()
+        mkdir_p(os.path.dirname(os.path.abspath(self.path)))
+        size, mtime = input_stat(mrconso_path)
+        self.meta = {'index': index,
+                     'mrconso_path': os.path.abspath(mrconso_path),
+                     'size': size, 'mtime': mtime,
+                     'ranges': [list(rng) for rng in ranges]}
+        write_json_durably(self.meta, self.path)
+        return self.meta
+
+    def load(self, mrconso_path):
+        """Reads the checkpoint, checking that it was made for the
+        current content of mrconso_path"""
+        if not self.exists():
+            raise IOError('no checkpoint to resume from in "{}"'
+                          ''.format(self.path))
+        with open(self.path) as f:
+            meta = json.load(f)
+
+        size, mtime = input_stat(mrconso_path)
+        if (meta['mrconso_path'] != os.path.abspath(mrconso_path) or
+                meta['size'] != size or meta['mtime'] != mtime):
+            raise ValueError('checkpoint "{}" was made for another version '
+                             'of "{}"'.format(self.path, mrconso_path))
+        self.meta = meta
+        return meta
+
+    def progress(self, start):
+        """Tuple (offset, docs) of the range beginning at start"""
+        try:
+            with open(self.__progress_path(start)) as f:
+                progress = json.load(f)
+        except IOError:
+            return start, 0
+        return progress['offset'], progress['docs']
+
+    def update(self, start, offset, docs):
+        """Records that the range beginning at start was indexed up to
+        byte offset, for a total of docs documents"""
+        write_json_durably({'offset': offset, 'docs': docs},
+                           self.__progress_path(start))
+
+    def clear(self):
+        """Removes the checkpoint and the progress of its ranges"""
+        for path in glob.glob(self.__progress_path('*')) + [self.path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.meta = None
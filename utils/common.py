@@ -180,7 +180,8 @@ def process_call(cmd):
 
 
 class LimitedSizeDict(OrderedDict):
-    """ Size-bounded dicitonary with LRU policy.
+    """ Size-bounded dicitonary that evicts the oldest keys first
+        (reads do not refresh keys; see utils.cache.Cache for LRU).
         From http://stackoverflow.com/questions/2437617
     """
     def __init__(self, *args, **kwargs):
@@ -258,34 +259,40 @@ def pairwise(iterable):
 
 
 
+def format_elapsed(elapsed):
+    """Formats elapsed seconds as "hh:mm:ss.ss" if longer than an hour,
+    "mm:ss.ss" if longer than a minute, and "s.sss s" otherwise"""
+    if elapsed > 3600:
+        return '{:02.0f}:{:02.0f}:{:05.2f}'.format(elapsed // 3600,
+                                                  (elapsed % 3600) // 60,
+                                                  elapsed % 60)
+    elif elapsed > 60:
+        return '{:02.0f}:{:05.2f}'.format((elapsed % 3600) // 60,
+                                          elapsed % 60)
+    return '{:.3f} s'.format(elapsed)
+
+
+def backoff_delay(attempt, initial_backoff, max_backoff):
+    """Seconds to wait before retry number attempt (starting from 1):
+    initial_backoff, doubled at every retry up to max_backoff"""
+    return min(max_backoff, initial_backoff * 2 ** (attempt - 1))
+
+
 def timer(func):
-    """Times function func"""
+    """Times function func; see utils.profiling to aggregate the
+    timings of functions called many times instead"""
     @wraps(func)
     def wrapper(*args, **kwargs):
-        from itertools import tee, izip
         printer = kwargs.pop('printer', print)
         comment = kwargs.pop('comment', '')
-        from itertools import tee, izip
         mthdname = kwargs.pop('mthdname', True)
 
         start = now()
         resp = func(*args, **kwargs)
-        elapsed = now() - start
-        if elapsed > 3600:
-            timestr = ('{:02.0f}:{:02.0f}:{:05.2f}'
-                       '').format(elapsed / 3600,
-                                  (elapsed % 3600) / 60,
-                                  elapsed % 60)
-        elif elapsed > 60:
-            timestr = ('{:02.0f}:{:05.2f}'
-                       '').format((elapsed % 3600) / 60,
-                                  elapsed % 60)
-        else:
-            timestr = ('{:.3f} s'.format(elapsed))
         printer('[timer] %s%s executed in %s' %
                 (func.__name__ if mthdname else '',
                  (' (%s)' % comment if comment else ''),
-                 timestr))
+                 format_elapsed(now() - start)))
         return resp
     return wrapper
 
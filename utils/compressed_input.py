@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  read compressed, archived and split files as one stream
+
+# default modules
+import io
+import os
+import re
+import sys
+import zlib
+import errno
+import zipfile
+import threading
+from Queue import Queue, Full
+
+# installed modules
+# no modules
+
+# project modules
+# no modules
+
+
+COMPRESSED_SUFFIXES = ('.gz', '.zst', '.zip')
+
+# size of the reads from compressed files; decompressed chunks are
+# several times larger
+COMPRESSED_READ_SIZE = 1024 * 1024
+
+# parts of a file split with split(1): "<file>.aa", "<file>.ab", ...;
+# each part can also be compressed on its own
+SPLIT_PART_PATTERN = r'\.[a-z]{{2}}({})?$'.format(
+    '|'.join(re.escape(suffix) for suffix in COMPRESSED_SUFFIXES))
+
+
+def input_parts(filepath):
+    """Files whose content, once decompressed and concatenated, is the
+    content of filepath: filepath itself if it exists, otherwise its
+    split parts (e.g., MRCONSO.RRF.aa.gz, MRCONSO.RRF.ab.gz) in order"""
+    if os.path.exists(filepath):
+        return [filepath]
+
+    dirname, basename = os.path.split(filepath)
+    pattern = re.compile(re.escape(basename) + SPLIT_PART_PATTERN)
+    # "<file>.gz" is a compressed copy of the file, not a part of it
+    parts = sorted(name for name in os.listdir(dirname or '.')
+                   if pattern.match(name) and
+                   name[len(basename):] not in COMPRESSED_SUFFIXES)
+    if not parts:
+        raise IOError(errno.ENOENT, 'No such file or directory', filepath)
+    return [os.path.join(dirname, name) for name in parts]
+
+
+def is_plain_input(filepath):
+    """Whether filepath is an uncompressed file, which can be read at
+    any byte offset"""
+    return (os.path.isfile(filepath) and
+            not filepath.endswith(COMPRESSED_SUFFIXES))
+
+
+def input_stat(filepath):
+    """Tuple (size, mtime) of the files of filepath (see input_parts);
+    size is the total size on disk, not the decompressed one"""
+    stats = [os.stat(part) for part in input_parts(filepath)]
+    return (sum(stat.st_size for stat in stats),
+            max(stat.st_mtime for stat in stats))
+
+
+def _iter_gzip(path, block_size):
+    with open(path, 'rb') as f:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for data in iter(lambda: f.read(COMPRESSED_READ_SIZE), ''):
+            while data:
+                yield decompressor.decompress(data)
+                data = decompressor.unused_data
+                if data:
+                    # files written by more than one gzip process (e.g.,
+                    # concatenated ones) hold a stream per member
+                    yield decompressor.flush()
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        yield decompressor.flush()
+
+
+def _iter_zstd(path, block_size):
+    # optional dependency, only needed to read .zst files
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('the zstandard module is required to read "{}"'
+                          ''.format(path))
+    with open(path, 'rb') as f:
+        for chunk in zstandard.ZstdDecompressor().read_to_iter(
+                f, read_size=COMPRESSED_READ_SIZE, write_size=block_size):
+            yield chunk
+
+
+def _zip_member(path, names):
+    """The only file in the archive, or the one named after it"""
+    if len(names) == 1:
+        return names[0]
+    expected = os.path.basename(path)[:-len('.zip')]
+    matches = [name for name in names
+               if os.path.basename(name) == expected]
+    if len(matches) != 1:
+        raise ValueError('"{}" holds {} files, none of them "{}"'.format(
+            path, len(names), expected))
+    return matches[0]
+
+
+def _iter_zip(path, block_size):
+    with zipfile.ZipFile(path) as archive:
+        names = [name for name in archive.namelist()
+                 if not name.endswith('/')]
+        with archive.open(_zip_member(path, names)) as f:
+            for block in iter(lambda: f.read(block_size), ''):
+                yield block
+
+
+def _iter_plain(path, block_size):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            yield block
+
+
+def iter_part(path, block_size):
+    """Decompressed content of path in chunks of about block_size"""
+    if path.endswith('.gz'):
+        return _iter_gzip(path, block_size)
+    elif path.endswith('.zst'):
+        return _iter_zstd(path, block_size)
+    elif path.endswith('.zip'):
+        return _iter_zip(path, block_size)
+    return _iter_plain(path, block_size)
+
+
+class DecompressingReader(io.RawIOBase):
+    """Raw stream over the decompressed content of parts, concatenated.
+
+    If threaded, parts are decompressed by a thread up to queue_size
+    chunks ahead of the reader, so that decompression (which releases
+    the GIL) overlaps with whatever the reader does with the data.
+    Errors of the thread are raised by the reader.
+    """
+
+    def __init__(self, parts, block_size, threaded=True, queue_size=4):
+        io.RawIOBase.__init__(self)
+        self.parts = parts
+        self.__chunks = (chunk for part in parts
+                         for chunk in iter_part(part, block_size) if chunk)
+        self.__chunk, self.__pos = '', 0
+        self.__done = False
+
+        self.__thread = None
+        if threaded:
+            self.__queue = Queue(queue_size)
+            self.__stop = threading.Event()
+            self.__thread = threading.Thread(target=self.__produce)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def __put(self, item):
+        # gives up if the reader is closed while the queue is full
+        while not self.__stop.is_set():
+            try:
+                self.__queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def __produce(self):
+        try:
+            for chunk in self.__chunks:
+                if not self.__put(('data', chunk)):
+                    return
+            self.__put(('end', None))
+        except Exception:
+            self.__put(('error', sys.exc_info()))
+
+    def __next_chunk(self):
+        if self.__thread is None:
+            return next(self.__chunks, None)
+        kind, value = self.__queue.get()
+        if kind == 'error':
+            raise value[0], value[1], value[2]
+        return value if kind == 'data' else None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.__pos >= len(self.__chunk):
+            chunk = None if self.__done else self.__next_chunk()
+            if chunk is None:
+                self.__done = True
+                return 0
+            self.__chunk, self.__pos = chunk, 0
+
+        n = min(len(b), len(self.__chunk) - self.__pos)
+        b[:n] = memoryview(self.__chunk)[self.__pos:self.__pos + n]
+        self.__pos += n
+        return n
+
+    def close(self):
+        if self.__thread is not None and not self.closed:
+            self.__stop.set()
+            self.__thread.join()
+        io.RawIOBase.close(self)
+
+
+def open_input(filepath, start=0, block_size=io.DEFAULT_BUFFER_SIZE,
+               threaded=True):
+    """Opens filepath for reading in binary mode, positioned at byte
+    start of its content.
+
+    Files ending in .gz, .zst (requires the zstandard module) or .zip
+    (holding a single file, or one named like the archive without .zip)
+    are decompressed while they are read; if filepath does not exist,
+    its parts (see input_parts) are read as one file. Compressed inputs
+    can not seek, so the first start bytes are read and discarded.
+    """
+    if is_plain_input(filepath):
+        f = open(filepath, 'rb')
+        f.seek(start)
+        return f
+
+    f = io.BufferedReader(DecompressingReader(input_parts(filepath),
+                                              block_size, threaded),
+                          block_size)
+    while start > 0:
+        skipped = len(f.read(min(start, block_size)))
+        if not skipped:
+            break
+        start -= skipped
+    return f
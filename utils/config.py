@@ -24,41 +24,47 @@ from copy import deepcopy
 from utils import commentjson as json
 
 
+def config_fingerprint(config, include=None, ignore=None):
+    """md5 of the keys of config in include (all if None) and not in
+    ignore, the same used for cache comments.
+
+    Fingerprints are remembered by config until any of its values is
+    changed, so that they can be computed at every call of a method.
+    """
+    memo_key = (tuple(include) if include is not None else None,
+                tuple(ignore) if ignore is not None else ())
+    fingerprints = config.__dict__.setdefault('_fingerprints', {})
+    if memo_key not in fingerprints:
+        if include is None and ignore is None:
+            data = repr(config)
+        else:
+            keys = [k for k in config.keys()
+                    if (include is None or k in include) and
+                    (ignore is None or k not in ignore)]
+            # same as repr(config) once the other keys are removed
+            data = '{{{}}}'.format(', '.join(
+                '{}: {}'.format(repr(k), repr(config[k]))
+                for k in sorted(keys)))
+        fingerprints[memo_key] = hashlib.md5(json.dumps(data)).hexdigest()
+    return fingerprints[memo_key]
+
+
 def generate_config_cache_comment(ignore=None, include=None):
     """Automatically generate cache comment for a class method based on
     the config file in the cache file"""
 
-    # they are out of scope in the wrapper
-    dec_ignore = ignore
-    dec_include = include
-
     def decorator(method):
         @wraps(method)
         def wrapper(*args, **kwargs):
-
-            config = deepcopy(args[0].config)
-
-            # include all the keys if no include is specified
-            include = config.keys() if dec_include is None else dec_include
-
-            ignore = dec_ignore if dec_ignore is not None else []
-
-            # puts together keys to be removed
-            to_remove = (filter(lambda k: k not in include, config.keys()) +
-                         ignore)
-
-            # removes keys not it include if include != None
-            # and keys in ignore
-            map(lambda k: config.pop(k), to_remove)
-
-            data = hashlib.md5(json.dumps(repr(config))).hexdigest()
-
+            data = config_fingerprint(args[0].config, include=include,
+                                      ignore=ignore)
             kwargs['cache_comment'] = kwargs.pop('cache_comment', '') + data
 
             return method(*args, **kwargs)
         return wrapper
     return decorator
 
+
 class BaseConfig(object):
     def __init__(self, current, default=None, parent=None):
 
@@ -80,10 +86,22 @@ class BaseConfig(object):
     def parent(self):
         return self.__parent
 
+    def _changed(self):
+        """Forgets the fingerprints of this configuration and of those
+        that contain it"""
+        config = self
+        while config is not None:
+            config.__dict__.pop('_fingerprints', None)
+            # not set yet while a copy is being built
+            config = config.__dict__.get('_BaseConfig__parent')
+
+    def _adopt(self, value):
+        if isinstance(value, BaseConfig):
+            value._BaseConfig__parent = self
+        return value
 
     def __hash__(self):
-        data = json.dumps(eval(self.__repr__()))
-        return int(hashlib.md5(data).hexdigest(), 16)
+        return int(config_fingerprint(self), 16)
 
     def __eq__(self, other):
         return hash(self) == hash(other)
@@ -110,6 +128,22 @@ class ConfigList(BaseConfig, list):
         self.extend(lst)
 
 
+def _forget_fingerprints(method):
+    def wrapper(self, *args, **kwargs):
+        resp = method(self, *args, **kwargs)
+        self._changed()
+        return resp
+    wrapper.__name__, wrapper.__doc__ = method.__name__, method.__doc__
+    return wrapper
+
+
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__',
+              '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+              'remove', 'reverse', 'sort'):
+    setattr(ConfigList, _name,
+            _forget_fingerprints(getattr(list, _name)))
+
+
 class ConfigDict(BaseConfig):
     def __parse__(self, config_dict):
         for k, v in config_dict.iteritems():
@@ -143,11 +177,26 @@ class ConfigDict(BaseConfig):
         args = [key, default] if default is not None else [key]
         return self.__dict__.get(*args)
 
+    def __setattr__(self, key, value):
+        self.__dict__[key] = value
+        if not key.startswith('_'):
+            self._adopt(value)
+            self._changed()
+
+    def __delattr__(self, key):
+        del self.__dict__[key]
+        self._changed()
+
     def update(self, other):
-        return self.__dict__.update(other)
+        self.__dict__.update(other)
+        for key in other.keys():
+            self._adopt(self.__dict__[key])
+        self._changed()
 
     def pop(self, key):
-        return self.__dict__.pop(key)
+        value = self.__dict__.pop(key)
+        self._changed()
+        return value
 
     def iteritems(self):
         return ((k, v) for k, v in self.__dict__.iteritems()
@@ -200,7 +249,8 @@ def Config(current, default=None):
 def parse_config(default_config):
     ag = ArgumentParser()
     ag.add_argument('-c', '--config', default=default_config)
-    opts = ag.parse_args()
+    # other arguments are left to the script
+    opts, _ = ag.parse_known_args()
 
     try:
         # try to interpret opts.config as a json blob
@@ -5,15 +5,25 @@
 # description:  Tools for elasticsearch api
 
 # default modules
+import base64
+import socket
+import asyncore
+from time import sleep, strftime
+from time import time as now
 from functools import wraps
+from threading import Lock
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 # installed modules
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import expand_action, BulkIndexError
+from elasticsearch.exceptions import TransportError
 from elasticsearch.client import IndicesClient
 
 # project modules
-from utils.common import cls_decorate_all
+from utils.common import cls_decorate_all, backoff_delay, VerbosePrinter
+from utils.metrics import metrics
 
 
 # def connect(host, port, index=None, username=None, password=None):
@@ -44,11 +54,47 @@ def connect(host, port, index=None, username=None, password=None):
 
     return Elasticsearch(**kwargs)
 
+# settings that make indexing cheaper while an index is bulk loaded,
+# and the values elasticsearch uses when they are not set in the mapping
+BULK_LOAD_SETTINGS = {'refresh_interval': -1, 'number_of_replicas': 0}
+DEFAULT_INDEX_SETTINGS = {'refresh_interval': '1s', 'number_of_replicas': 1}
+
+
+def get_index_setting(mapping, key, default=None):
+    """Returns index setting key from the settings of mapping, which can
+    be specified as {"index": {key: ...}}, {"index.key": ...},
+    or {key: ...}."""
+    settings = mapping.get('settings', {})
+    for value in (settings.get('index', {}).get(key),
+                  settings.get('index.{}'.format(key)),
+                  settings.get(key)):
+        if value is not None:
+            return value
+    return default
+
+
+def versioned_index_name(alias):
+    """Name of a new index to be exposed under alias"""
+    return '{}_{}'.format(alias, strftime('%Y%m%d%H%M%S'))
+
+
 def create_index(index, mapping,
-                 host, port, username=None, password=None):
+                 host, port, username=None, password=None, bulk_load=False):
+    """Creates index with mapping, asking whether to overwrite it if
+    it already exists. If bulk_load, the index is created without
+    replicas and refreshes (see finish_bulk_load)."""
     es = connect(host, port, username=username, password=password)
     ic = IndicesClient(es)
 
+    if bulk_load:
+        mapping = dict(mapping)
+        settings = mapping['settings'] = dict(mapping.get('settings', {}))
+        for key in BULK_LOAD_SETTINGS:
+            settings.pop('index.{}'.format(key), None)
+            settings.pop(key, None)
+        settings['index'] = dict(settings.get('index', {}),
+                                 **BULK_LOAD_SETTINGS)
+
     create = True
     if ic.exists(index):
         resp = None
@@ -65,6 +111,616 @@ def create_index(index, mapping,
         ic.create(index=index, body=mapping)
 
 
-def bulk_create(client, docs, chunk_size=1000):
-    resp = bulk(client, docs, chunk_size=chunk_size)
-    return resp[0]
+def finish_bulk_load(client, index, mapping, force_merge=True,
+                     max_num_segments=None):
+    """Restores the refresh interval and replicas of an index created
+    with create_index(bulk_load=True) to the values in mapping (or to
+    the defaults of elasticsearch), refreshes it and optionally
+    force-merges it to max_num_segments segments."""
+    ic = IndicesClient(client)
+
+    settings = {key: get_index_setting(mapping, key, default)
+                for key, default in DEFAULT_INDEX_SETTINGS.iteritems()}
+    ic.put_settings(index=index, body={'index': settings})
+    ic.refresh(index=index)
+
+    if force_merge:
+        params = {}
+        if max_num_segments is not None:
+            params['max_num_segments'] = max_num_segments
+        ic.forcemerge(index=index, **params)
+
+
+def check_alias(client, alias):
+    """Raises ValueError if alias is the name of an index, which would
+    keep swap_alias from pointing it to a new index; meant to be called
+    before loading into versioned indices rather than after"""
+    ic = IndicesClient(client)
+    if ic.exists(alias) and not ic.exists_alias(name=alias):
+        raise ValueError('"{}" is an index, not an alias; delete it '
+                         'before loading into versioned indices'
+                         ''.format(alias))
+
+
+def swap_alias(client, alias, index, delete_old=False):
+    """Atomically points alias to index, removing it from the indices it
+    pointed to before; these indices are deleted if delete_old.
+
+    Returns:
+        old_indices (list): indices alias pointed to before.
+    """
+    check_alias(client, alias)
+
+    ic = IndicesClient(client)
+    if ic.exists_alias(name=alias):
+        old_indices = sorted(ic.get_alias(name=alias).keys())
+    else:
+        old_indices = []
+
+    actions = [{'remove': {'index': old, 'alias': alias}}
+               for old in old_indices if old != index]
+    actions.append({'add': {'index': index, 'alias': alias}})
+    ic.update_aliases(body={'actions': actions})
+
+    old_indices = [old for old in old_indices if old != index]
+    if delete_old:
+        for old in old_indices:
+            ic.delete(index=old)
+
+    return old_indices
+
+
+class AdaptiveChunkSize(object):
+    """Controls the number of documents per bulk request based on the
+    latency and rejection rate measured on the last window requests.
+
+    The chunk size is halved (down to min_chunk_size) if more than
+    max_rejection_rate of the documents sent were rejected or if the mean
+    latency exceeds target_latency; it grows by grow_factor (up to
+    max_chunk_size) if the latency is below half of target_latency.
+    Each decision is printed if verbose and kept in self.decisions.
+    """
+
+    def __init__(self, chunk_size=1000, min_chunk_size=100,
+                 max_chunk_size=10000, target_latency=1.0,
+                 max_rejection_rate=0.01, window=5, grow_factor=1.5,
+                 shrink_factor=0.5, verbose=True):
+        self.chunk_size = max(min_chunk_size, min(max_chunk_size,
+                                                  chunk_size))
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_latency = target_latency
+        self.max_rejection_rate = max_rejection_rate
+        self.window = window
+        self.grow_factor = grow_factor
+        self.shrink_factor = shrink_factor
+
+        self.decisions = []
+        self.__printer = VerbosePrinter(enabled=verbose, prefix='adaptive')
+        self.__lock = Lock()
+        self.__observed = []
+
+    def observe(self, docs, size, latency, rejected):
+        """Records a bulk request of docs documents (size bytes) that
+        took latency seconds and in which rejected documents were
+        rejected with HTTP 429"""
+        with self.__lock:
+            self.__observed.append((docs, size, latency, rejected))
+            if len(self.__observed) >= self.window:
+                self.__decide()
+
+    def __decide(self):
+        docs = sum(obs[0] for obs in self.__observed)
+        size = sum(obs[1] for obs in self.__observed)
+        latency = (sum(obs[2] for obs in self.__observed) /
+                   len(self.__observed))
+        rejection_rate = (float(sum(obs[3] for obs in self.__observed)) /
+                          max(docs, 1))
+        self.__observed = []
+
+        current = self.chunk_size
+        if (rejection_rate > self.max_rejection_rate or
+                latency > self.target_latency):
+            new = max(self.min_chunk_size,
+                      int(current * self.shrink_factor))
+        elif latency < self.target_latency / 2:
+            new = min(self.max_chunk_size,
+                      int(current * self.grow_factor))
+        else:
+            new = current
+
+        if new != current:
+            decision = {'from': current, 'to': new, 'latency': latency,
+                        'rejection_rate': rejection_rate,
+                        'bytes_per_doc': float(size) / max(docs, 1)}
+            self.decisions.append(decision)
+            self.__printer('chunk size {from} -> {to} (mean latency '
+                           '{latency:.3f} s, {rejection_rate:.1%} rejected, '
+                           '{bytes_per_doc:.0f} bytes/doc)'
+                           ''.format(**decision))
+        self.chunk_size = new
+
+
+def chunk_actions(docs, chunk_size, serializer, max_chunk_bytes=None):
+    """Expands and serializes docs, grouping them in chunks of at most
+    chunk_size items and max_chunk_bytes bytes (a single document larger
+    than max_chunk_bytes is sent by itself). chunk_size can either be
+    an int or an object whose attribute chunk_size is read at the
+    beginning of every chunk. Each item is a tuple (op_type, lines),
+    where lines are UTF-8 encoded, so that their length is the number
+    of bytes they take in the request."""
+    if isinstance(chunk_size, AdaptiveChunkSize):
+        controller, chunk_size = chunk_size, chunk_size.chunk_size
+    else:
+        controller = None
+
+    # time spent serializing is only measured if metrics are enabled
+    timed = metrics.enabled
+    chunk, chunk_bytes, elapsed = [], 0, 0.0
+    for doc in docs:
+        if timed:
+            start = now()
+        action, data = expand_action(doc)
+        lines = [_encode(serializer.dumps(action))]
+        if data is not None:
+            lines.append(_encode(serializer.dumps(data)))
+        item_bytes = sum(len(ln) + 1 for ln in lines)
+        if timed:
+            elapsed += now() - start
+
+        if (max_chunk_bytes is not None and chunk and
+                chunk_bytes + item_bytes > max_chunk_bytes):
+            _observe_serialized(chunk, chunk_bytes, elapsed)
+            yield chunk
+            chunk, chunk_bytes, elapsed = [], 0, 0.0
+            if controller is not None:
+                chunk_size = controller.chunk_size
+
+        chunk.append((next(iter(action)), lines))
+        chunk_bytes += item_bytes
+
+        if len(chunk) >= chunk_size:
+            _observe_serialized(chunk, chunk_bytes, elapsed)
+            yield chunk
+            chunk, chunk_bytes, elapsed = [], 0, 0.0
+            if controller is not None:
+                chunk_size = controller.chunk_size
+    if chunk:
+        _observe_serialized(chunk, chunk_bytes, elapsed)
+        yield chunk
+
+
+def _observe_serialized(chunk, chunk_bytes, elapsed):
+    metrics.counter('serialize_docs_total').inc(len(chunk))
+    metrics.counter('serialize_bytes_total').inc(chunk_bytes)
+    metrics.counter('serialize_seconds_total').inc(elapsed)
+
+
+def _encode(line):
+    # JSONSerializer returns unicode if the document has non-ASCII text
+    return line.encode('utf-8') if isinstance(line, unicode) else line
+
+
+def bulk_body(chunk):
+    """Body of a bulk request with the items of chunk (see
+    chunk_actions), as UTF-8 encoded bytes"""
+    return '\n'.join(ln for _, lines in chunk for ln in lines) + '\n'
+
+
+def _observe_request(observer, docs, size, latency, rejected):
+    """Records a bulk request in the metrics and reports it to
+    observer, if provided"""
+    metrics.counter('bulk_requests_total').inc()
+    metrics.counter('bulk_request_bytes_total').inc(size)
+    metrics.histogram('bulk_request_seconds').observe(latency)
+    if rejected:
+        metrics.counter('bulk_rejected_docs_total').inc(rejected)
+    if observer is not None:
+        observer.observe(docs, size, latency, rejected)
+
+
+def process_bulk_response(chunk, resp, retry):
+    """Splits the items of a bulk response in successes, errors, and
+    items to send again because they were rejected (status 429); also
+    returns the number of rejected items, whether retried or not."""
+    successes, errors, rejected, throttled = 0, [], [], 0
+    for item, resp_item in zip(chunk, resp['items']):
+        op_type, info = resp_item.popitem()
+        status = info.get('status', 500)
+        # deleting a document that is not there leaves the index as
+        # intended
+        if 200 <= status < 300 or (op_type == 'delete' and status == 404):
+            successes += 1
+            continue
+
+        throttled += status == 429
+        if status == 429 and retry:
+            rejected.append(item)
+        else:
+            errors.append({op_type: info})
+    return successes, errors, rejected, throttled
+
+
+def _send_chunk(client, chunk, max_retries, initial_backoff, max_backoff,
+                observer=None, **kwargs):
+    """Sends one chunk with a blocking bulk request; requests and items
+    rejected with HTTP 429 are retried with exponential backoff. Each
+    request is reported to observer, if provided."""
+    successes, errors = 0, []
+    for attempt in xrange(max_retries + 1):
+        if attempt > 0:
+            backoff = backoff_delay(attempt, initial_backoff, max_backoff)
+            metrics.counter('bulk_retries_total').inc()
+            metrics.counter('bulk_backoff_seconds_total').inc(backoff)
+            sleep(backoff)
+        retry = attempt < max_retries
+        body = bulk_body(chunk)
+        in_flight = metrics.gauge('bulk_in_flight')
+        in_flight.inc()
+        start = now()
+        try:
+            # the client appends a unicode newline to the body if missing,
+            # which fails on non-ASCII bytes
+            resp = client.bulk(body=body.decode('utf-8'), **kwargs)
+        except TransportError as e:
+            if e.status_code != 429:
+                raise
+            _observe_request(observer, len(chunk), len(body),
+                             now() - start, len(chunk))
+            if retry:
+                continue
+            raise
+        finally:
+            in_flight.dec()
+
+        ok, failed, chunk, throttled = process_bulk_response(chunk, resp,
+                                                             retry)
+        _observe_request(observer, len(resp['items']), len(body),
+                         now() - start, throttled)
+        successes += ok
+        errors.extend(failed)
+        if not chunk:
+            break
+    return successes, errors
+
+
+def _serial_backend(client, chunks, send_kwargs, max_in_flight=None,
+                    **kwargs):
+    """One bulk request at the time; max_in_flight is ignored. Like the
+    other backends, yields tuples (seq, successes, errors) where seq is
+    the position of the chunk in chunks."""
+    for seq, chunk in enumerate(chunks):
+        yield (seq, ) + _send_chunk(client, chunk,
+                                    **dict(send_kwargs, **kwargs))
+
+
+def _threaded_backend(client, chunks, send_kwargs, max_in_flight=4,
+                      **kwargs):
+    """Up to max_in_flight blocking bulk requests, each in its own
+    thread; results are returned in the same order as chunks"""
+    pool = ThreadPool(max_in_flight)
+    pending = deque()
+    send_kwargs = dict(send_kwargs, **kwargs)
+    try:
+        for seq, chunk in enumerate(chunks):
+            pending.append((seq, pool.apply_async(
+                _send_chunk, (client, chunk), send_kwargs)))
+            while len(pending) >= max_in_flight:
+                seq, result = pending.popleft()
+                yield (seq, ) + result.get()
+        while pending:
+            seq, result = pending.popleft()
+            yield (seq, ) + result.get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+class _BulkConnection(asyncore.dispatcher):
+    """Non-blocking HTTP connection that sends one bulk request at the
+    time to path and hands parsed responses to on_response"""
+
+    def __init__(self, host, port, path, headers, on_response, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.path = path
+        self.headers = headers
+        self.on_response = on_response
+        self.task = None
+        self.sent_at = self.sent_bytes = None
+        self.closed = False
+        self.__outbuf = ''
+        self.__inbuf = ''
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+
+    def request(self, task, body):
+        self.task = task
+        self.sent_at = now()
+        self.sent_bytes = len(body)
+        self.__outbuf = ('POST {} HTTP/1.1\r\n{}Content-Length: {}'
+                         '\r\n\r\n{}'.format(self.path, self.headers,
+                                              len(body), body))
+
+    def writable(self):
+        return len(self.__outbuf) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.__outbuf)
+        self.__outbuf = self.__outbuf[sent:]
+
+    def handle_read(self):
+        self.__inbuf += self.recv(65536)
+        resp = self.__parse_response()
+        if resp is not None:
+            task, self.task = self.task, None
+            self.on_response(self, task, *resp)
+
+    def handle_close(self):
+        self.close()
+        self.closed = True
+        if self.task is not None:
+            raise IOError('connection closed by elasticsearch')
+
+    def handle_error(self):
+        self.close()
+        self.closed = True
+        raise
+
+    def __parse_response(self):
+        head_end = self.__inbuf.find('\r\n\r\n')
+        if head_end < 0:
+            return None
+        head = self.__inbuf[:head_end].split('\r\n')
+        status = int(head[0].split(' ')[1])
+        headers = dict((k.strip().lower(), v.strip()) for k, v in
+                       (ln.split(':', 1) for ln in head[1:]))
+        rest = self.__inbuf[head_end + 4:]
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body, pos = [], 0
+            while True:
+                size_end = rest.find('\r\n', pos)
+                if size_end < 0:
+                    return None
+                size = int(rest[pos:size_end].split(';')[0], 16)
+                if len(rest) < size_end + 2 + size + 2:
+                    return None
+                body.append(rest[size_end + 2:size_end + 2 + size])
+                pos = size_end + 2 + size + 2
+                if size == 0:
+                    break
+            body, self.__inbuf = ''.join(body), rest[pos:]
+        else:
+            length = int(headers.get('content-length', 0))
+            if len(rest) < length:
+                return None
+            body, self.__inbuf = rest[:length], rest[length:]
+
+        return status, body
+
+
+def _async_backend(client, chunks, send_kwargs, max_in_flight=4,
+                   **kwargs):
+    """Up to max_in_flight bulk requests multiplexed on a single thread
+    by an asyncore event loop; results are returned as soon as requests
+    complete, not necessarily in the same order as chunks. Requests are
+    sent over plain HTTP to the first host of client (and its
+    url_prefix, if any); hosts that require TLS are rejected."""
+    if kwargs:
+        raise TypeError('the async backend does not support bulk '
+                        'parameters {}'.format(', '.join(kwargs)))
+
+    max_retries = send_kwargs['max_retries']
+    initial_backoff = send_kwargs['initial_backoff']
+    max_backoff = send_kwargs['max_backoff']
+    observer = send_kwargs.get('observer')
+
+    # connection parameters can either be per host or for all hosts
+    host = dict(client.transport.kwargs, **client.transport.hosts[0])
+    host.setdefault('host', 'localhost')
+    host.setdefault('port', 9200)
+    if host.get('use_ssl') or host.get('scheme') == 'https':
+        # the event loop speaks plain HTTP only
+        raise ValueError('the async backend does not support TLS; use the '
+                         'threaded backend to connect to {}:{}'.format(
+                             host['host'], host['port']))
+    url_prefix = host.get('url_prefix', '').strip('/')
+    path = '/{}/_bulk'.format(url_prefix) if url_prefix else '/_bulk'
+    headers = 'Host: {}:{}\r\nContent-Type: application/json\r\n'.format(
+        host['host'], host['port'])
+    http_auth = host.get('http_auth')
+    if http_auth is not None:
+        if isinstance(http_auth, (tuple, list)):
+            http_auth = ':'.join(http_auth)
+        headers += 'Authorization: Basic {}\r\n'.format(
+            base64.b64encode(http_auth))
+
+    socket_map = {}
+    idle = []           # connections without a request
+    delayed = []        # (time, task) to retry after backoff
+    completed = deque()
+    state = {'in_flight': 0}
+
+    in_flight = metrics.gauge('bulk_in_flight')
+
+    def submit(conn, task):
+        seq, chunk, attempt, _, _ = task
+        if attempt > 0:
+            metrics.counter('bulk_retries_total').inc()
+        in_flight.inc()
+        conn.request(task, bulk_body(chunk))
+
+    def on_response(conn, task, status, body):
+        seq, chunk, attempt, successes, errors = task
+        in_flight.dec()
+        retry = attempt < max_retries
+        if status == 429:
+            _observe_request(observer, len(chunk), conn.sent_bytes,
+                             now() - conn.sent_at, len(chunk))
+            if not retry:
+                raise TransportError(status, body)
+            rejected = chunk
+        elif status >= 300:
+            raise TransportError(status, body)
+        else:
+            resp = client.transport.serializer.loads(body)
+            ok, failed, rejected, throttled = process_bulk_response(
+                chunk, resp, retry)
+            _observe_request(observer, len(chunk), conn.sent_bytes,
+                             now() - conn.sent_at, throttled)
+            successes += ok
+            errors = errors + failed
+
+        if rejected:
+            backoff = backoff_delay(attempt + 1, initial_backoff, max_backoff)
+            metrics.counter('bulk_backoff_seconds_total').inc(backoff)
+            delayed.append((now() + backoff,
+                            (seq, rejected, attempt + 1, successes,
+                             errors)))
+        else:
+            completed.append((seq, successes, errors))
+            state['in_flight'] -= 1
+        idle.append(conn)
+
+    def get_connection():
+        while idle:
+            conn = idle.pop()
+            if not conn.closed:
+                return conn
+        return _BulkConnection(host['host'], host['port'], path,
+                               headers, on_response, socket_map)
+
+    chunks = enumerate(chunks)
+    exhausted = False
+    try:
+        while True:
+            # first resubmit rejected chunks whose backoff has expired
+            current = now()
+            for item in [d for d in delayed if d[0] <= current]:
+                delayed.remove(item)
+                submit(get_connection(), item[1])
+
+            while not exhausted and state['in_flight'] < max_in_flight:
+                try:
+                    seq, chunk = next(chunks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                state['in_flight'] += 1
+                submit(get_connection(), (seq, chunk, 0, 0, []))
+
+            while completed:
+                yield completed.popleft()
+
+            if exhausted and state['in_flight'] == 0:
+                break
+
+            if socket_map:
+                asyncore.loop(timeout=0.05, map=socket_map, count=1)
+            else:
+                sleep(0.05)
+    finally:
+        asyncore.close_all(map=socket_map)
+
+
+BULK_BACKENDS = {
+    'serial': _serial_backend,
+    'threaded': _threaded_backend,
+    'async': _async_backend
+}
+
+
+def bulk_create(client, docs, chunk_size=1000, backend='serial',
+                max_retries=3, initial_backoff=2, max_backoff=600,
+                max_chunk_bytes=None, adaptive=None, on_progress=None,
+                **kwargs):
+    """Indexes docs in chunks of chunk_size documents.
+
+    Args:
+        client (Elasticsearch): client to send the requests with
+        docs (iterable): bulk actions, as accepted by elasticsearch.helpers
+        chunk_size (int, default=1000): documents per bulk request
+        max_chunk_bytes (int, default=None): if provided, bulk requests
+            are also limited to max_chunk_bytes bytes
+        adaptive (dict or AdaptiveChunkSize, default=None): if provided,
+            chunk_size is adjusted by an AdaptiveChunkSize controller
+            (built with options adaptive if a dict) based on the
+            latency and rejections of the bulk requests. A dict with
+            key "enabled" set to false disables the controller.
+        backend (str, default='serial'): one of BULK_BACKENDS; 'serial'
+            sends one request at the time, 'threaded' and 'async' keep
+            up to max_in_flight requests in flight using threads or
+            an event loop respectively.
+        max_retries (int, default=3): number of times requests or
+            documents rejected with HTTP 429 are sent again
+        initial_backoff (float, default=2): seconds to wait before the
+            first retry; the wait doubles at every retry up to
+            max_backoff seconds.
+        on_progress (callable, default=None): called with the number n
+            of documents acknowledged after each chunk, once all of the
+            first n documents of docs have been indexed (chunks may
+            complete out of order with the async backend).
+        **kwargs: options of the backend (e.g., max_in_flight) or
+            parameters of the bulk request.
+
+    Returns:
+        successes (int): number of documents indexed.
+
+    Raises:
+        BulkIndexError: as soon as some documents fail to index.
+    """
+    try:
+        backend_func = BULK_BACKENDS[backend]
+    except KeyError:
+        raise ValueError('unknown bulk backend "{}"; options are: {}'
+                         ''.format(backend, ', '.join(BULK_BACKENDS)))
+
+    if adaptive is not None and not isinstance(adaptive, AdaptiveChunkSize):
+        adaptive = dict(adaptive)
+        if adaptive.pop('enabled', True):
+            adaptive = AdaptiveChunkSize(chunk_size, **adaptive)
+        else:
+            adaptive = None
+
+    send_kwargs = {'max_retries': max_retries,
+                   'initial_backoff': initial_backoff,
+                   'max_backoff': max_backoff,
+                   'observer': adaptive}
+    chunks = chunk_actions(docs, adaptive or chunk_size,
+                            client.transport.serializer, max_chunk_bytes)
+
+    # sizes of the chunks handed to the backend, to know how many of
+    # the first documents are acknowledged when a chunk completes
+    sizes = []
+    if on_progress is not None:
+        chunks = (sizes.append(len(chunk)) or chunk for chunk in chunks)
+    completed, next_seq, acknowledged = set(), 0, 0
+
+    total = 0
+    results = backend_func(client, chunks, send_kwargs, **kwargs)
+    try:
+        for seq, successes, errors in results:
+            total += successes
+            metrics.counter('bulk_indexed_docs_total').inc(successes)
+            if errors:
+                metrics.counter('bulk_failed_docs_total').inc(len(errors))
+                raise BulkIndexError('{} document(s) failed to index.'
+                                     ''.format(len(errors)), errors)
+
+            if on_progress is not None:
+                completed.add(seq)
+                while next_seq in completed:
+                    completed.remove(next_seq)
+                    acknowledged += sizes[next_seq]
+                    next_seq += 1
+                on_progress(acknowledged)
+    finally:
+        results.close()
+
+    return total
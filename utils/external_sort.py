@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  sorting of iterables that do not fit in memory
+
+# default modules
+import os
+import heapq
+import shutil
+import marshal
+import tempfile
+from itertools import islice
+
+# installed modules
+# no modules
+
+# project modules
+# no modules
+
+
+# items kept in memory by external_sort before spilling a sorted run
+DEFAULT_BUFFER_SIZE = 1000000
+
+
+def _write_run(items, directory):
+    """Writes items, already sorted, to a new file in directory"""
+    fd, path = tempfile.mkstemp(dir=directory, suffix='.run')
+    with os.fdopen(fd, 'wb') as f:
+        for item in items:
+            marshal.dump(item, f)
+    return path
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                break
+
+
+def external_sort(items, buffer_size=DEFAULT_BUFFER_SIZE, tmp_dir=None):
+    """Sorts items using at most buffer_size of them in memory at the
+    time: sorted runs of buffer_size items are written to temporary
+    files that are then merged. Items are compared as they are (python 2
+    heapq.merge has no key), so tuples with the sort key first work
+    well; they must be serializable with marshal (e.g., tuples of
+    strings and numbers).
+
+    Args:
+        items (iterable): items to sort
+        buffer_size (int, default=DEFAULT_BUFFER_SIZE): items per run
+        tmp_dir (str, default=None): where runs are written; the
+            default temporary directory if not provided
+
+    Returns:
+        items (generator): items in increasing order; the temporary
+            files are removed once the generator is exhausted or closed
+    """
+    items = iter(items)
+    buffer = sorted(islice(items, buffer_size))
+    if len(buffer) < buffer_size:
+        # fits in memory
+        for item in buffer:
+            yield item
+        return
+
+    directory = tempfile.mkdtemp(prefix='external_sort.', dir=tmp_dir)
+    try:
+        runs = [_write_run(buffer, directory)]
+        while True:
+            buffer = sorted(islice(items, buffer_size))
+            if not buffer:
+                break
+            runs.append(_write_run(buffer, directory))
+        del buffer
+
+        for item in heapq.merge(*[_read_run(path) for path in runs]):
+            yield item
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
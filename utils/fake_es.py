@@ -0,0 +1,389 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  In-process fake elasticsearch endpoint for testing
+
+# default modules
+import sys
+import json
+import socket
+import random
+import threading
+from time import sleep
+from collections import namedtuple
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+# installed modules
+# no modules
+
+# project modules
+# no modules
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients closing keep-alive connections are not errors
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def __reply(self, status, body=None):
+        data = json.dumps(body) if body is not None else ''
+
+        # headers and body are written at once
+        self.wfile.write(
+            '{} {} {}\r\nContent-Type: application/json\r\n'
+            'Content-Length: {}\r\n\r\n{}'.format(
+                self.protocol_version, status,
+                self.responses.get(status, ('', ))[0], len(data),
+                data if self.command != 'HEAD' else ''))
+
+    def __dispatch(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else ''
+        path = [p for p in self.path.split('?')[0].split('/') if p]
+        status, resp = self.server.fake.handle(self.command, path, body)
+        self.__reply(status, resp)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = __dispatch
+
+
+class FakeElasticsearch(object):
+    """Fake elasticsearch node that serves the requests issued by the
+    importer (index creation/deletion and bulk indexing) and by
+    utils.matcher (multi search with the umls script) from memory.
+    Searches are scored with src.local_matcher and need store=True.
+
+    Args:
+        host (str, default='127.0.0.1'): address to bind to
+        port (int, default=0): port to bind to; a free port is chosen
+            if 0.
+        reject_rate (float, default=0.0): probability of rejecting a
+            document of a bulk request or a search of a multi search
+            request with status 429
+        reject_request_rate (float, default=0.0): probability of
+            rejecting a whole bulk request with status 429
+        store (bool, default=False): keep the source of the documents
+            indexed instead of only their ids
+        seed (int, default=None): seed for the rejection decisions
+        latency (float, default=0.0): seconds added to every bulk request
+        latency_per_doc (float, default=0.0): seconds added to bulk
+            requests for each document they contain
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, reject_rate=0.0,
+                 reject_request_rate=0.0, store=False, seed=None,
+                 latency=0.0, latency_per_doc=0.0):
+        self.latency = latency
+        self.latency_per_doc = latency_per_doc
+        self.reject_rate = reject_rate
+        self.reject_request_rate = reject_request_rate
+        self.store = store
+        # requests and items draw from different generators, so the
+        # requests rejected do not depend on how threads interleave
+        self.random = random.Random(seed)
+        self.request_random = random.Random(seed)
+
+        self.indices = {}
+        self.aliases = {}
+        self.stats = {'requests': 0, 'bulk_requests': 0, 'items': 0,
+                      'rejected_items': 0, 'rejected_requests': 0,
+                      'msearch_requests': 0, 'searches': 0,
+                      'rejected_searches': 0}
+        self.lock = threading.Lock()
+        self.__matchers = {}
+
+        self.server = _ThreadingHTTPServer((host, port), _FakeHandler)
+        self.server.fake = self
+        self.__thread = None
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.__thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def count(self, index):
+        """Number of documents in index (or in the indices of an alias)"""
+        with self.lock:
+            return sum(len(self.indices[idx]['docs'])
+                       for idx in self.__resolve(index))
+
+    def handle(self, method, path, body):
+        """Returns status and response for a request to path (a list
+        of path components)"""
+        with self.lock:
+            self.stats['requests'] += 1
+
+        if path and path[-1] == '_bulk':
+            return self.bulk(path[0] if len(path) > 1 else None,
+                             path[1] if len(path) > 2 else None, body)
+
+        if path and path[-1] == '_msearch':
+            return self.msearch(path[0] if len(path) > 1 else None,
+                                path[1] if len(path) > 2 else None, body)
+
+        if not path:
+            return 200, {'version': {'number': '5.0.0'},
+                         'tagline': 'You Know, for Search'}
+
+        with self.lock:
+            if path[0] == '_aliases' and method == 'POST':
+                return self.__update_aliases(json.loads(body)['actions'])
+
+            if path[0] == '_alias' and len(path) == 2:
+                name = path[1]
+                if name not in self.aliases:
+                    return 404, None if method == 'HEAD' else {}
+                return 200, {idx: {'aliases': {name: {}}}
+                             for idx in self.aliases[name]}
+
+            index = path[0]
+            resolved = self.__resolve(index)
+
+            if len(path) == 1 and method == 'HEAD':
+                return (200 if resolved else 404), None
+
+            if len(path) == 1 and method == 'PUT':
+                if resolved:
+                    return 400, {'error': {
+                        'type': 'index_already_exists_exception'}}
+                self.indices[index] = {
+                    'body': json.loads(body) if body else {}, 'docs': {},
+                    'settings': {}, 'refreshes': 0, 'force_merges': 0}
+                return 200, {'acknowledged': True}
+
+            if not resolved:
+                return 404, {'error': {'type': 'index_not_found_exception'}}
+
+            if len(path) == 1 and method == 'DELETE':
+                for idx in resolved:
+                    self.indices.pop(idx)
+                    for indices in self.aliases.itervalues():
+                        indices.discard(idx)
+                return 200, {'acknowledged': True}
+
+            if len(path) == 2 and path[1] == '_settings' and method == 'PUT':
+                settings = json.loads(body)
+                for idx in resolved:
+                    self.indices[idx]['settings'].update(
+                        settings.get('index', settings))
+                return 200, {'acknowledged': True}
+
+            if len(path) == 2 and path[1] in ('_refresh', '_forcemerge'):
+                key = ('refreshes' if path[1] == '_refresh'
+                       else 'force_merges')
+                for idx in resolved:
+                    self.indices[idx][key] += 1
+                return 200, {'_shards': {'total': 1, 'successful': 1,
+                                         'failed': 0}}
+
+        return 400, {'error': {'type': 'unsupported_request',
+                               'reason': '{} /{}'.format(method,
+                                                         '/'.join(path))}}
+
+    def __resolve(self, name):
+        """Indices referred to by name, which can be an alias"""
+        if name in self.indices:
+            return [name]
+        return sorted(self.aliases.get(name, []))
+
+    def __update_aliases(self, actions):
+        for action in actions:
+            (op, params), = action.items()
+            if params['index'] not in self.indices:
+                return 404, {'error': {'type': 'index_not_found_exception'}}
+        for action in actions:
+            (op, params), = action.items()
+            indices = self.aliases.setdefault(params['alias'], set())
+            if op == 'add':
+                indices.add(params['index'])
+            else:
+                indices.discard(params['index'])
+            if not indices:
+                self.aliases.pop(params['alias'])
+        return 200, {'acknowledged': True}
+
+    def bulk(self, default_index, default_type, body):
+        with self.lock:
+            self.stats['bulk_requests'] += 1
+            if self.request_random.random() < self.reject_request_rate:
+                self.stats['rejected_requests'] += 1
+                return 429, {'error': {
+                    'type': 'es_rejected_execution_exception'}, 'status': 429}
+
+        lines = [ln for ln in body.split('\n') if ln.strip()]
+        items, errors, pos = [], False, 0
+        while pos < len(lines):
+            action = json.loads(lines[pos])
+            pos += 1
+            op_type, meta = action.popitem()
+            source = None
+            if op_type != 'delete':
+                source = json.loads(lines[pos])
+                pos += 1
+
+            info = {'_index': meta.get('_index', default_index),
+                    '_type': meta.get('_type', default_type),
+                    '_id': meta.get('_id')}
+            info['status'] = self.__apply(op_type, info, source)
+            if info['status'] >= 300:
+                errors = True
+                info['error'] = {'type': ('es_rejected_execution_exception'
+                                          if info['status'] == 429
+                                          else 'document_exception')}
+            items.append({op_type: info})
+
+        delay = self.latency + self.latency_per_doc * len(items)
+        if delay > 0:
+            sleep(delay)
+
+        return 200, {'took': int(delay * 1000), 'errors': errors,
+                     'items': items}
+
+    def __apply(self, op_type, info, source):
+        with self.lock:
+            self.stats['items'] += 1
+            if self.random.random() < self.reject_rate:
+                self.stats['rejected_items'] += 1
+                return 429
+
+            resolved = self.__resolve(info['_index'])
+            if resolved:
+                docs = self.indices[resolved[0]]['docs']
+            else:
+                docs = self.indices.setdefault(info['_index'], {
+                    'body': {}, 'docs': {}, 'settings': {}, 'refreshes': 0,
+                    'force_merges': 0})['docs']
+            _id = info['_id']
+            exists = _id in docs
+
+            if op_type == 'delete':
+                docs.pop(_id, None)
+                return 200 if exists else 404
+            elif op_type == 'create' and exists:
+                return 409
+            elif op_type == 'update':
+                if not exists:
+                    return 404
+                if self.store:
+                    docs[_id].update(source.get('doc', {}))
+                return 200
+
+            docs[_id] = source if self.store else True
+            return 200 if exists else 201
+
+    def msearch(self, default_index, default_type, body):
+        with self.lock:
+            self.stats['msearch_requests'] += 1
+        if not self.store:
+            return 400, {'error': {'type': 'unsupported_request',
+                                   'reason': 'searches need store=True'}}
+
+        lines = [ln for ln in body.split('\n') if ln.strip()]
+        responses = []
+        for header, search in zip(lines[::2], lines[1::2]):
+            header, search = json.loads(header), json.loads(search)
+            index = header.get('index', default_index)
+            with self.lock:
+                self.stats['searches'] += 1
+                if self.random.random() < self.reject_rate:
+                    self.stats['rejected_searches'] += 1
+                    responses.append({'status': 429, 'error': {
+                        'type': 'es_rejected_execution_exception'}})
+                    continue
+                resolved = self.__resolve(index)
+                if not resolved:
+                    responses.append({'status': 404, 'error': {
+                        'type': 'index_not_found_exception'}})
+                    continue
+                matcher = self.__matcher(resolved[0])
+            responses.append(self.__search(resolved[0], matcher, search))
+
+        return 200, {'responses': responses}
+
+    def __matcher(self, index):
+        """Local matcher over the documents of index, rebuilt when
+        documents have been indexed since the last search"""
+        from src.local_matcher import LocalUmlsMatcher
+
+        version, matcher = self.__matchers.get(index, (None, None))
+        if version != self.stats['items']:
+            # documents are identified by _id, which is the AUI unless
+            # the index has one document per string
+            record = namedtuple('Record', ('AUI', 'CUI', 'STR'))
+            docs = self.indices[index]['docs']
+            matcher = LocalUmlsMatcher.build(
+                record(_id, u'', docs[_id]['text']) for _id in sorted(docs))
+            self.__matchers[index] = (self.stats['items'], matcher)
+        return matcher
+
+    @staticmethod
+    def __matches(doc, filters):
+        """Whether doc has any of the values of each field in filters"""
+        for field, values in filters:
+            value = doc.get(field)
+            doc_values = value if isinstance(value, list) else [value]
+            if not set(doc_values).intersection(values):
+                return False
+        return True
+
+    def __search(self, index, matcher, search):
+        query = search['query']['function_score']
+        params = query['script_score']['script']['params']
+        docs = self.indices[index]['docs']
+
+        # terms filters are applied by scoring every document and
+        # keeping the top ones that pass them
+        filters = [terms.items()[0] for terms in
+                   (clause['terms'] for clause in
+                    query['query']['bool'].get('filter', []))]
+        size = search.get('size', 10)
+        candidates = matcher.score(params['ngrams'], params['text'],
+                                   alpha=params.get('alpha'),
+                                   beta=params.get('beta'),
+                                   k=len(docs) if filters else size)
+        if filters:
+            candidates = [cand for cand in candidates
+                          if self.__matches(docs[cand['AUI']], filters)]
+            candidates = candidates[:size]
+
+        hits = [{'_index': index, '_id': cand['AUI'],
+                 '_score': cand['score'],
+                 '_source': {'AUI': docs[cand['AUI']]['AUI'],
+                             'CUI': docs[cand['AUI']]['CUI']}}
+                for cand in candidates]
+        return {'status': 200, 'took': 0, 'hits': {
+            'total': len(hits), 'hits': hits,
+            'max_score': hits[0]['_score'] if hits else None}}
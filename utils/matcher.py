@@ -0,0 +1,278 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  batch matching of strings against the umls index
+
+# default modules
+import json
+from time import sleep
+from multiprocessing.pool import ThreadPool
+
+# installed modules
+from elasticsearch import TransportError
+
+# project modules
+from src.analysis import load_field_analyzers, DEFAULT_CACHE_SIZE
+from src.local_matcher import resolve_alpha_beta
+from src.exact_index import ExactIndex
+from utils.cache import Cache, DiskCache
+from utils.common import backoff_delay
+
+
+# native script installed by esplugin/setup.sh
+DEFAULT_SCRIPT = {'inline': 'umls', 'lang': 'native'}
+
+
+class UmlsMatcher(object):
+    """Matches strings against the umls index with UmlsScoringScript.
+
+    Strings are analyzed locally with the analyzers of the mapping; the
+    n-grams and terms are used both to select the candidate atoms (those
+    containing any of them) and as parameters of the scoring script.
+    Strings are sent in _msearch requests of up to batch_size searches,
+    with up to concurrency requests in flight; repeated strings are
+    searched once. If an exact index is provided and there are no
+    filters, strings whose normal form is the STR of some atoms are
+    answered with those atoms (match "exact", no score) without
+    searching the cluster; the other candidates have match "scored". If
+    the index has one document per string, each of the k documents found
+    gives one candidate per atom.
+
+    Args:
+        client (Elasticsearch): client to the cluster
+        index (str): index (or alias) to search
+        mapping (dict or str): mapping of the index or path to it
+        doc_type (str, default=None): type of the atoms; the first type
+            in the mapping if not provided
+        k (int, default=10): candidates returned per string
+        alpha (float, default=None): weight of the n-grams score
+        beta (float, default=None): weight of the text score
+        batch_size (int, default=100): searches per _msearch request
+        concurrency (int, default=1): _msearch requests in flight
+        script (dict, default=DEFAULT_SCRIPT): script used to score
+            candidates, without params
+        max_retries (int, default=3): retries of searches rejected
+            with HTTP 429
+        initial_backoff (int, default=2): seconds to wait before the
+            first retry; doubled at every retry up to max_backoff
+        cache_size (int, default=DEFAULT_CACHE_SIZE): strings whose
+            analysis is cached
+        exact_index (ExactIndex or str, default=None): index checked
+            before searching, or path to it; not used with filters,
+            as it only holds the AUI and CUI of atoms
+        filters (dict, default=None): values allowed for fields of the
+            atoms (e.g., {"TUI": ["T047"], "SAB": ["MSH"]}); searched
+            candidates are restricted to atoms with any of the values of
+            each field. They require an index with those fields (see
+            src.enrichment); every string is searched when filters
+            are set, so that all candidates are filtered.
+        result_cache (Cache, DiskCache or dict, default=None): cache of
+            the candidates of the strings matched, or the arguments of a
+            new utils.cache.Cache; strings found there are not searched
+            again. A cache must not be shared by matchers with
+            different settings.
+    """
+
+    def __init__(self, client, index, mapping, doc_type=None, k=10,
+                 alpha=None, beta=None, batch_size=100, concurrency=1,
+                 script=None, max_retries=3, initial_backoff=2,
+                 max_backoff=600, field_ngrams='ngrams', field_text='text',
+                 cache_size=DEFAULT_CACHE_SIZE, exact_index=None,
+                 filters=None, result_cache=None):
+        if isinstance(mapping, basestring):
+            with file(mapping) as f:
+                mapping = json.load(f)
+
+        self.client = client
+        self.index = index
+        self.doc_type = (doc_type if doc_type is not None
+                         else mapping['mappings'].keys()[0])
+        self.k = k
+        self.alpha, self.beta = resolve_alpha_beta(alpha, beta)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.script = script if script is not None else DEFAULT_SCRIPT
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.field_ngrams = field_ngrams
+        self.field_text = field_text
+        self.filters = {field: list(values) for field, values
+                        in (filters or {}).iteritems()}
+
+        if isinstance(exact_index, basestring):
+            exact_index = ExactIndex.load(exact_index)
+        self.exact_index = exact_index
+
+        if (result_cache is not None and
+                not isinstance(result_cache, (Cache, DiskCache))):
+            result_cache = Cache(**dict(result_cache))
+        self.result_cache = result_cache
+
+        analyzers = load_field_analyzers(mapping, self.doc_type,
+                                         cache_size=cache_size)
+        self.ngrams_analyzer = analyzers[field_ngrams]
+        self.text_analyzer = analyzers[field_text]
+
+    def build_query(self, ngrams, text):
+        """Search body for a string with the given n-grams and terms"""
+        params = {'field_ngrams': self.field_ngrams,
+                  'field_text': self.field_text,
+                  'ngrams': ngrams, 'text': text,
+                  # the script expects doubles
+                  'alpha': float(self.alpha), 'beta': float(self.beta)}
+        should = [{'terms': {field: terms}} for field, terms
+                  in ((self.field_ngrams, ngrams), (self.field_text, text))
+                  if terms]
+        query = {'should': should}
+        if self.filters:
+            # with a filter, should clauses would otherwise be optional
+            query['minimum_should_match'] = 1
+            query['filter'] = [{'terms': {field: values}} for field, values
+                               in sorted(self.filters.iteritems())]
+        return {
+            'size': self.k,
+            '_source': ['AUI', 'CUI'],
+            'query': {'function_score': {
+                'query': {'bool': query},
+                'script_score': {'script': dict(self.script,
+                                                params=params)},
+                'boost_mode': 'replace'}}}
+
+    def _msearch(self, queries):
+        """Runs queries in one _msearch request, sending again the
+        searches rejected with HTTP 429; returns their responses."""
+        responses = [None] * len(queries)
+        pending = range(len(queries))
+        if not pending:
+            return responses
+        header = {'index': self.index, 'type': self.doc_type}
+
+        for attempt in xrange(self.max_retries + 1):
+            if attempt > 0:
+                sleep(backoff_delay(attempt, self.initial_backoff,
+                                    self.max_backoff))
+            retry = attempt < self.max_retries
+
+            body = []
+            for i in pending:
+                body.extend((header, queries[i]))
+            try:
+                resp = self.client.msearch(body=body)
+            except TransportError as e:
+                if e.status_code == 429 and retry:
+                    continue
+                raise
+
+            rejected = []
+            for i, item in zip(pending, resp['responses']):
+                if item.get('status') == 429 and retry:
+                    rejected.append(i)
+                elif 'error' in item:
+                    raise RuntimeError(
+                        '[error] search failed: {}'.format(item['error']))
+                else:
+                    responses[i] = item
+
+            pending = rejected
+            if not pending:
+                break
+
+        return responses
+
+    def _match_batch(self, strings):
+        # atoms of the exact index could not be filtered
+        if self.exact_index is not None and not self.filters:
+            results = self.exact_index.lookup_many(strings, k=self.k)
+            for atoms in results:
+                for atom in atoms:
+                    atom.update(score=None, match='exact')
+            missed = [i for i, atoms in enumerate(results) if not atoms]
+            if missed:
+                scored = self._search_batch([strings[i] for i in missed])
+                for i, candidates in zip(missed, scored):
+                    results[i] = candidates
+            return results
+        return self._search_batch(strings)
+
+    def _search_batch(self, strings):
+        ngrams = self.ngrams_analyzer.analyze_many(strings)
+        text = self.text_analyzer.analyze_many(strings)
+
+        # strings without tokens can not match anything
+        searched = [i for i in xrange(len(strings)) if ngrams[i] or text[i]]
+        responses = self._msearch([self.build_query(ngrams[i], text[i])
+                                   for i in searched])
+
+        results = [[] for _ in strings]
+        for i, resp in zip(searched, responses):
+            results[i] = [candidate for hit in resp['hits']['hits']
+                          for candidate in self._hit_candidates(hit)]
+        return results
+
+    @staticmethod
+    def _hit_candidates(hit):
+        """Candidates of a search hit: one per atom, as documents of
+        indices with one document per string hold arrays of AUIs and
+        CUIs (see src.grouped_importer)"""
+        auis, cuis = hit['_source']['AUI'], hit['_source']['CUI']
+        if not isinstance(auis, list):
+            auis, cuis = [auis], [cuis]
+        return [{'AUI': aui, 'CUI': cui, 'score': hit['_score'],
+                 'match': 'scored'} for aui, cui in zip(auis, cuis)]
+
+    def match(self, strings):
+        """Top k candidates of each string.
+
+        Args:
+            strings (iterable): strings to match
+
+        Returns:
+            candidates (list): for each string, in input order, a list of
+                dictionaries with keys AUI, CUI, score and match, sorted
+                by decreasing score.
+        """
+        strings = list(strings)
+
+        # each distinct string is searched once
+        unique = {}
+        for string in strings:
+            unique.setdefault(string, len(unique))
+        distinct = sorted(unique, key=unique.get)
+
+        results = {}
+        if self.result_cache is not None:
+            for string in distinct:
+                candidates = self.result_cache.get(string)
+                if candidates is not None:
+                    results[string] = candidates
+            distinct = [string for string in distinct
+                        if string not in results]
+
+        batches = [distinct[i:i + self.batch_size]
+                   for i in xrange(0, len(distinct), self.batch_size)]
+
+        if self.concurrency > 1 and len(batches) > 1:
+            pool = ThreadPool(min(self.concurrency, len(batches)))
+            try:
+                batch_results = pool.map(self._match_batch, batches)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            batch_results = map(self._match_batch, batches)
+
+        matched = [res for batch in batch_results for res in batch]
+        for string, candidates in zip(distinct, matched):
+            results[string] = candidates
+            if self.result_cache is not None:
+                self.result_cache.put(string, candidates)
+
+        # candidates are copied, so that callers can not alter those
+        # cached or returned for another occurrence of the same string
+        return [[dict(candidate) for candidate in results[string]]
+                for string in strings]
+
+    def match_one(self, string):
+        return self.match([string])[0]
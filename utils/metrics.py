@@ -0,0 +1,284 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  counters, gauges and histograms of the import pipeline
+
+# default modules
+import os
+import json
+import tempfile
+import threading
+from bisect import bisect_left
+from time import time as now
+
+# installed modules
+# no modules
+
+# project modules
+# no modules
+
+
+# upper bounds (seconds) of the buckets of latency histograms
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                           2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter(object):
+    """Value that only increases (e.g., rows parsed, seconds spent)"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+
+class Gauge(Counter):
+    """Value that can go up and down (e.g., requests in flight)"""
+
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+
+class Histogram(object):
+    """Counts of observations by bucket, with their sum; buckets are
+    upper bounds, the last one being infinite"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, buckets=DEFAULT_LATENCY_BUCKETS, help=None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        pos = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[pos] += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile"""
+        counts = list(self.counts)
+        rank, seen = q * sum(counts), 0
+        for bound, cnt in zip(self.buckets, counts):
+            seen += cnt
+            if cnt and seen >= rank:
+                return bound
+        return None
+
+
+class _NullMetric(object):
+    """Stands for every metric while metrics are disabled"""
+
+    value = count = sum = 0
+
+    def inc(self, n=1):
+        pass
+
+    dec = set = observe = inc
+
+
+NULL_METRIC = _NullMetric()
+
+
+class MetricsRegistry(object):
+    """Metrics of this process by name.
+
+    While disabled, metrics are not recorded: counter(), gauge() and
+    histogram() return an object whose methods do nothing, so that
+    instrumented code costs a dictionary lookup at most. Code that
+    needs to time things can check enabled first.
+    """
+
+    def __init__(self, prefix='matchu_', enabled=False):
+        self.prefix = prefix
+        self.enabled = enabled
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def __get(self, cls, name, *args, **kwargs):
+        if not self.enabled:
+            return NULL_METRIC
+        metric = self.__metrics.get(name)
+        if metric is None:
+            with self.__lock:
+                metric = self.__metrics.setdefault(
+                    name, cls(name, *args, **kwargs))
+        return metric
+
+    def counter(self, name, help=None):
+        return self.__get(Counter, name, help=help)
+
+    def gauge(self, name, help=None):
+        return self.__get(Gauge, name, help=help)
+
+    def histogram(self, name, buckets=DEFAULT_LATENCY_BUCKETS, help=None):
+        return self.__get(Histogram, name, buckets, help=help)
+
+    def reset(self):
+        with self.__lock:
+            self.__metrics.clear()
+
+    def snapshot(self):
+        """Current values as a dictionary that can be serialized to JSON
+        and merged into another registry (see merge)"""
+        snapshot = {'time': now(), 'counters': {}, 'gauges': {},
+                    'histograms': {}}
+        for name, metric in sorted(self.__metrics.items()):
+            if metric.kind == 'histogram':
+                snapshot['histograms'][name] = {
+                    'buckets': list(metric.buckets[:-1]),
+                    'counts': list(metric.counts), 'sum': metric.sum}
+            else:
+                snapshot[metric.kind + 's'][name] = metric.value
+        return snapshot
+
+    def merge(self, snapshot):
+        """Adds the values of a snapshot of another registry (e.g., of a
+        worker process) to those of this one"""
+        for name, value in snapshot['counters'].iteritems():
+            self.counter(name).inc(value)
+        for name, value in snapshot['gauges'].iteritems():
+            self.gauge(name).inc(value)
+        for name, hist in snapshot['histograms'].iteritems():
+            metric = self.histogram(name, hist['buckets'])
+            if metric is NULL_METRIC:
+                continue
+            with metric._lock:
+                metric.counts = [a + b for a, b
+                                 in zip(metric.counts, hist['counts'])]
+                metric.sum += hist['sum']
+
+    def summary(self):
+        """Flat dictionary of the values of counters and gauges, and of
+        the count, mean and approximate quantiles of histograms"""
+        summary = {}
+        for name, metric in sorted(self.__metrics.items()):
+            if metric.kind != 'histogram':
+                summary[name] = metric.value
+                continue
+            count = metric.count
+            summary[name + '_count'] = count
+            summary[name + '_mean'] = metric.sum / count if count else None
+            for q in (0.5, 0.99):
+                summary['{}_p{:.0f}'.format(name, q * 100)] = (
+                    metric.quantile(q))
+        return summary
+
+    def to_prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        for name, metric in sorted(self.__metrics.items()):
+            full_name = self.prefix + name
+            if metric.help:
+                lines.append('# HELP {} {}'.format(full_name, metric.help))
+            lines.append('# TYPE {} {}'.format(full_name, metric.kind))
+            if metric.kind != 'histogram':
+                lines.append('{} {!r}'.format(full_name, metric.value))
+                continue
+            cumulative = 0
+            for bound, cnt in zip(metric.buckets, metric.counts):
+                cumulative += cnt
+                lines.append('{}_bucket{{le="{}"}} {}'.format(
+                    full_name, '+Inf' if bound == float('inf')
+                    else repr(bound), cumulative))
+            lines.append('{}_sum {!r}'.format(full_name, metric.sum))
+            lines.append('{}_count {}'.format(full_name, cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes a snapshot to path, in the Prometheus text format if
+        path ends with .prom and as JSON otherwise; the file is replaced
+        atomically, so that it can be read at any time"""
+        if path.endswith('.prom'):
+            data = self.to_prometheus()
+        else:
+            data = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+
+
+# metrics of the current process, disabled until enabled
+metrics = MetricsRegistry()
+
+
+class MetricsReporter(object):
+    """Every interval seconds, prints a line "[metrics] {...}" with the
+    summary of registry as JSON, along with the rate per second of each
+    counter since the previous line, and writes a snapshot to path if
+    provided. Runs in a daemon thread between start() and stop(), which
+    reports one last time.
+    """
+
+    def __init__(self, registry=metrics, interval=10, path=None):
+        self.registry = registry
+        self.interval = interval
+        self.path = path
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__previous = None
+
+    def report(self):
+        summary = self.registry.summary()
+        current = now()
+        if self.__previous is not None:
+            previous_time, previous = self.__previous
+            elapsed = current - previous_time
+            for name, value in summary.items():
+                if (name.endswith('_total') and elapsed > 0 and
+                        name in previous):
+                    summary[name[:-len('_total')] + '_per_sec'] = round(
+                        (value - previous[name]) / elapsed, 3)
+        self.__previous = (current, summary)
+
+        print '[metrics] {}'.format(json.dumps(summary, sort_keys=True))
+        if self.path:
+            self.registry.write(self.path)
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.report()
+
+    def start(self):
+        self.__previous = (now(), self.registry.summary())
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+        self.report()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
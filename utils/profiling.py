@@ -0,0 +1,412 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  aggregated timings of nested spans and profiled functions
+
+# default modules
+import gc
+import os
+import sys
+import json
+import atexit
+import signal
+import random
+import threading
+import importlib
+from functools import wraps
+from contextlib import contextmanager
+from time import time as now
+
+# installed modules
+# no modules
+
+# project modules
+from utils.common import format_elapsed
+
+
+# number of latencies kept per span to estimate its percentiles
+RESERVOIR_SIZE = 1024
+
+# the first calls of each span are timed regardless of sampling, so
+# that spans entered a few times are timed as well
+ALWAYS_SAMPLED = 10
+
+
+class SpanStats(object):
+    """Calls of a span: all of them are counted, but only sampled ones
+    are timed; latencies of up to RESERVOIR_SIZE sampled calls, chosen
+    uniformly at random, are kept to estimate percentiles"""
+
+    def __init__(self, path):
+        self.path = path
+        self.children = {}
+        self.calls = 0
+        self.sampled = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.gc_objects = 0
+        self.reservoir = []
+        self.lock = threading.Lock()
+
+    def record(self, elapsed, gc_objects):
+        with self.lock:
+            self.sampled += 1
+            self.total += elapsed
+            self.gc_objects += gc_objects
+            if elapsed > self.max:
+                self.max = elapsed
+            if len(self.reservoir) < RESERVOIR_SIZE:
+                self.reservoir.append(elapsed)
+            else:
+                pos = random.randrange(self.sampled)
+                if pos < RESERVOIR_SIZE:
+                    self.reservoir[pos] = elapsed
+
+    def merge(self, snapshot):
+        """Adds the calls of a snapshot of another span (see
+        Profiler.snapshot) to this one"""
+        with self.lock:
+            self.calls += snapshot['calls']
+            self.sampled += snapshot['sampled']
+            self.total += snapshot['total']
+            self.gc_objects += snapshot['gc_objects']
+            if snapshot['sampled'] and snapshot['max'] > self.max:
+                self.max = snapshot['max']
+            # percentiles of the merged span are estimated from a sample
+            # of both reservoirs
+            reservoir = self.reservoir + snapshot['reservoir']
+            if len(reservoir) > RESERVOIR_SIZE:
+                reservoir = random.sample(reservoir, RESERVOIR_SIZE)
+            self.reservoir = reservoir
+
+    def percentile(self, q):
+        latencies = sorted(self.reservoir)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def to_dict(self):
+        mean = self.total / self.sampled if self.sampled else None
+        return {'span': '/'.join(self.path), 'calls': self.calls,
+                'sampled': self.sampled,
+                # calls that were not timed are assumed to take as long
+                # as the sampled ones on average
+                'total': mean * self.calls if self.sampled else 0.0,
+                'mean': mean, 'max': self.max if self.sampled else None,
+                'p50': self.percentile(0.5), 'p99': self.percentile(0.99),
+                'gc_objects': self.gc_objects}
+
+
+class Profiler(object):
+    """Aggregates the latency of spans, which can be nested.
+
+    Spans are either blocks of code (see span) or calls of functions
+    (see profile and attach); each is identified by its name and by
+    the names of the spans it runs in, in the same thread. Every call
+    is counted, but only a fraction sample_rate of them is timed,
+    which keeps the cost of spans entered millions of times low. If
+    track_allocations, each timed call also counts the objects tracked
+    by the garbage collector that it allocated and did not free; this
+    is approximate, as collections during the call reset the count.
+
+    While disabled, spans and profiled functions only check whether
+    the profiler is enabled. Processes forked from this one (e.g., the
+    workers of a multiprocessing.Pool) should reset their copy of the
+    profiler and send back a snapshot, which the parent merges.
+    """
+
+    def __init__(self, enabled=False, sample_rate=1.0,
+                 track_allocations=False):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.track_allocations = track_allocations
+        self.__stats = {}
+        self.__root = SpanStats(())
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__attached = []
+        self.__start = now()
+        self.__pid = os.getpid()
+
+    def __stack(self):
+        try:
+            return self.__local.stack
+        except AttributeError:
+            self.__local.stack = [self.__root]
+            return self.__local.stack
+
+    def __child(self, parent, name):
+        stats = parent.children.get(name)
+        if stats is None:
+            with self.__lock:
+                stats = parent.children.get(name)
+                if stats is None:
+                    stats = SpanStats(parent.path + (name, ))
+                    parent.children[name] = stats
+                    self.__stats[stats.path] = stats
+        return stats
+
+    def __enter(self, name):
+        stack = self.__stack()
+        stats = self.__child(stack[-1], name)
+        stack.append(stats)
+        with stats.lock:
+            stats.calls += 1
+
+        if (self.sample_rate < 1 and stats.sampled >= ALWAYS_SAMPLED and
+                random.random() >= self.sample_rate):
+            return stats, None, None
+        gc_count = gc.get_count()[0] if self.track_allocations else None
+        return stats, now(), gc_count
+
+    def __exit(self, stats, start, gc_count):
+        if start is not None:
+            elapsed = now() - start
+            gc_objects = 0
+            if gc_count is not None:
+                gc_objects = max(0, gc.get_count()[0] - gc_count)
+            stats.record(elapsed, gc_objects)
+        self.__stack().pop()
+
+    @contextmanager
+    def span(self, name):
+        """Times the block of code it wraps as span name"""
+        if not self.enabled:
+            yield
+            return
+        state = self.__enter(name)
+        try:
+            yield
+        finally:
+            self.__exit(*state)
+
+    def profile(self, func=None, name=None):
+        """Decorator that times the calls of func as span name (by
+        default, the qualified name of func); can be used with or
+        without arguments. Functions returning generators are only
+        timed until the generator is returned."""
+        if func is None:
+            return lambda func: self.profile(func, name)
+        name = name or _qualified_name(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            state = self.__enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.__exit(*state)
+        wrapper.__profiled__ = func
+        return wrapper
+
+    def attach(self, target, name=None):
+        """Profiles an existing function or method in place, without
+        changing its callers or signature.
+
+        Args:
+            target (str): "module:attribute", where attribute is the name
+                of a function of the module or "Class.method". Modules
+                that imported a function by name (e.g., "from
+                utils.es_tools import bulk_create") are patched as well.
+            name (str, default=None): name of the span; target without
+                the module if not provided.
+
+        Returns:
+            detach (callable): restores the original function.
+        """
+        module_name, _, attr_path = target.partition(':')
+        owner = importlib.import_module(module_name)
+        attrs = attr_path.split('.')
+        for attr in attrs[:-1]:
+            owner = getattr(owner, attr)
+        attr = attrs[-1]
+
+        if isinstance(owner, type):
+            # the function in the class dictionary, so that static and
+            # class methods are rewrapped as such
+            original = owner.__dict__[attr]
+            if isinstance(original, (staticmethod, classmethod)):
+                wrapped = type(original)(self.profile(
+                    original.__func__, name or attr_path))
+            else:
+                wrapped = self.profile(original, name or attr_path)
+            patched = [(owner, attr, original)]
+        else:
+            original = getattr(owner, attr)
+            wrapped = self.profile(original, name or attr_path)
+            patched = [(module, attr, original)
+                       for module in sys.modules.values()
+                       if getattr(module, attr, None) is original]
+
+        for obj, attr_name, _ in patched:
+            setattr(obj, attr_name, wrapped)
+        self.__attached.extend(patched)
+
+        def detach():
+            for obj, attr_name, value in patched:
+                setattr(obj, attr_name, value)
+                self.__attached.remove((obj, attr_name, value))
+        return detach
+
+    def detach_all(self):
+        for obj, attr, original in reversed(self.__attached):
+            setattr(obj, attr, original)
+        del self.__attached[:]
+
+    def reset(self):
+        """Forgets all spans, including those the calling thread is in
+        (e.g., those inherited by a forked process)"""
+        with self.__lock:
+            self.__stats.clear()
+            self.__root.children.clear()
+        self.__local = threading.local()
+        self.__start = now()
+
+    def snapshot(self):
+        """Statistics of spans as a dictionary that can be pickled or
+        serialized to JSON and merged into another profiler (see
+        merge)"""
+        spans = []
+        for path, stats in sorted(self.__stats.items()):
+            with stats.lock:
+                spans.append({'path': list(path), 'calls': stats.calls,
+                              'sampled': stats.sampled,
+                              'total': stats.total, 'max': stats.max,
+                              'gc_objects': stats.gc_objects,
+                              'reservoir': list(stats.reservoir)})
+        return {'elapsed': now() - self.__start, 'spans': spans}
+
+    def merge(self, snapshot):
+        """Adds the spans of a snapshot of another profiler (e.g., of a
+        worker process) to those of this one, nested under the span
+        the calling thread is in"""
+        parent = self.__stack()[-1]
+        # parents are listed before their children
+        for span_snapshot in snapshot['spans']:
+            stats = parent
+            for name in span_snapshot['path']:
+                stats = self.__child(stats, name)
+            stats.merge(span_snapshot)
+
+    def stats(self):
+        """Statistics of each span, sorted so that spans are listed
+        right after the span they run in"""
+        return [stats.to_dict() for _, stats
+                in sorted(self.__stats.items())]
+
+    def report(self):
+        """Lines of a table of the statistics of spans, nested spans
+        being indented under the span they run in"""
+        lines = ['[profile] {:<40} {:>10} {:>10} {:>12} {:>9} {:>9} {:>9}'
+                 ''.format('span', 'calls', 'sampled', 'total', 'mean ms',
+                           'p50 ms', 'p99 ms') +
+                 (' {:>10}'.format('gc objs')
+                  if self.track_allocations else '')]
+        for _, stats in sorted(self.__stats.items()):
+            row = stats.to_dict()
+            label = '  ' * (len(stats.path) - 1) + stats.path[-1]
+            lines.append(
+                '[profile] {:<40} {:>10,} {:>10,} {:>12} {:>9} {:>9} {:>9}'
+                ''.format(label[:40], row['calls'], row['sampled'],
+                          format_elapsed(row['total']),
+                          *[_format_ms(row[key])
+                            for key in ('mean', 'p50', 'p99')]) +
+                (' {:>10,}'.format(row['gc_objects'])
+                 if self.track_allocations else ''))
+        lines.append('[profile] {} spans in {}'.format(
+            len(self.__stats), format_elapsed(now() - self.__start)))
+        return lines
+
+    def dump(self, path=None, printer=None):
+        """Prints the report with printer (by default, to standard
+        output), or writes the statistics of spans to path as JSON if
+        provided. In processes forked after the profiler was created or
+        installed, the pid of the process is added to path (e.g.,
+        "profile.1234.json"), so that they do not overwrite each
+        other's statistics."""
+        if path is not None and os.getpid() != self.__pid:
+            root, ext = os.path.splitext(path)
+            path = '{}.{}{}'.format(root, os.getpid(), ext)
+        if path is None:
+            printer = printer or _write_line
+            for line in self.report():
+                printer(line)
+            return
+        with open(path, 'w') as f:
+            json.dump({'elapsed': now() - self.__start,
+                       'spans': self.stats()}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def install(self, path=None, at_exit=True, signum=signal.SIGUSR1):
+        """Dumps the statistics (see dump) when the process exits if
+        at_exit, and whenever it receives signal signum if not None
+        (e.g., "kill -USR1 <pid>"); signal handlers can only be set
+        from the main thread.
+
+        Forked processes inherit the signal handler, but not the dump at
+        exit if they end with os._exit, as the workers of a
+        multiprocessing.Pool do.
+        """
+        self.__pid = os.getpid()
+        if at_exit:
+            atexit.register(self.dump, path)
+        if signum is not None:
+            signal.signal(signum, lambda *args: self.dump(path))
+
+
+def _qualified_name(func):
+    """"Class.method" for methods defined in a class, the name of the
+    function otherwise"""
+    cls = getattr(func, 'im_class', None)
+    if cls is not None:
+        return '{}.{}'.format(cls.__name__, func.__name__)
+    return func.__name__
+
+
+def _write_line(line):
+    sys.stdout.write(line + '\n')
+
+
+def _format_ms(seconds):
+    return '-' if seconds is None else '{:.3f}'.format(seconds * 1000)
+
+
+# profiler of the current process, disabled until enabled
+profiler = Profiler()
+span = profiler.span
+profile = profiler.profile
+attach = profiler.attach
+
+
+def configure(enabled=False, sample_rate=1.0, track_allocations=False,
+              attach=(), dump_path=None, dump_at_exit=True,
+              dump_signal='SIGUSR1'):
+    """Sets up the profiler of the current process from the options of
+    a configuration file.
+
+    Args:
+        enabled (bool, default=False): if false, nothing else is done
+        sample_rate, track_allocations: see Profiler
+        attach (list, default=()): functions to profile, as targets of
+            Profiler.attach (e.g., "utils.es_tools:bulk_create")
+        dump_path (str, default=None): see Profiler.dump
+        dump_at_exit (bool, default=True), dump_signal (str,
+            default='SIGUSR1'): when statistics are dumped (see
+            Profiler.install); dump_signal can be null.
+
+    Returns:
+        profiler (Profiler): the profiler of the current process.
+    """
+    profiler.enabled = enabled
+    if not enabled:
+        return profiler
+    profiler.sample_rate = sample_rate
+    profiler.track_allocations = track_allocations
+    for target in attach:
+        profiler.attach(target)
+    profiler.install(dump_path, dump_at_exit,
+                     getattr(signal, dump_signal) if dump_signal else None)
+    return profiler
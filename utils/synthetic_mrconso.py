@@ -0,0 +1,222 @@
+#!/usr/bin/python
+
+# author:       Luca Soldaini
+# email:        luca@soldaini.net
+# description:  synthetic MRCONSO files for tests and benchmarks
+
+# default modules
+from __future__ import print_function
+import os
+import random
+import tempfile
+from bisect import bisect
+from argparse import ArgumentParser
+
+# installed modules
+# no modules
+
+# project modules
+# no modules
+
+
+# syllables synthetic words are made of, and real words mixed in so
+# that common medical terms show up with a high frequency
+SYLLABLES = ('ca', 'di', 'o', 'my', 'in', 'far', 'tion', 're', 'nal', 'hy',
+             'per', 'ten', 'sis', 'pul', 'mo', 'na', 'ry', 'em', 'bo', 'lis',
+             'ac', 'ute', 'chro', 'nic', 'car', 'ci', 'no', 'ma', 'neu',
+             'ro', 'gas', 'tri', 'tis', 'an', 'e', 'mi', 'a', 'col', 'ith',
+             'ly', 'ep', 'ic', 'os', 'te', 'ar', 'thr', 'path', 'y', 'cyst',
+             'derm', 'hep', 'at', 'oma', 'leu', 'ke', 'ost', 'al', 'gi')
+MEDICAL_WORDS = ('acute chronic disease disorder syndrome pain heart '
+                 'attack myocardial infarction renal failure kidney liver '
+                 'diabetes mellitus type hypertension pulmonary embolism '
+                 'chest breast carcinoma cirrhosis anemia iron deficiency '
+                 'fracture left right lower upper limb injury infection '
+                 'neoplasm malignant benign of the and with without '
+                 'unspecified primary secondary').split()
+
+# weights of the number of words of a string (1 to 12), of atoms per
+# concept (1 to 10) and of languages, sources and term types; these
+# follow the shape of a UMLS release: short strings and concepts with
+# few atoms are common, but long tails are there
+WORDS_PER_STRING = (18, 26, 20, 13, 8, 5, 3, 2, 1.5, 1.2, 1, 0.8)
+ATOMS_PER_CONCEPT = (30, 22, 14, 9, 6, 5, 4, 3, 2, 2)
+LANGUAGES = (('ENG', 70), ('SPA', 8), ('FRE', 4), ('GER', 3), ('DUT', 3),
+             ('ITA', 2), ('POR', 2), ('JPN', 4), ('CZE', 2), ('RUS', 2))
+SOURCES = (('SNOMEDCT_US', ('PT', 'FN', 'SY'), 25),
+           ('MSH', ('MH', 'ENTRY', 'PEP'), 15),
+           ('MDR', ('PT', 'LLT'), 12), ('NCI', ('PT', 'SY'), 12),
+           ('RXNORM', ('IN', 'SCD', 'SBD'), 10), ('LNC', ('LN', 'LC'), 10),
+           ('ICD10CM', ('PT', 'HT'), 8), ('MEDLINEPLUS', ('PT', ), 8))
+
+# letters added to words in other languages, so that non-ASCII text
+# goes through the parser as it does with a real release
+ACCENTED = {'SPA': u'\xf1\xe1\xe9\xed\xf3', 'FRE': u'\xe9\xe8\xea\xe7',
+            'GER': u'\xe4\xf6\xfc\xdf', 'DUT': u'\xeb\xef\xe9',
+            'ITA': u'\xe0\xf2\xf9', 'POR': u'\xe3\xf5\xe7',
+            'CZE': u'\u010d\u0159\u0161\u017e',
+            'RUS': u'\u0434\u0436\u0444\u044f',
+            'JPN': u'\u764c\u75c7\u708e'}
+
+
+class _Weighted(object):
+    """Draws items with probability proportional to their weights"""
+
+    def __init__(self, items, weights):
+        self.items = list(items)
+        self.cumulative = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+        self.total = total
+
+    def draw(self, rnd):
+        return self.items[bisect(self.cumulative, rnd.random() * self.total)]
+
+
+class MrconsoGenerator(object):
+    """Generates rows of MRCONSO.RRF with realistic distributions of
+    string lengths and words: words are drawn from a vocabulary of
+    vocab_size synthetic and real words with a Zipfian distribution
+    (exponent zipf), and atoms of the same concept are variants of its
+    preferred string (case, word order, qualifiers), in several
+    languages and sources. Output is fully determined by seed.
+    """
+
+    def __init__(self, seed=0, vocab_size=50000, zipf=1.05):
+        self.random = random.Random(seed)
+        rnd = self.random
+
+        vocab = set()
+        while len(vocab) < vocab_size:
+            vocab.add(''.join(rnd.choice(SYLLABLES)
+                              for _ in xrange(rnd.randint(2, 5))))
+        vocab = sorted(vocab)
+        rnd.shuffle(vocab)
+        vocab = list(MEDICAL_WORDS) + vocab
+        self.words = _Weighted(vocab, (1.0 / (rank + 1) ** zipf
+                                       for rank in xrange(len(vocab))))
+
+        self.words_per_string = _Weighted(
+            xrange(1, len(WORDS_PER_STRING) + 1), WORDS_PER_STRING)
+        self.atoms_per_concept = _Weighted(
+            xrange(1, len(ATOMS_PER_CONCEPT) + 1), ATOMS_PER_CONCEPT)
+        self.languages = _Weighted(*zip(*LANGUAGES))
+        self.sources = _Weighted([src[:2] for src in SOURCES],
+                                 [src[2] for src in SOURCES])
+
+        self.concepts = self.atoms = self.strings = 0
+
+    def __variant(self, string, lang):
+        rnd = self.random
+        choice = rnd.random()
+        if choice < 0.3:
+            pass
+        elif choice < 0.45:
+            string = string.title()
+        elif choice < 0.55:
+            string = string + ', NOS'
+        elif choice < 0.65:
+            string = string + ' (disorder)'
+        elif choice < 0.75:
+            string = ' '.join(reversed(string.split(' ')))
+        elif choice < 0.8:
+            string = string.upper()
+        else:
+            string = string + 's'
+
+        if lang != 'ENG':
+            letters = ACCENTED[lang]
+            string = u''.join(c if rnd.random() > 0.08
+                              else rnd.choice(letters)
+                              for c in string.decode('ascii'))
+            string = string.encode('utf-8')
+        return string
+
+    def rows(self):
+        """Yields lines of MRCONSO, newline included, indefinitely"""
+        rnd = self.random
+        while True:
+            self.concepts += 1
+            cui = 'C{:07d}'.format(self.concepts)
+            preferred = ' '.join(
+                self.words.draw(rnd)
+                for _ in xrange(self.words_per_string.draw(rnd)))
+
+            for i in xrange(self.atoms_per_concept.draw(rnd)):
+                self.atoms += 1
+                self.strings += 1
+                lang = 'ENG' if i == 0 else self.languages.draw(rnd)
+                string = (preferred if i == 0
+                          else self.__variant(preferred, lang))
+                sab, ttys = self.sources.draw(rnd)
+                suppress = 'N' if rnd.random() > 0.05 else rnd.choice('OEY')
+                yield '|'.join((
+                    cui, lang, 'P' if i == 0 else 'S',
+                    'L{:07d}'.format(self.concepts * 2 + (i > 0)),
+                    'PF' if i == 0 else 'VO',
+                    'S{:07d}'.format(self.strings),
+                    'Y' if i == 0 else rnd.choice('YN'),
+                    'A{:08d}'.format(self.atoms), '',
+                    '{:d}'.format(rnd.randint(1, 10 ** 8)),
+                    'D{:06d}'.format(self.concepts % 10 ** 6), sab,
+                    rnd.choice(ttys), 'D{:06d}'.format(self.concepts),
+                    string, rnd.choice('0039'), suppress,
+                    '256' if rnd.random() < 0.1 else '', '')) + '\n'
+
+
+def generate_mrconso(path, rows=None, size=None, seed=0, **kwargs):
+    """Writes a synthetic MRCONSO of rows rows, or of size bytes plus
+    at most one row; other options are those of MrconsoGenerator. The
+    file is written to a temporary file first, then renamed to path.
+
+    Returns:
+        stats (dict): rows, bytes, concepts and seed of the file.
+    """
+    if (rows is None) == (size is None):
+        raise ValueError('exactly one of rows and size is required')
+
+    generator = MrconsoGenerator(seed=seed, **kwargs)
+    written = n_rows = 0
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.mrconso.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for line in generator.rows():
+                if rows is not None and n_rows >= rows:
+                    break
+                if size is not None and written >= size:
+                    break
+                f.write(line)
+                written += len(line)
+                n_rows += 1
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+    return {'rows': n_rows, 'bytes': written, 'seed': seed,
+            'concepts': generator.concepts}
+
+
+def main():
+    ap = ArgumentParser(description='writes a synthetic MRCONSO.RRF')
+    ap.add_argument('output_path')
+    group = ap.add_mutually_exclusive_group(required=True)
+    group.add_argument('-r', '--rows', type=int)
+    group.add_argument('-s', '--size-mb', type=float)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--vocab-size', type=int, default=50000)
+    opts = ap.parse_args()
+
+    stats = generate_mrconso(
+        opts.output_path, rows=opts.rows,
+        size=int(opts.size_mb * 2 ** 20) if opts.size_mb else None,
+        seed=opts.seed, vocab_size=opts.vocab_size)
+    print('[info] {rows:,} rows of {concepts:,} concepts ({bytes:,} '
+          'bytes) written'.format(**stats))
+
+
+if __name__ == '__main__':
+    main()